@@ -0,0 +1,237 @@
+'''
+Benchmarks for the TRACMASS kernel with synthetic fields on a full-size grid,
+and for the stepping backends on the rectangle example.
+These are not tests, and are not collected by py.test. Run with, for example,
+python benchmarks.py sort 1000000
+python benchmarks.py backends 100000
+python benchmarks.py repack ocean_his_0001.nc
+python benchmarks.py rawread ocean_his_0001.nc
+'''
+
+import os
+import sys
+import time
+import datetime
+import shutil
+import tempfile
+import numpy as np
+import tracpy
+import tracpy.repack
+import tracpy.kernel
+import tracpy.tools
+from tracpy.tracpy_class import Tracpy
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+
+def synthetic_fields(imt=1000, jmt=1000, km=10, seed=0):
+    '''
+    Make random fluxes and layer thicknesses for a grid of size imt x jmt x km,
+    with a mean flow to the east.
+    '''
+
+    rs = np.random.RandomState(seed)
+    uf = np.asfortranarray(800. + 400.*rs.rand(imt-1, jmt, km, 2))
+    vf = np.asfortranarray(300.*(rs.rand(imt, jmt-1, km, 2) - 0.5))
+    dzt = np.asfortranarray(8. + 4.*rs.rand(imt, jmt, km, 2))
+    grid = {'kmt': np.ones((imt, jmt))*km, 'dxdy': np.ones((imt, jmt))*1e6,
+            'dxv': np.ones((imt, jmt-1))*1e3, 'dyu': np.ones((imt-1, jmt))*1e3,
+            'h': np.ones((imt, jmt))*km*10.}
+
+    return uf, vf, dzt, tracpy.kernel.grid_args(grid)
+
+def run_kernel(xstart, ystart, zstart, uf, vf, dzt, gridargs, N=1, iter=4, backend='fortran',
+                output=False):
+    '''
+    Step drifters through one model output with a backend, returning the wall time,
+    and the final positions and flags if output is True.
+    '''
+
+    backend = tracpy.kernel.get_backend(backend)
+
+    ntrac = xstart.size
+    xend, yend, zend, ttend = [np.zeros((ntrac, N), order='F') for i in xrange(4)]
+    flag = np.zeros(ntrac, dtype=tracpy.kernel.inttype)
+    wft = np.zeros((1, 1, uf.shape[2]+1, 2), order='F')
+    dxyzt = np.zeros((1, 1, uf.shape[2], 2), order='F')
+    counts = np.zeros((1, 4), dtype=tracpy.kernel.inttype, order='F')
+
+    tic = time.time()
+    backend.step(xstart, ystart, zstart, 3600., uf, vf, 0., 1., 1,
+                    gridargs['kmt'], dzt, gridargs['dxdy'], gridargs['dxv'],
+                    gridargs['dyu'], gridargs['h'], xend, yend, zend, flag, ttend,
+                    iter, 0., 0., 0, 0, 0, 0, 0, wft, dxyzt, 0, counts, 30000)
+    toc = time.time() - tic
+
+    if output:
+        return toc, xend[:,-1], yend[:,-1], flag
+    else:
+        return toc
+
+def bench_sort(ntrac=100000, imt=1000, jmt=1000, km=10, repeat=3):
+    '''
+    Compare stepping drifters in random order with stepping them in the order
+    found by tracpy.tools.morton_order, which includes the time for sorting.
+    The best of repeat runs is shown.
+    '''
+
+    uf, vf, dzt, gridargs = synthetic_fields(imt, jmt, km)
+
+    rs = np.random.RandomState(1)
+    xstart = 2. + rs.rand(ntrac)*(imt-20)
+    ystart = 2. + rs.rand(ntrac)*(jmt-4)
+    zstart = 0.5 + rs.randint(0, km, ntrac)
+
+    trandom = min([run_kernel(xstart, ystart, zstart, uf, vf, dzt, gridargs) 
+                    for i in xrange(repeat)])
+
+    tic = time.time()
+    ind = tracpy.tools.morton_order(xstart, ystart)
+    xs, ys, zs = xstart[ind], ystart[ind], zstart[ind]
+    tsort = time.time() - tic
+    tsorted = min([run_kernel(xs, ys, zs, uf, vf, dzt, gridargs) 
+                    for i in xrange(repeat)])
+
+    print '%d drifters on a %d x %d x %d grid' % (ntrac, imt, jmt, km)
+    print '  random order: %.3f s' % trandom
+    print '  morton order: %.3f s (%.3f s of which for sorting)' % (tsorted + tsort, tsort)
+
+def bench_backends(ntrac=100000, imt=1000, jmt=1000, km=10):
+    '''
+    Compare the throughput and results of the fortran and numpy backends, 
+    on synthetic fields and on the rectangle example in tests/input.
+    '''
+
+    uf, vf, dzt, gridargs = synthetic_fields(imt, jmt, km)
+
+    rs = np.random.RandomState(1)
+    xstart = 2. + rs.rand(ntrac)*(imt-20)
+    ystart = 2. + rs.rand(ntrac)*(jmt-4)
+    zstart = 0.5 + rs.randint(0, km, ntrac)
+
+    res = {}
+    for backend in ['fortran', 'numpy']:
+        res[backend] = run_kernel(xstart, ystart, zstart, uf, vf, dzt, gridargs, 
+                                    backend=backend, output=True)
+
+    print '%d drifters on a %d x %d x %d grid' % (ntrac, imt, jmt, km)
+    for backend in ['fortran', 'numpy']:
+        print '  %s: %.3f s (%.0f drifters/s)' % (backend, res[backend][0], ntrac/res[backend][0])
+    print '  max difference in final x, y: %e, %e, same flags: %s' \
+            % (np.abs(res['fortran'][1] - res['numpy'][1]).max(), 
+                np.abs(res['fortran'][2] - res['numpy'][2]).max(), 
+                (res['fortran'][3] == res['numpy'][3]).all())
+
+    # rectangle example, as in test_rect.py
+    currents_filename = os.path.join(here, 'input', 'ocean_his_0001.nc')
+    grid_filename = os.path.join(here, 'input', 'grid.nc')
+    date = datetime.datetime(2013, 12, 19, 0)
+    tseas = 4*3600. # 4 hours between outputs, in seconds 
+    ndays = tseas*9./(3600.*24)
+    lon0 = np.linspace(-123.1, -122.9, 50)
+    lat0 = np.ones(50)*48.6
+
+    res = {}
+    for backend in ['fortran', 'numpy']:
+        tp = Tracpy(currents_filename, grid_filename, name='bench_backends_' + backend, 
+                    tseas=tseas, ndays=ndays, nsteps=5, N=4, ff=1, ah=0., av=0., doturb=0, do3d=0, 
+                    z0='s', zpar=2, time_units='seconds since 1970-01-01', savell=False, 
+                    backend=backend)
+        tic = time.time()
+        xg, yg, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+        res[backend] = (time.time() - tic, xg, yg)
+
+    print 'rectangle example, %d drifters' % lon0.size
+    for backend in ['fortran', 'numpy']:
+        print '  %s: %.3f s' % (backend, res[backend][0])
+    print '  max difference in tracks (grid cells): %e' \
+            % np.nanmax(np.abs(res['fortran'][1] - res['numpy'][1]))
+
+def read_slabs(loc):
+    '''
+    Read u, v and zeta one time step at a time, as readfields does, returning the
+    wall time and the number of bytes read.
+    '''
+
+    nc = tracpy.inout.opendataset(loc)
+    names = [name for name in tracpy.repack.fields if name in nc.variables]
+    nbytes = 0
+    tic = time.time()
+    for t in xrange(len(nc.variables['ocean_time'])):
+        for name in names:
+            nbytes += nc.variables[name][t].nbytes
+    toc = time.time() - tic
+    nc.close()
+
+    return toc, nbytes
+
+def bench_repack(loc=None, float32=False):
+    '''
+    Compare the throughput of reading model output one time step at a time before
+    and after repacking it with tracpy.repack.
+    '''
+
+    if loc is None:
+        loc = os.path.join(here, 'input', 'ocean_his_0001.nc')
+
+    directory = tempfile.mkdtemp()
+    try:
+        tic = time.time()
+        packed = tracpy.repack.repack(loc, os.path.join(directory, 'packed.nc'), float32=float32)
+        print 'repacked %s in %.1f s' % (loc, time.time() - tic)
+
+        for name, filename in [('original', loc), ('repacked', packed)]:
+            toc, nbytes = read_slabs(filename)
+            print '  %s: %.3f s for %.1f MB (%.1f MB/s)' % (name, toc, nbytes/1e6, nbytes/1e6/toc)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_rawread(loc=None, repeat=3):
+    '''
+    Compare reading model output with netCDF4's masking and scaling and with
+    tracpy.inout.rawread: the time for reading u and v one time step at a time, and
+    the memory of the arrays that each read makes.
+    '''
+
+    if loc is None:
+        loc = os.path.join(here, 'input', 'ocean_his_0001.nc')
+
+    nc = tracpy.inout.opendataset(loc)
+    nt = len(nc.variables['ocean_time'])
+    names = ['u', 'v']
+
+    res = {}
+    for raw in [False, True]:
+        best = np.inf
+        for i in xrange(repeat):
+            nbytes = 0
+            tic = time.time()
+            for t in xrange(nt):
+                for name in names:
+                    values = tracpy.inout._read(nc.variables[name], t, raw)
+                    nbytes += values.nbytes
+                    if np.ma.isMaskedArray(values) and values.mask is not np.ma.nomask:
+                        nbytes += values.mask.nbytes
+            best = min(best, time.time() - tic)
+        res[raw] = (best, nbytes)
+    nc.close()
+
+    print 'reading u and v for %d time steps of %s' % (nt, loc)
+    for raw, name in [(False, 'masked and scaled'), (True, 'raw')]:
+        print '  %s: %.4f s per step, %.2f MB of arrays per step' \
+                % (name, res[raw][0]/nt, res[raw][1]/1e6/nt)
+
+
+if __name__ == '__main__':
+    bench = sys.argv[1] if len(sys.argv) > 1 else 'sort'
+    if bench == 'repack':
+        bench_repack(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif bench == 'rawread':
+        bench_rawread(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        ntrac = int(float(sys.argv[2])) if len(sys.argv) > 2 else 100000
+        if bench == 'sort':
+            bench_sort(ntrac)
+        elif bench == 'backends':
+            bench_backends(ntrac)
@@ -0,0 +1,146 @@
+'''
+Testing campaigns of simulations
+Call with py.test test_campaign.py
+'''
+
+import tracpy
+import tracpy.campaign
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import multiprocessing
+import netCDF4 as netCDF
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+def fake_run(campaign, name, task):
+    '''
+    Stand-in for running a simulation, which fails for tasks that ask for it.
+    '''
+
+    if task['params'].get('fail'):
+        raise ValueError('failing on purpose')
+    filename = os.path.join(campaign.directory, 'tracks', name + '.txt')
+    f = open(filename, 'a')
+    f.write('ran\n')
+    f.close()
+    return filename
+
+def tasks(n):
+    return dict(('task%02d' % i, {'date': '2013-12-19 00:00:00', 'lon0': [-123.], 'lat0': [48.6],
+                                    'params': {'fail': i == 3}}) for i in xrange(n))
+
+def work(directory):
+    tracpy.campaign.Campaign(directory, run=fake_run).work()
+
+def test_campaign():
+    '''
+    Test that workers run every task once, record failures, and that a campaign can be resumed.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        c = tracpy.campaign.Campaign(directory, run=fake_run)
+        c.add(tasks(10))
+        c.add(tasks(10)) # adding the same tasks again does nothing
+        assert len(c.tasks()) == 10
+
+        # four workers at once
+        workers = [multiprocessing.Process(target=work, args=(directory,)) for i in xrange(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        status = c.status()
+        assert status['task03'] == 'failed'
+        assert 'failing on purpose' in json.load(open(c._file('task03', 'failed')))['error']
+        for name in status:
+            if name != 'task03':
+                assert status[name] == 'done'
+                assert open(os.path.join(directory, 'tracks', name + '.txt')).read() == 'ran\n'
+
+        # resuming with more tasks only runs the new ones
+        c.add(tasks(12))
+        assert sorted(c.work()) == ['task10', 'task11']
+        assert c.work() == []
+        assert c.summary()['done'] == 11
+
+        # a task can't be added again with a different definition
+        t = tasks(1)
+        t['task00']['lon0'] = [-122.]
+        try:
+            c.add(t)
+            assert False
+        except ValueError:
+            pass
+
+        # a claim left behind by a worker that died is released
+        open(c._file('task03', 'lock'), 'w').write(json.dumps({'host': 'elsewhere', 'pid': 1, 'start': 0.}))
+        assert c.status()['task03'] == 'running'
+        assert c.release_stale(3600.) == ['task03']
+        assert c.status()['task03'] == 'failed'
+
+        # and so is a lock on the manifest, of a dead process here or an old one elsewhere
+        lock = os.path.join(directory, 'manifest.lock')
+        dead = multiprocessing.Process(target=len, args=([],))
+        dead.start()
+        dead.join()
+        for claim in [{'host': socket.gethostname(), 'pid': dead.pid, 'start': time.time()},
+                        {'host': 'elsewhere', 'pid': 1, 'start': 0.}]:
+            open(lock, 'w').write(json.dumps(claim))
+            c.add(tasks(13))
+            assert 'task12' in c.tasks()
+            assert not os.path.exists(lock)
+    finally:
+        shutil.rmtree(directory)
+
+def test_campaign_run():
+    '''
+    Test running a simulation of the rectangle example as a task.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        c = tracpy.campaign.Campaign(directory)
+        c.add({'rect': {'date': '2013-12-19 00:00:00', 'lon0': [-123., -123.], 'lat0': [48.55, 48.6],
+                        'params': {'currents_filename': os.path.join(here, 'input', 'ocean_his_0001.nc'),
+                                    'grid_filename': os.path.join(here, 'input', 'grid.nc'),
+                                    'tseas': 4*3600., 'ndays': 1., 'nsteps': 5, 'N': 4, 
+                                    'z0': 's', 'zpar': 2, 'savell': False}}})
+        assert c.work() == ['rect']
+        assert c.status()['rect'] == 'done'
+        assert os.path.exists(os.path.join(directory, 'tracks', 'rectgc.nc'))
+    finally:
+        shutil.rmtree(directory)
+
+def test_run_task():
+    '''
+    Test running a task as it is read back from the manifest, where json has made
+    its strings unicode.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        c = tracpy.campaign.Campaign(directory)
+        c.add({'rect': {'date': '2013-12-19 00:00:00', 'lon0': [-123., -123.], 'lat0': [48.55, 48.6],
+                        'params': {'currents_filename': os.path.join(here, 'input', 'ocean_his_0001.nc'),
+                                    'grid_filename': os.path.join(here, 'input', 'grid.nc'),
+                                    'tseas': 4*3600., 'ndays': 1., 'nsteps': 5, 'N': 4, 
+                                    'z0': 's', 'zpar': 2, 'savell': False}}})
+        task = c.tasks()['rect']
+        assert isinstance(task['params']['currents_filename'], unicode)
+
+        filename = tracpy.campaign.run_task(c, 'rect', task)
+
+        assert filename == os.path.join(directory, 'tracks', 'rectgc.nc')
+        d = netCDF.Dataset(filename)
+        assert d.variables['xg'].shape[0] == 2
+        assert d.variables['xg'][:,-1].all() # moved, and still in the domain
+        d.close()
+    finally:
+        shutil.rmtree(directory)
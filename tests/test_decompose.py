@@ -0,0 +1,68 @@
+'''
+Testing domain decomposition against stepping on the whole grid
+Call with py.test test_decompose.py
+'''
+
+import tracpy
+import tracpy.decompose
+from tracpy.tracpy_class import Tracpy
+import numpy as np
+
+# synthetic grid and fields, with a flow to the northeast that crosses tiles
+imt, jmt, km = 40, 30, 3
+rs = np.random.RandomState(0)
+uf = np.asfortranarray(1500. + 500.*rs.rand(imt-1, jmt, km, 2))
+vf = np.asfortranarray(1000. + 500.*rs.rand(imt, jmt-1, km, 2))
+dzt = np.asfortranarray(8. + 4.*rs.rand(imt, jmt, km, 2))
+grid = {'kmt': np.ones((imt, jmt))*km, 'dxdy': np.ones((imt, jmt))*1e6,
+        'dxv': np.ones((imt, jmt-1))*1e3, 'dyu': np.ones((imt-1, jmt))*1e3,
+        'h': np.ones((imt, jmt))*km*10.}
+
+def reader(tind, window):
+    '''
+    Synthetic model output tind (0 or 1) for window.
+    '''
+
+    i0, i1, j0, j1 = window
+    return uf[i0:i1-1,j0:j1,:,tind], vf[i0:i1,j0:j1-1,:,tind], dzt[i0:i1,j0:j1,:,tind]
+
+def test_decompose():
+    '''
+    Test that drifters stepped on tiles, moving between them, end up where they do
+    when they are stepped on the whole grid.
+    '''
+
+    tp = Tracpy('synthetic', grid=grid, tseas=4*3600., N=2, nsteps=1, do3d=1)
+
+    # drifters spread over the southwest part of the grid
+    x0 = 3. + rs.rand(100)*15
+    y0 = 3. + rs.rand(100)*10
+    z0 = 0.5 + rs.randint(0, km, 100)
+
+    # on the whole grid
+    tp._gridargs = tracpy.kernel.grid_args(grid)
+    tp.uf, tp.vf, tp.dzt = uf, vf, dzt
+    tp.wft = np.zeros((1, 1, km+1, 2), order='F')
+    tp.dxyzt = np.zeros((1, 1, km, 2), order='F')
+    x, y, z = x0, y0, z0
+    for ta, tb in [(0., 0.5), (0.5, 1.)]:
+        xend, yend, zend, flag, ttend, U, V = tp.step(x, y, z, ta, tb, None, None, None)
+        x, y, z = xend[:,-1], yend[:,-1], zend[:,-1]
+
+    # on 2 x 2 tiles in separate processes
+    dd = tracpy.decompose.Decomposition(tp, reader, ni=2, nj=2, halo=8)
+    dd.read(0)
+    dd.read(1)
+    xd, yd, zd = x0, y0, z0
+    tiles = [tracpy.decompose.owners(xd, yd, dd.iedges, dd.jedges)]
+    for ta, tb in [(0., 0.5), (0.5, 1.)]:
+        xendd, yendd, zendd, flagd, ttendd = dd.step(xd, yd, zd, ta, tb)
+        xd, yd, zd = xendd[:,-1], yendd[:,-1], zendd[:,-1]
+        tiles.append(tracpy.decompose.owners(xd, yd, dd.iedges, dd.jedges))
+    dd.close()
+
+    assert (tiles[0] != tiles[-1]).any() # some drifters moved between tiles
+    assert (flagd == flag).all()
+    assert np.allclose(xd, x, rtol=0, atol=1e-8)
+    assert np.allclose(yd, y, rtol=0, atol=1e-8)
+    assert np.allclose(zd, z, rtol=0, atol=1e-8)
@@ -0,0 +1,87 @@
+'''
+Testing the cache of model fields
+Call with py.test test_fieldcache.py
+'''
+
+import tracpy
+import tracpy.fieldcache
+from tracpy.tracpy_class import Tracpy
+import os
+import datetime
+import threading
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+def test_lru():
+    '''
+    The least recently used fields are removed first to stay under the size limit,
+    and the cache can be used from many threads.
+    '''
+
+    cache = tracpy.fieldcache.FieldCache(maxbytes=3*5*8*10)
+    fields = lambda i: tuple([np.ones(10)*i for j in xrange(5)])
+
+    for i in xrange(3):
+        cache.put(i, fields(i))
+    assert cache.get(0)[0][0] == 0 # 0 is now more recently used than 1
+    cache.put(3, fields(3))
+
+    assert 1 not in cache
+    assert 0 in cache and 2 in cache and 3 in cache
+    assert cache.get(1) is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1, 'entries': 3, 'nbytes': 3*5*8*10}
+
+    # fields bigger than the cache aren't kept
+    cache.put(4, tuple([np.ones(100) for j in xrange(5)]))
+    assert 4 not in cache
+
+    def work(n):
+        for i in xrange(200):
+            key = (n + i) % 7
+            if cache.get(key) is None:
+                cache.put(key, fields(key))
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 2 + 8*200
+    assert stats['entries'] == 3
+    assert stats['nbytes'] == 3*5*8*10
+
+def test_shared_between_objects():
+    '''
+    A Tracpy object uses the fields that another one already read in.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+
+    tracpy.fieldcache.cache.clear()
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'))
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+    assert tracpy.fieldcache.cache.stats()['misses'] == 1
+
+    tp2 = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid=tp.grid)
+    tinds2, nc2, t0save2, xend2, yend2, zend2, zp2, ttend2, flag2 = tp2.prepare_for_model_run(date, lon0, lat0)
+    assert tracpy.fieldcache.cache.stats()['hits'] == 1
+    assert np.array_equal(tp2.uf[:,:,:,1], tp.uf[:,:,:,1])
+
+    # a different isoslice level is read in again
+    tp3 = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid=tp.grid, zpar=0)
+    tinds3, nc3, t0save3, xend3, yend3, zend3, zp3, ttend3, flag3 = tp3.prepare_for_model_run(date, lon0, lat0)
+    assert tracpy.fieldcache.cache.stats()['misses'] == 2
+
+    # and so are the fields for another vertical grid
+    grid = dict(tp.grid)
+    grid['theta_s'] = grid['theta_s'] + 1.
+    tp4 = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid=grid)
+    assert tracpy.fieldcache.key(tp4, tinds[0]) != tracpy.fieldcache.key(tp, tinds[0])
+    tinds4, nc4, t0save4, xend4, yend4, zend4, zp4, ttend4, flag4 = tp4.prepare_for_model_run(date, lon0, lat0)
+    assert tracpy.fieldcache.cache.stats()['misses'] == 3
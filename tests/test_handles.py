@@ -0,0 +1,79 @@
+'''
+Testing the pool of open datasets
+Call with py.test test_handles.py
+'''
+
+import tracpy
+import tracpy.handles
+import tracpy.run
+from tracpy.tracpy_class import Tracpy
+import os
+import time
+import datetime
+import netCDF4 as netCDF
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+def test_pool():
+    '''
+    Datasets are shared while they are in use, kept open after they are given back,
+    and opened again when they have been idle too long or don't work anymore.
+    '''
+
+    loc = os.path.join(here, 'input', 'ocean_his_0001.nc')
+    pool = tracpy.handles.HandlePool(idle=3600.)
+
+    nc = pool.acquire(loc)
+    nc2 = pool.acquire(loc)
+    assert nc.dataset is nc2.dataset
+    assert np.array_equal(nc.variables['ocean_time'][:], nc2.variables['ocean_time'][:])
+    assert pool.stats() == {'opens': 1, 'reuses': 1, 'open': 1, 'inuse': 1}
+
+    nc.close()
+    nc.close() # only given back once
+    nc2.close()
+    assert pool.stats()['inuse'] == 0 and nc.dataset.isopen()
+
+    nc3 = pool.acquire(loc)
+    assert nc3.dataset is nc.dataset
+    nc3.close()
+
+    # broken
+    nc3.dataset.close()
+    nc4 = pool.acquire(loc)
+    assert nc4.dataset is not nc.dataset and nc4.dataset.isopen()
+    nc4.close()
+    assert pool.stats()['opens'] == 2
+
+    # idle
+    pool.idle = 0.
+    time.sleep(0.01)
+    nc5 = pool.acquire(loc)
+    assert not nc4.dataset.isopen() and nc5.dataset is not nc4.dataset
+    nc5.close()
+    pool.clear()
+    assert pool.stats()['open'] == 0 and not nc5.dataset.isopen()
+
+def test_runs():
+    '''
+    Runs one after the other use the model output and grid files that the first one opened.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    currents_filename = os.path.join(here, 'input', 'ocean_his_0001.nc')
+    grid_filename = os.path.join(here, 'input', 'grid.nc')
+
+    tp = Tracpy(currents_filename, grid_filename=grid_filename, ndays=0.5)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+    stats = tracpy.handles.pool.stats()
+
+    tp2 = Tracpy(currents_filename, grid_filename=grid_filename, ndays=0.5)
+    lonp2, latp2, zp2, t2, T02, U2, V2 = tracpy.run.run(tp2, date, lon0, lat0)
+
+    stats2 = tracpy.handles.pool.stats()
+    assert stats2['opens'] == stats['opens'] and stats2['inuse'] == stats['inuse']
+    assert np.allclose(lonp, lonp2, equal_nan=True)
@@ -0,0 +1,137 @@
+'''
+Testing reading model output ahead of when it is used
+Call with py.test test_prefetch.py
+'''
+
+import tracpy
+import tracpy.prefetch
+import tracpy.fieldcache
+import tracpy.run
+from tracpy.tracpy_class import Tracpy
+import os
+import time
+import datetime
+import threading
+import netCDF4 as netCDF
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+class Flaky(object):
+    '''
+    Stand-in for a slow server with the model output in tests/input, where the first
+    few reads of u fail. Counts the reads of u, and the most reads at once.
+    '''
+
+    def __init__(self, failures=0, delay=0.05):
+        self.failures = failures
+        self.delay = delay
+        self.reads = 0
+        self.inflight = 0
+        self.maxinflight = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, loc):
+        d = netCDF.Dataset(loc)
+        served = FlakyDataset(d)
+        for name, var in d.variables.items():
+            served.variables[name] = FlakyVariable(self, var) if name == 'u' else var
+        return served
+
+class FlakyDataset(object):
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.variables = {}
+
+    def close(self):
+        self.dataset.close()
+
+class FlakyVariable(object):
+    def __init__(self, server, var):
+        self.server = server
+        self.var = var
+
+    def __getitem__(self, index):
+        server = self.server
+        with server.lock:
+            server.reads += 1
+            server.inflight += 1
+            server.maxinflight = max(server.maxinflight, server.inflight)
+            fail = server.reads <= server.failures
+        time.sleep(server.delay)
+        with server.lock:
+            server.inflight -= 1
+        if fail:
+            raise RuntimeError('NetCDF: DAP failure')
+        return self.var[index]
+
+def test_prefetcher():
+    '''
+    Fields read ahead are the same as the ones read in when they are needed, adjacent
+    time indices are read together, reads happen at once up to the number of
+    workers, and failed reads are tried again.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5)
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+    tinds = tinds[1:]
+
+    tracpy.fieldcache.cache.clear()
+    server = Flaky(failures=1)
+    prefetcher = tracpy.prefetch.Prefetcher(tp, tinds, 8, workers=2, coalesce=4, backoff=0.01, opener=server)
+    try:
+        assert prefetcher.get(tinds[0]) is None # not read ahead, the others are
+        for tind in tinds[1:]:
+            fields = tracpy.inout.readfields(tind, tp.grid, nc, tp.z0, tp.zpar, zparuv=tp.zparuv)
+            for field, ahead in zip(fields, prefetcher.get(tind)):
+                assert np.allclose(field, ahead)
+    finally:
+        prefetcher.close()
+
+    # the 11 after the first are read as 4, 4 and 3, and the one that failed again
+    assert prefetcher.reads == 4 and prefetcher.failures == 1
+    assert server.reads == 4 and server.maxinflight == 2
+
+def test_run():
+    '''
+    A run that reads ahead has the same tracks as one that doesn't.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+
+    tracpy.fieldcache.cache.clear()
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    tracpy.fieldcache.cache.clear()
+    tp2 = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid=tp.grid, ndays=0.5, prefetch=3)
+    lonp2, latp2, zp2, t2, T02, U2, V2 = tracpy.run.run(tp2, date, lon0, lat0)
+
+    assert np.allclose(lonp, lonp2, equal_nan=True)
+    assert np.allclose(latp, latp2, equal_nan=True)
+    assert tp2.state.prefetcher is None
+
+def test_estimate():
+    '''
+    Estimating a run that reads ahead doesn't leave threads or files open behind.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5, prefetch=3)
+
+    nthreads = threading.active_count()
+    for i in xrange(3):
+        tp.estimate(date, lon0, lat0, verbose=False)
+    assert threading.active_count() == nthreads
+    assert tp.state.prefetcher is None
@@ -0,0 +1,134 @@
+'''
+Testing providers of model fields
+Call with py.test test_providers.py
+'''
+
+import tracpy
+import tracpy.providers
+import tracpy.run
+import tracpy.cache
+from tracpy.tracpy_class import Tracpy
+import os
+import shutil
+import tempfile
+import datetime
+import netCDF4 as netCDF
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+currents_filename = os.path.join(here, 'input', 'ocean_his_0001.nc')
+grid_filename = os.path.join(here, 'input', 'grid.nc')
+date = datetime.datetime(2013, 12, 17, 0)
+lon0 = [-123., -123.]
+lat0 = [48.55, 48.75]
+
+def test_arrays():
+    '''
+    Drifters run on model output in arrays, or from a function, have the same tracks
+    as when it is read in from the file.
+    '''
+
+    tp = Tracpy(currents_filename, grid_filename=grid_filename, ndays=0.5)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    d = netCDF.Dataset(currents_filename)
+    ocean_time = d.variables['ocean_time'][:]
+    u = d.variables['u'][:]
+    v = d.variables['v'][:]
+    d.close()
+
+    provider = tracpy.providers.ArrayProvider(ocean_time, u, v)
+    assert provider.variables['u'] is u # not copied
+    tp2 = Tracpy(provider, grid=tp.grid, ndays=0.5)
+    lonp2, latp2, zp2, t2, T02, U2, V2 = tracpy.run.run(tp2, date, lon0, lat0)
+    assert np.allclose(lonp, lonp2, equal_nan=True)
+    assert np.allclose(latp, latp2, equal_nan=True)
+
+    # from a coupled model, as velocities or as ready fluxes
+    called = []
+    def velocities(tind):
+        called.append(tind)
+        return {'u': u[tind], 'v': v[tind]}
+    tp3 = Tracpy(tracpy.providers.CallbackProvider(ocean_time, velocities), grid=tp.grid, ndays=0.5)
+    lonp3, latp3, zp3, t3, T03, U3, V3 = tracpy.run.run(tp3, date, lon0, lat0)
+    assert np.allclose(lonp, lonp3, equal_nan=True)
+    assert called == sorted(called) and len(called) == len(set(called))
+
+    # which can't be run again for batches of drifters
+    tp5 = Tracpy(tracpy.providers.CallbackProvider(ocean_time, velocities), grid=tp.grid, ndays=0.5,
+                    plan={'nbatches': 2})
+    del called[:]
+    try:
+        tracpy.run.run(tp5, date, lon0, lat0)
+    except ValueError:
+        pass
+    else:
+        assert False
+    try:
+        tp5.estimate(date, lon0, lat0)
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert called == []
+    tp2.plan = {'nbatches': 2} # arrays can
+    lonp2, latp2, zp2, t2, T02, U2, V2 = tracpy.run.run(tp2, date, lon0, lat0)
+    assert np.allclose(lonp, lonp2, equal_nan=True)
+
+    fluxes = lambda tind: provider.get_fields(tp2, tind)
+    tp4 = Tracpy(tracpy.providers.CallbackProvider(ocean_time, fluxes), grid=tp.grid, ndays=0.5)
+    lonp4, latp4, zp4, t4, T04, U4, V4 = tracpy.run.run(tp4, date, lon0, lat0)
+    assert np.allclose(lonp, lonp4, equal_nan=True)
+
+def test_cache():
+    '''
+    Runs on fields from different callbacks aren't taken from the cache for each other,
+    since the fields can't be identified.
+    '''
+
+    tp = Tracpy(currents_filename, grid_filename=grid_filename, ndays=0.5)
+    tp._readgrid()
+    d = netCDF.Dataset(currents_filename)
+    ocean_time = d.variables['ocean_time'][:]
+    u = d.variables['u'][:]
+    v = d.variables['v'][:]
+    d.close()
+
+    forward = lambda tind: {'u': u[tind], 'v': v[tind]}
+    backward = lambda tind: {'u': -u[tind], 'v': -v[tind]}
+    cachedir = tempfile.mkdtemp()
+    try:
+        lonp = []
+        for callback in [forward, backward]:
+            tp2 = Tracpy(tracpy.providers.CallbackProvider(ocean_time, callback), grid=tp.grid, ndays=0.5)
+            try:
+                tracpy.cache.input_hash(tp2, date, lon0, lat0)
+            except ValueError:
+                pass
+            else:
+                assert False
+            lonp.append(tracpy.run.run(tp2, date, lon0, lat0, cache=cachedir)[0])
+        assert not np.allclose(lonp[0], lonp[1], equal_nan=True)
+        assert os.listdir(cachedir) == []
+    finally:
+        shutil.rmtree(cachedir)
+
+def test_netcdf():
+    '''
+    A NetCDF provider is the same as its location, and other providers need a grid.
+    '''
+
+    tp = Tracpy(tracpy.providers.NetCDFProvider(currents_filename), grid_filename=grid_filename)
+    assert tp.currents_filename == currents_filename
+    assert tp.vert_filename == currents_filename
+
+    provider = tracpy.providers.ArrayProvider(np.arange(2), np.zeros((2, 1, 2, 1)), np.zeros((2, 1, 1, 2)))
+    tp = Tracpy(provider)
+    try:
+        tp._readgrid()
+    except ValueError:
+        pass
+    else:
+        assert False
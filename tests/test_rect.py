@@ -6,13 +6,17 @@ Some basic tests of tracpy, using the simple rectangle input
 
 import tracpy
 import tracpy.calcs
+import tracpy.kernel
 from tracpy.tracpy_class import Tracpy
 import os
 import time
+import shutil
+import tempfile
 import datetime
 import numpy as np
 import netCDF4
 import pyproj
+import pytest
 
 def test_2dtransport():
 
@@ -184,3 +188,261 @@ def test_run_2d_xy():
     print xp[:,-1] - xp[:,0]
 
     assert np.allclose( xp[:,-1] - xp[:,0], distance )
+
+def rect_inputs(**kwargs):
+    """
+    Common inputs for runs on the rectangle example: the model output and grid files,
+    the start date, two particles, and keyword arguments for Tracpy, changed by kwargs.
+    """
+
+    # some simple example data
+    currents_filename = os.path.join('input', 'ocean_his_0001.nc')
+    grid_filename = os.path.join('input', 'grid.nc')
+    num_layers = 3
+
+    date = datetime.datetime(2013, 12, 19, 0)
+    tseas = 4*3600. # 4 hours between outputs, in seconds 
+    ndays = tseas*9./(3600.*24)
+
+    # two particles (starting positions)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+
+    params = dict(tseas=tseas, ndays=ndays, nsteps=5, N=4, ff=1, ah=0., av=0., doturb=0, do3d=0, 
+                    z0='s', zpar=num_layers-1, time_units='seconds since 1970-01-01')
+    params.update(kwargs)
+
+    return currents_filename, grid_filename, date, lon0, lat0, params
+
+@pytest.mark.skipif(tracpy.kernel.tracmass32 is None,
+                    reason='the single precision kernel is built with make f2py32 in src')
+def test_run_2d_ll_float32():
+    """
+    Accuracy report for the single precision (usefloat32) mode on the rectangle example.
+    Compare final location of drifters between the float32 and float64 paths.
+    Requires the single precision kernel, built with make f2py32 in src, and is
+    skipped without it.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    lonp = {}; latp = {}
+    for usefloat32 in [False, True]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_float32_' + str(usefloat32), 
+                    usefloat32=usefloat32, **params)
+        lonp[usefloat32], latp[usefloat32], zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    # distance between the final positions of the two paths, in meters
+    geod = pyproj.Geod(ellps = 'WGS84')
+    _, _, dist = geod.inv(lonp[False][:,-1], latp[False][:,-1], lonp[True][:,-1], latp[True][:,-1])
+
+    print "float32 vs. float64 final position differences (m): max %e, mean %e" % (np.max(dist), np.mean(dist))
+
+    assert np.max(dist) < 1.
+
+def test_run_2d_ll_counters():
+    """
+    Check that kernel counters are kept and saved, and don't change the tracks.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    lonp = {}; latp = {}
+    for docounters in [0, 1]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_counters_' + str(docounters), 
+                    docounters=docounters, **params)
+        lonp[docounters], latp[docounters], zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    assert np.allclose(lonp[0], lonp[1])
+
+    # the drifters cross cells in the rectangle, without errors
+    assert (tp.counts[:,0] > 0).all()
+    assert (tp.counts[:,1] >= tp.counts[:,0]).all()
+    assert (tp.counts[:,3] == 0).all()
+
+    d = netCDF4.Dataset(os.path.join('tracks', 'test_run_2d_ll_counters_1.nc'))
+    assert (d.variables['niter'][:] == tp.counts[:,1]).all()
+    d.close()
+
+def test_run_2d_ll_maxiter():
+    """
+    Drifters that go over maxiter are held in place for the rest of the TRACMASS call,
+    and are not stepped again if they are quarantined.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs(maxiter=1)
+
+    for quarantine in [False, True]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_maxiter_' + str(quarantine), 
+                    quarantine=quarantine, **params)
+        lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+        # the drifters are held where their first iteration left them for the rest
+        # of the first call to TRACMASS
+        assert (lonp[:,1:tp.N+1].T == lonp[:,1]).all()
+
+        if quarantine:
+            assert np.isnan(lonp[:,tp.N+1:]).all()
+        else:
+            assert not np.isnan(lonp).any()
+
+def test_run_2d_ll_numpy():
+    """
+    The numpy backend should give the same tracks as the fortran backend.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    lonp = {}; latp = {}
+    for backend in ['fortran', 'numpy']:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_numpy_' + backend, 
+                    backend=backend, **params)
+        lonp[backend], latp[backend], zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    assert np.allclose(lonp['fortran'], lonp['numpy'])
+    assert np.allclose(latp['fortran'], latp['numpy'])
+
+def test_run_2d_ll_cache():
+    """
+    A simulation that is run again with the same inputs comes from the cache,
+    and one with different inputs doesn't.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    cachedir = tempfile.mkdtemp()
+    try:
+        lonp = []
+        for ah in [0., 0., 1.]:
+            params['ah'] = ah
+            tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_cache', **params)
+            lonp.append(tracpy.run.run(tp, date, lon0, lat0, cache=cachedir)[0])
+
+        assert (lonp[0] == lonp[1]).all()
+        assert len(os.listdir(cachedir)) == 2
+    finally:
+        shutil.rmtree(cachedir)
+
+def test_run_2d_ll_plan():
+    """
+    Running the drifters in batches, with the tracks on disk and the model output
+    preloaded, gives the same tracks as running them all together. A small memory
+    budget gives a plan like that.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs(docounters=1)
+
+    # five particles (starting positions)
+    lon0 = [-123., -123., -123., -123., -123.]
+    lat0 = [48.55, 48.6, 48.65, 48.7, 48.75]
+
+    lonp = {}; latp = {}
+    for plan in [None, {'fields': 'preload', 'tracks': 'disk', 'nbatches': 3}]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_plan', plan=plan, **params)
+        lonp[plan is None], latp[plan is None], zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    assert np.allclose(lonp[True], lonp[False])
+    assert np.allclose(latp[True], latp[False])
+    assert tp.counts.shape[0] == 5
+
+    est = tp.estimate(date, lon0, lat0, calibrate=False, verbose=False)
+    plan = tracpy.planner.choose(est, est['fields_bytes'] + 1.5*tracpy.planner.step_bytes*5)
+    assert plan.tracks == 'disk'
+    assert plan.nbatches > 1
+
+def test_run_2d_ll_layers():
+    """
+    Drifters in several s levels at once move the same way as in a run for each level,
+    also when they are run in batches, and are saved in order of layer.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    # three particles (starting positions)
+    lon0 = [-123., -123., -123.]
+    lat0 = [48.55, 48.65, 48.75]
+
+    lonp = {}
+    for zpar in [0, 2]:
+        params['zpar'] = zpar
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_layers_' + str(zpar), **params)
+        lonp[zpar], latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    params['zpar'] = [2, 0]
+    for plan in [None, {'nbatches': 2}]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_layers', plan=plan, **params)
+        lonpl, latpl, zpl, tl, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+        assert lonpl.shape[0] == 6
+        assert np.allclose(lonpl[:3], lonp[2])
+        assert np.allclose(lonpl[3:], lonp[0])
+
+    d = netCDF4.Dataset(os.path.join('tracks', 'test_run_2d_ll_layers.nc'))
+    assert (d.variables['zpar'][:] == [2, 2, 2, 0, 0, 0]).all()
+    d.close()
+
+def test_run_2d_ll_substeps():
+    """
+    Calling TRACMASS for quarters of the time between model outputs, with the velocities
+    interpolated in time to each quarter in the kernel, gives the same tracks as calling
+    it once for the time between model outputs.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+    tseas = params['tseas']
+
+    # velocities that change in time
+    directory = tempfile.mkdtemp()
+    shutil.copy(currents_filename, directory)
+    currents_filename = os.path.join(directory, os.path.basename(currents_filename))
+    d = netCDF4.Dataset(currents_filename, 'a')
+    for t in xrange(d.variables['u'].shape[0]):
+        d.variables['u'][t] = d.variables['u'][t]*(1 + 0.5*(t % 3))
+        d.variables['v'][t] = 0.02*(-1)**t
+    d.close()
+
+    # the same time interpolation steps, in one call or in four
+    params.update(nsteps=4, N=1)
+    tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_substeps_1', **params)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    params.update(nsteps=1, dtFromTracmass=tseas/4)
+    tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_substeps_4', **params)
+    lonp4, latp4, zp4, t4, T04, U4, V4 = tracpy.run.run(tp, date, lon0, lat0)
+    shutil.rmtree(directory)
+
+    assert tp.nsubsteps == 4
+    assert not np.isnan(lonp4).any()
+    assert not np.allclose(latp[:,-1], lat0) # the drifters moved in both directions
+    assert np.allclose(lonp, lonp4)
+    assert np.allclose(latp, latp4)
+    assert np.allclose(t, t4)
+
+def test_run_2d_ll_sortdrifters():
+    """
+    Drifters stepped in space-filling curve order are given back in the order they
+    were seeded in, with the same tracks as drifters stepped in that order.
+    """
+
+    currents_filename, grid_filename, date, lon0, lat0, params = rect_inputs()
+
+    # particles across the domain, seeded in a scrambled order
+    lon0, lat0 = np.meshgrid(np.linspace(-123.25, -123., 4), np.linspace(48.35, 48.75, 4))
+    scramble = np.random.RandomState(0).permutation(lon0.size)
+    lon0 = lon0.ravel()[scramble]
+    lat0 = lat0.ravel()[scramble]
+
+    lonp = {}; latp = {}
+    for sortdrifters in [False, True]:
+        tp = Tracpy(currents_filename, grid_filename, name='test_run_2d_ll_sortdrifters_' + str(sortdrifters), 
+                    sortdrifters=sortdrifters, **params)
+        lonp[sortdrifters], latp[sortdrifters], zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+    # the drifters were stepped in a different order than they were seeded in
+    xstart, ystart, _ = tracpy.tools.interpolate2d(lon0, lat0, tp.grid, 'd_ll2ij')
+    assert (tracpy.tools.morton_order(xstart, ystart) != np.arange(lon0.size)).any()
+
+    assert np.allclose(lonp[True][:,0], lon0)
+    assert np.allclose(latp[True][:,0], lat0)
+    assert (lonp[True] == lonp[False]).all()
+    assert (latp[True] == latp[False]).all()
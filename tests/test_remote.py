@@ -0,0 +1,121 @@
+'''
+Testing the disk cache for remote model output
+Call with py.test test_remote.py
+'''
+
+import tracpy
+import tracpy.remote
+import os
+import time
+import shutil
+import tempfile
+import netCDF4 as netCDF
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+server = 'http://localhost/thredds/dodsC/'
+
+class StandIn(object):
+    '''
+    Stand-in for a thredds server, serving the files in tests/input and counting
+    the reads of each variable.
+    '''
+
+    def __init__(self):
+        self.reads = {}
+
+    def __call__(self, url):
+        d = netCDF.Dataset(os.path.join(here, 'input', url[len(server):]))
+        served = StandInDataset(d)
+        for name, var in d.variables.items():
+            served.variables[name] = StandInVariable(self, name, var)
+        return served
+
+class StandInDataset(object):
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.variables = {}
+
+    def close(self):
+        self.dataset.close()
+
+class StandInVariable(object):
+    def __init__(self, server, name, var):
+        self.server = server
+        self.name = name
+        self.var = var
+        self.shape = var.shape
+
+    def __getitem__(self, index):
+        self.server.reads[self.name] = self.server.reads.get(self.name, 0) + 1
+        return self.var[index]
+
+def test_read_through():
+    '''
+    Reads from a remote dataset are fetched once, the same from the cache as from
+    the server, and shared with later datasets that use the same cache directory.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        standin = StandIn()
+        cache = tracpy.remote.RemoteCache(directory)
+        nc = tracpy.remote.CachedDataset(server + 'ocean_his_0001.nc', cache, opener=standin)
+        local = netCDF.Dataset(os.path.join(here, 'input', 'ocean_his_0001.nc'))
+
+        u = nc.variables['u'][2,:,::2,np.arange(3)]
+        assert np.array_equal(u, local.variables['u'][2,:,::2,np.arange(3)])
+        assert nc.variables['u'].shape == local.variables['u'].shape
+        assert np.array_equal(nc.variables['u'][np.int64(2),:,::2,[0,1,2]], u)
+        assert standin.reads['u'] == 1
+        assert cache.hits == 1 and cache.misses == 1
+
+        # a different slice is fetched
+        nc.variables['u'][1]
+        assert standin.reads['u'] == 2
+
+        # another process would find the reads on disk
+        nc2 = tracpy.remote.CachedDataset(server + 'ocean_his_0001.nc',
+                                            tracpy.remote.RemoteCache(directory), opener=standin)
+        assert np.array_equal(nc2.variables['u'][1], local.variables['u'][1])
+        assert standin.reads['u'] == 2
+        local.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_evict():
+    '''
+    Reads are fetched again after maxage, and the least recently used reads are
+    removed to stay under maxsize.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        standin = StandIn()
+        cache = tracpy.remote.RemoteCache(directory, maxage=3600.)
+        nc = tracpy.remote.CachedDataset(server + 'ocean_his_0001.nc', cache, opener=standin)
+
+        for t in xrange(3):
+            nc.variables['v'][t]
+        # as if v at time 0 was fetched two hours ago
+        filename = cache._file(nc.url, 'v', 0)
+        os.utime(filename, (time.time(), time.time() - 7200))
+        nc.variables['v'][0]
+        assert standin.reads['v'] == 4
+
+        # just room for two, after using 1 so that 2 is the least recently used
+        size = os.stat(filename).st_size
+        nc.variables['v'][1]
+        os.utime(cache._file(nc.url, 'v', 2), (time.time() - 60, time.time()))
+        cache.maxsize = 2*size
+        assert cache.evict() == 1
+        nc.variables['v'][0]
+        nc.variables['v'][1]
+        assert standin.reads['v'] == 4
+        nc.variables['v'][2]
+        assert standin.reads['v'] == 5
+        assert len(os.listdir(directory)) == 2
+    finally:
+        shutil.rmtree(directory)
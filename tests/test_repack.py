@@ -0,0 +1,57 @@
+'''
+Testing repacking model output
+Call with py.test test_repack.py
+'''
+
+import tracpy
+import tracpy.repack
+import tracpy.run
+from tracpy.tracpy_class import Tracpy
+import os
+import shutil
+import datetime
+import tempfile
+import netCDF4 as netCDF
+import numpy as np
+
+# For niceties with file locations and such
+here = os.path.dirname(__file__)
+
+def test_repack():
+    '''
+    Repacked model output has the same values, one chunk per time step, and gives
+    the same tracks.
+    '''
+
+    currents_filename = os.path.join(here, 'input', 'ocean_his_0001.nc')
+    grid_filename = os.path.join(here, 'input', 'grid.nc')
+    directory = tempfile.mkdtemp()
+    try:
+        packed = tracpy.repack.repack(currents_filename, os.path.join(directory, 'packed.nc'))
+        packed32 = tracpy.repack.repack(currents_filename, os.path.join(directory, 'packed32.nc'), float32=True)
+
+        d = netCDF.Dataset(currents_filename)
+        p = netCDF.Dataset(packed)
+        p32 = netCDF.Dataset(packed32)
+        assert sorted(p.variables.keys()) == sorted(['ocean_time', 'u', 'v', 's_w', 'Cs_w', 's_rho',
+                                                        'Cs_r', 'hc', 'theta_s', 'theta_b',
+                                                        'Vtransform', 'Vstretching'])
+        for name in p.variables:
+            assert np.array_equal(p.variables[name][:], d.variables[name][:])
+        assert p.variables['u'].chunking() == [1] + list(d.variables['u'].shape[1:])
+        assert p32.variables['u'].dtype == np.float32 and p32.variables['ocean_time'].dtype == np.float64
+        assert np.allclose(p32.variables['u'][:], d.variables['u'][:], rtol=1e-6)
+        for nc in [d, p, p32]:
+            nc.close()
+
+        date = datetime.datetime(2013, 12, 17, 0)
+        lon0 = [-123., -123.]
+        lat0 = [48.55, 48.75]
+        tp = Tracpy(currents_filename, grid_filename=grid_filename, ndays=0.5)
+        lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+        tp2 = Tracpy(packed, grid_filename=grid_filename, ndays=0.5)
+        lonp2, latp2, zp2, t2, T02, U2, V2 = tracpy.run.run(tp2, date, lon0, lat0)
+        assert np.allclose(lonp, lonp2, equal_nan=True)
+        assert np.allclose(latp, latp2, equal_nan=True)
+    finally:
+        shutil.rmtree(directory)
@@ -4,10 +4,16 @@ Call with py.test test_tracpy_class.py
 '''
 
 import tracpy
+import tracpy.shared
 from tracpy.tracpy_class import Tracpy
 import os
 import datetime
 import numpy as np
+import pickle
+import shutil
+import tempfile
+import multiprocessing
+import netCDF4 as netCDF
 
 # For niceties with file locations and such
 here = os.path.dirname(__file__)
@@ -75,6 +81,411 @@ def test_prepareForSimulation():
 
     assert np.sum(np.isnan(tp.uf[:,:,:,0])) == tp.uf[:,:,:,0].size
 
+def test_kernelArgs():
+    '''
+    Test that the static grid arrays are ready to be passed to the kernel without copies.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                checkcopies='raise')
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+
+    assert tp._gridargs['kmt'].dtype == tracpy.kernel.inttype
+
+    for key in tp._gridargs.keys():
+        assert tp._gridargs[key].flags['F_CONTIGUOUS']
+
+    assert tp.uf.flags['F_CONTIGUOUS']
+
+def test_precompute():
+    '''
+    Test the vertical fluxes and grid cell volumes that are precomputed for the kernel.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                doprecompute=1, checkcopies='raise')
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+
+    assert np.allclose(tp.dxyzt[:,:,:,1], tp.dzt[:,:,:,1]*tp.grid['dxdy'][:,:,np.newaxis])
+
+    # vertical fluxes the way vertvel.f95 calculates them, for one column
+    uf = tp.uf[:,:,:,1]
+    vf = tp.vf[:,:,:,1]
+    wf = tracpy.kernel.calc_wflux(uf, vf, tp.ff)
+    i, j = 10, 10
+    w = np.zeros(uf.shape[2]+1)
+    for k in xrange(1, w.size):
+        w[k] = w[k-1] - tp.ff*(uf[i,j,k-1] - uf[i-1,j,k-1] + vf[i,j,k-1] - vf[i,j-1,k-1])
+    assert (wf[i,j,:] == w).all()
+
+def test_precompute_3d():
+    '''
+    Test that drifters stepped in 3D with the precomputed vertical fluxes and grid cell 
+    volumes have the same tracks as with them calculated in TRACMASS, in flow that moves
+    them between vertical levels.
+    '''
+
+    # flow that is stronger near the surface and converges, then diverges, so that 
+    # there is upward and then downward flow
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'ocean_his_0001.nc')
+    shutil.copy(os.path.join(here, 'input', 'ocean_his_0001.nc'), filename)
+    d = netCDF.Dataset(filename, 'a')
+    nt, nk, ny, nx = d.variables['u'].shape
+    for t in xrange(nt):
+        converge = 0.9 if t < nt/2 else -0.9
+        for k in xrange(nk):
+            d.variables['u'][t,k] = 0.03*(1 + 3*k)*(1 - converge*np.arange(nx)/(nx-1.))*np.ones((ny, nx))
+    d.close()
+
+    tp = Tracpy(filename, grid_filename=os.path.join(here, 'input', 'grid.nc'))
+    tp._readgrid()
+    g = tracpy.kernel.grid_args(tp.grid)
+    backend = tracpy.kernel.get_backend('fortran')
+    nc = netCDF.Dataset(filename)
+    fields = [tracpy.inout.readfields(tind, tp.grid, nc) for tind in xrange(nt)]
+    nc.close()
+    shutil.rmtree(directory)
+
+    # drifters just below the tops of the lower two levels, and in the top level, in 
+    # fortran grid indices
+    x0, y0, _ = tracpy.tools.interpolate2d(np.array([-123.]*3), np.array([48.55, 48.65, 48.75]), tp.grid, 'd_ll2ij')
+    x0, y0 = tracpy.tools.convert_indices('py2f', x0, y0)
+    z0 = np.array([0.985, 1.97, 2.5])
+
+    tracks = {}
+    for doprecompute in [0, 1]:
+        x, y, z = x0.copy(), y0.copy(), z0.copy()
+        tracks[doprecompute] = [z[:,np.newaxis]]
+        for tind in xrange(len(fields)-1):
+            uf, vf, dzt = [np.asfortranarray(np.concatenate([fields[tind][i][...,np.newaxis], 
+                                                              fields[tind+1][i][...,np.newaxis]], axis=3)) 
+                            for i in xrange(3)]
+            if doprecompute:
+                wft = np.concatenate([tracpy.kernel.calc_wflux(uf[...,i], vf[...,i], 1)[...,np.newaxis]
+                                        for i in xrange(2)], axis=3)
+                dxyzt = np.concatenate([tracpy.kernel.calc_dxyz(dzt[...,i], g['dxdy'])[...,np.newaxis]
+                                        for i in xrange(2)], axis=3)
+            else:
+                wft = np.zeros((1, 1, nk+1, 2))
+                dxyzt = np.zeros((1, 1, nk, 2))
+            wft, dxyzt = np.asfortranarray(wft), np.asfortranarray(dxyzt)
+            xend, yend, zend, ttend = [np.zeros((x.size, 4), order='F') for i in xrange(4)]
+            flag = np.zeros(x.size, dtype=tracpy.kernel.inttype)
+            counts = np.zeros((1, len(tracpy.kernel.counternames)), dtype=tracpy.kernel.inttype, order='F')
+            backend.step(x, y, z, tp.tseas, uf, vf, 0., 1., 1, g['kmt'], dzt, g['dxdy'], g['dxv'], g['dyu'], g['h'],
+                            xend, yend, zend, flag, ttend, 5, 0., 0., 1, 0, 0, 0, 
+                            doprecompute, wft, dxyzt, 0, counts, 30000)
+            assert (flag == 0).all()
+            x, y, z = xend[:,-1].copy(), yend[:,-1].copy(), zend[:,-1].copy()
+            tracks[doprecompute].append(zend)
+
+    # the lower two drifters went up a level and back down
+    k = np.floor(np.hstack(tracks[0])[:2])
+    assert (k.max(axis=1) == k[:,0] + 1).all()
+    assert (k[:,-1] == k[:,0]).all()
+    for z, zpre in zip(tracks[0], tracks[1]):
+        assert np.allclose(z, zpre)
+
+def test_shared():
+    '''
+    Test that the grid and model fields can be attached from shared memory by another TracPy object.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                useshared=True, checkcopies='raise')
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+
+    worker = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'))
+    worker.attach_shared(tp.shared.descriptor())
+
+    assert (worker.grid['xr'] == tp.grid['xr']).all()
+    assert (worker._gridargs['kmt'] == tp._gridargs['kmt']).all()
+    assert np.array_equal(worker.uf[:,:,:,1], tp.uf[:,:,:,1])
+
+    # changes in the owner are seen by the worker
+    tp.uf[:,:,:,0] = 1.
+    assert (worker.uf[:,:,:,0] == 1.).all()
+
+    # a worker in another process sees the fields of the owner's next run too
+    descriptor = tp.shared.descriptor()
+    attached, refilled, results = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+    process = multiprocessing.Process(target=_shared_worker, args=(descriptor, attached, refilled, results))
+    process.start()
+    attached.wait(60)
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+    tp.uf[:,:,:,0] = 7.
+    refilled.set()
+    assert results.get(timeout=60)
+    process.join()
+    assert tp.shared.descriptor() == descriptor
+    assert tracpy.shared.changed(descriptor) == []
+
+    # and can tell when it has to attach again
+    tp.shared.empty('uf', tp.uf.shape, dtype=np.float32)
+    assert tracpy.shared.changed(descriptor) == ['uf']
+    worker.attach_shared(tp.shared.descriptor())
+    assert worker.uf.dtype == np.float32
+
+    filenames = [val[0] for val in tp.shared.descriptor().values()]
+    tp.shared.close()
+    for filename in filenames:
+        assert not os.path.exists(filename)
+
+def _shared_worker(descriptor, attached, refilled, results):
+    worker = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'))
+    worker.attach_shared(descriptor)
+    attached.set()
+    refilled.wait(60)
+    results.put(bool((worker.uf[:,:,:,0] == 7.).all()))
+
+def _crash(directory):
+    shared = tracpy.shared.SharedArrays(directory)
+    shared.empty('uf', (2, 3))
+    os._exit(0) # without removing the arrays
+
+def test_shared_stale():
+    '''
+    Shared arrays left behind by a process that died are removed, and those of running
+    processes aren't.
+    '''
+
+    directory = tempfile.mkdtemp()
+    try:
+        process = multiprocessing.Process(target=_crash, args=(directory,))
+        process.start()
+        process.join()
+        left = os.listdir(directory)
+        assert len(left) == 1 and left[0].startswith('%s%d-' % (tracpy.shared.prefix, process.pid))
+
+        shared = tracpy.shared.SharedArrays(directory) # which cleans up
+        assert os.listdir(directory) == []
+        shared.empty('uf', (2, 3))
+        assert tracpy.shared.cleanup_stale(directory) == []
+        assert len(os.listdir(directory)) == 1
+        shared.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_pickle():
+    '''
+    Test that a TracPy object can be pickled, keeping its parameters and not its grid or state.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5, doprecompute=1)
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+
+    tp2 = pickle.loads(pickle.dumps(tp))
+
+    assert tp2.ndays == tp.ndays
+    assert tp2.doprecompute == tp.doprecompute
+    assert tp2.grid is None
+    assert tp2.uf is None
+
+    # the state can be pickled on its own, and reopens the model output
+    state = pickle.loads(pickle.dumps(tp.state))
+    assert np.array_equal(state.uf[:,:,:,1], tp.uf[:,:,:,1])
+    assert (state.nc.variables['ocean_time'][:] == nc.variables['ocean_time'][:]).all()
+    state.close()
+
+    # and the copy can run on its own
+    tinds2, nc2, t0save2, xend2, yend2, zend2, zp2, ttend2, flag2 = tp2.prepare_for_model_run(date, lon0, lat0)
+    assert np.array_equal(tp2.uf[:,:,:,1], tp.uf[:,:,:,1])
+
+def test_estimate():
+    '''
+    Test estimating the memory use and run time of a simulation, without changing the TracPy object.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5, N=4)
+
+    est = tp.estimate(date, lon0, lat0)
+
+    assert est['ntrac'] == 2
+    assert est['tracks_bytes'] == 7*2*est['nt']*8
+    assert est['walltime'] > 0
+    assert tp.uf is None
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+    assert est['nt'] == xend.shape[1]
+    assert est['fields_bytes'] == tp.uf.nbytes + tp.vf.nbytes + tp.dzt.nbytes + tp.zrt.nbytes + tp.zwt.nbytes
+
+    # layers of zpar, where the run has a drifter in each layer for each one given
+    lon0 = [-123., -123., -123.]
+    lat0 = [48.55, 48.65, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5, z0='s', zpar=[2, 0], memory_budget=1e9)
+
+    est = tp.estimate(date, lon0, lat0)
+
+    assert est['ntrac'] == 6
+    assert est['walltime'] > 0
+    assert tp.make_plan(date, lon0, lat0).nbatches == 1
+
+def test_preload():
+    '''
+    Test that model output that is read in all at once is the same as when it is read in
+    for each time index, and is kept for later runs.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5)
+
+    tracpy.fieldcache.cache.clear()
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = \
+        tp.prepare_for_model_run(date, lon0, lat0, plan=tracpy.planner.Plan(fields='preload'))
+
+    for tind in tinds:
+        fields = tracpy.inout.readfields(tind, tp.grid, nc, tp.z0, tp.zpar, zparuv=tp.zparuv)
+        for field, preloaded in zip(fields, tp._preloaded[tind]):
+            assert np.allclose(field, preloaded)
+        assert tracpy.fieldcache.key(tp, tind) in tracpy.fieldcache.cache
+
+    # another run that overlaps in time uses what was already read in
+    tp2 = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                ndays=0.5)
+    tinds2, nc2, t0save2, xend2, yend2, zend2, zp2, ttend2, flag2 = \
+        tp2.prepare_for_model_run(date, lon0, lat0, plan=tracpy.planner.Plan(fields='preload'))
+    assert tp2._preloaded[tinds[0]][0] is tp._preloaded[tinds[0]][0]
+
+def test_isoslice():
+    '''
+    Test slicing at a depth, with weights that are found once for each grid, and reading 
+    in only the levels around the slice.
+    '''
+
+    # one column that crosses 0.5 between the first two levels, and one that doesn't cross
+    prop = np.array([[0., 2.], [1., 3.], [2., 4.]])
+    var = np.array([[10., 10.], [20., 20.], [30., 30.]])
+    weights, mask = tracpy.inout.isoslice_weights(prop, 0.5)
+    result = tracpy.inout.isoslice(var, weights, mask)
+    assert result[0] == 15.
+    assert result.mask[1]
+
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                z0='z', zpar=-60.)
+    tp._readgrid()
+    nc = tracpy.inout.opendataset(tp.currents_filename)
+    fields = tracpy.inout.readfields(0, tp.grid, nc, tp.z0, tp.zpar)
+    # the same as interpolating the 3d fluxes to the depth of the slice
+    zru = tracpy.op.resize(tp.grid['zrt0'], 0) # no free surface in the example
+    k = (zru[0,0,:] < tp.zpar).sum() # slice is between levels k-1 and k
+    w = (tp.zpar - zru[:,:,k-1])/(zru[:,:,k] - zru[:,:,k-1])
+    uflux = tracpy.inout.readfields(0, tp.grid, nc)[0]
+    assert np.allclose(fields[0][:,:,0], (1-w)*uflux[:,:,k-1] + w*uflux[:,:,k])
+
+    banded = tracpy.inout.readfields(0, tp.grid, nc, tp.z0, tp.zpar, kband=(k-1, k+1))
+    for field, field_banded in zip(fields, banded):
+        assert np.allclose(field, field_banded)
+    nc.close()
+
+def test_layers():
+    '''
+    Test that layers of isoslices are read in together and stacked in place of the 
+    vertical levels, with every drifter started in each layer.
+    '''
+
+    date = datetime.datetime(2013, 12, 17, 0)
+    lon0 = [-123., -123.]
+    lat0 = [48.55, 48.75]
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'),
+                z0='z', zpar=[-20., -60.])
+
+    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
+
+    assert tp.uf.shape[2] == 2
+    assert (tp.layer == [0, 0, 1, 1]).all()
+    assert (zend[:,0] == [0.5, 0.5, 1.5, 1.5]).all()
+    assert (xend[:2,0] == xend[2:,0]).all()
+
+    for k, zpar in enumerate(tp.zpar):
+        fields = tracpy.inout.readfields(tinds[0], tp.grid, nc, tp.z0, zpar)
+        for field, layered in zip(fields[:4], [tp.uf, tp.vf, tp.dzt, tp.zrt]):
+            assert np.allclose(np.ma.filled(field[:,:,0], np.nan), layered[:,:,k,1], equal_nan=True)
+
+def test_rawread():
+    '''
+    Test that reading without netCDF4's masking and scaling gives the same values,
+    with missing values filled in.
+    '''
+
+    filename = os.path.join(tempfile.mkdtemp(), 'packed.nc')
+    d = netCDF.Dataset(filename, 'w')
+    d.createDimension('t', 2)
+    d.createDimension('x', 4)
+    var = d.createVariable('u', 'i2', ('t', 'x'), fill_value=-999)
+    var.scale_factor = 0.01
+    var.add_offset = 1.
+    var[:] = np.ma.masked_values([[0., 0.5, 1., -999.], [2., 3., -999., 4.]], -999.)
+    d.close()
+
+    d = netCDF.Dataset(filename)
+    assert np.allclose(tracpy.inout.rawread(d.variables['u'], (slice(None), slice(1, 4))),
+                        np.ma.filled(d.variables['u'][:,1:4], 0.))
+    assert np.ma.isMaskedArray(d.variables['u'][:]) # back to masking and scaling after
+
+    # or to how the variable was read before
+    d.variables['u'].set_auto_mask(False)
+    tracpy.inout.rawread(d.variables['u'], (slice(None), slice(1, 4)))
+    assert not d.variables['u'].mask and d.variables['u'].scale
+    assert not np.ma.isMaskedArray(d.variables['u'][:])
+    d.close()
+
+    # values outside of the valid range are missing too, in packed units
+    d = netCDF.Dataset(filename, 'a')
+    v = d.createVariable('v', 'i2', ('t', 'x'))
+    v.valid_min = 0
+    v.valid_max = 250
+    v.scale_factor = 0.01
+    v.set_auto_maskandscale(False)
+    v[:] = [[-5, 0, 100, 250], [251, 30, -32767, 7]]
+    w = d.createVariable('w', 'f8', ('t', 'x'))
+    w.valid_range = [-1., 1.]
+    w[:] = [[-2., -1., 0.5, 1.], [1.5, 0., 3., -0.5]]
+    d.close()
+    d = netCDF.Dataset(filename)
+    for name in ['v', 'w']:
+        assert np.ma.getmaskarray(d.variables[name][:]).sum() == 3
+        assert np.allclose(tracpy.inout.rawread(d.variables[name], slice(None)),
+                            np.ma.filled(d.variables[name][:], 0.))
+    d.close()
+    shutil.rmtree(os.path.dirname(filename))
+
+    tp = Tracpy(os.path.join(here, 'input', 'ocean_his_0001.nc'), grid_filename=os.path.join(here, 'input', 'grid.nc'))
+    tp._readgrid()
+    nc = tracpy.inout.opendataset(tp.currents_filename)
+    for z0, zpar in [(None, None), ('s', 1), ('z', -60.)]:
+        fields = tracpy.inout.readfields(3, tp.grid, nc, z0, zpar)
+        raw = tracpy.inout.readfields(3, tp.grid, nc, z0, zpar, raw=True)
+        for field, rawfield in zip(fields, raw):
+            assert np.allclose(np.ma.filled(field, np.nan), np.ma.filled(rawfield, np.nan), equal_nan=True)
+    assert not np.ma.isMaskedArray(tracpy.inout.readfields(3, tp.grid, nc, raw=True)[0])
+    nc.close()
+
 def test_timestep():
     '''
     Test for moving between time indices and datetime.
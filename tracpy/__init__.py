@@ -9,14 +9,25 @@ Tracmass is available online.
 
 Modules available in tracpy include:
 
+* cache.py
+* fieldcache.py
+* handles.py
 * inout.py
+* kernel.py
 * op.py
+* planner.py
+* prefetch.py
+* providers.py
+* remote.py
 * run.py
+* shared.py
 * tools.py
 
 Modules available but not imported directly with TracPy include:
 * plotting.py
 * init.py
+* decompose.py
+* campaign.py
 * manual.ipynb
 * calcs.py
 
@@ -34,10 +45,19 @@ Modules available in tracmass include:
 * vertvel.f95
 '''
 
+import cache
+import fieldcache
+import handles
 import inout
+import kernel
 import op
+import planner
+import prefetch
+import providers
+import remote
 # import plotting
 import run
+import shared
 import tools
 
 __authors__ = ['Kristen Thyng <kthyng@tamu.edu>']
@@ -0,0 +1,242 @@
+"""
+Cache of simulation results, so that a simulation that has already been run
+with the same inputs isn't run again.
+
+A simulation is identified by a hash of everything that goes into it: the
+parameters of the Tracpy object, the start date, digests of the drifter
+starting locations (and of T0, U and V for stream functions), fingerprints
+of the model output and grid files (name, size and modification time), and a
+fingerprint of the tracpy code and the compiled kernel. Simulations on model
+fields that can't be identified, like those from a
+tracpy.providers.CallbackProvider, have no hash and aren't cached. Results are stored
+as one .npz file per simulation in the cache directory. Old entries are
+evicted by age and by the total size of the cache, least recently used first.
+
+Usage:
+    cache = ResultCache('cache', maxsize=10e9, maxage=30*24*3600.)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0, cache=cache)
+
+Contains:
+    fingerprint
+    input_hash
+    ResultCache
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+import datetime
+import numpy as np
+import tracpy.kernel
+
+# Parameters of a Tracpy object that don't change the results
+ignored = ['name', 'checkcopies', 'grid', '_gridargs', 'backend', 'shared', 'state',
+            'memory_budget', 'plan', '_preloaded', 'prefetch']
+
+_code = None
+
+def _digest(arr):
+    '''
+    Digest of the values of an array.
+    '''
+
+    arr = np.ascontiguousarray(np.ma.filled(np.asanyarray(arr, dtype=np.float64), np.nan))
+    return hashlib.sha1(str(arr.shape) + arr.tostring()).hexdigest()
+
+def _canonical(value):
+    '''
+    Version of value that can be written the same way every time with json.
+    '''
+
+    if value is None or isinstance(value, (bool, basestring)):
+        return value
+    elif isinstance(value, (int, long, float, np.generic)):
+        return repr(np.asscalar(np.asarray(value)))
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, np.ndarray):
+        return 'array:' + _digest(value)
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((str(k), _canonical(v)) for k, v in value.items())
+    elif isinstance(value, type):
+        return value.__name__
+    else: # for example a backend object
+        return type(value).__name__
+
+def fingerprint(filenames):
+    '''
+    Fingerprint of files: their names, sizes and modification times. Names that
+    are not local files, like thredds addresses, are used as they are. Providers of
+    model fields give their own.
+    '''
+
+    if filenames is None:
+        return None
+    if hasattr(filenames, 'fingerprint'): # a tracpy.providers.Provider
+        return filenames.fingerprint()
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+
+    fp = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            st = os.stat(filename)
+            fp.append([os.path.abspath(filename), st.st_size, repr(st.st_mtime)])
+        else:
+            fp.append(filename)
+
+    return fp
+
+def code_fingerprint():
+    '''
+    Digest of the tracpy source code and the compiled kernels, found once per process.
+    '''
+
+    global _code
+    if _code is None:
+        sha = hashlib.sha1()
+        files = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')))
+        for module in [tracpy.kernel.tracmass, tracpy.kernel.tracmass32]:
+            if module is not None:
+                files.append(module.__file__)
+        for filename in files:
+            f = open(filename, 'rb')
+            sha.update(f.read())
+            f.close()
+        _code = sha.hexdigest()
+
+    return _code
+
+def input_hash(tp, date, lon0, lat0, T0=None, U=None, V=None):
+    '''
+    Hash of all of the inputs of a simulation, as for tracpy.run.run.
+
+    Output:
+     key        Hexadecimal hash
+     inputs     Dictionary of what went into the hash
+
+    Raises a ValueError if the model output can't be identified (its fingerprint is None),
+    since then simulations on different model output would have the same hash.
+    '''
+
+    if fingerprint(tp.currents_filename) is None:
+        raise ValueError('The model output of this simulation can\'t be identified, so it can\'t be cached')
+
+    params = dict((k, _canonical(v)) for k, v in tp.__getstate__().items() if k not in ignored)
+    inputs = {'params': params,
+                'date': _canonical(date),
+                'lon0': _digest(lon0), 'lat0': _digest(lat0),
+                'T0': None if T0 is None else _digest(T0),
+                'U': None if U is None else _digest(U),
+                'V': None if V is None else _digest(V),
+                'files': [fingerprint(tp.currents_filename), fingerprint(tp.grid_filename),
+                            fingerprint(tp.vert_filename)],
+                'code': code_fingerprint()}
+
+    key = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    return key, inputs
+
+class ResultCache(object):
+    '''
+    Directory of simulation results, keyed by input_hash.
+    '''
+
+    # outputs of tracpy.run.run, in order
+    names = ['lonp', 'latp', 'zp', 'ttend', 'T0', 'U', 'V']
+
+    def __init__(self, directory, maxsize=None, maxage=None):
+        '''
+        :param directory: Where the results are kept
+        :param maxsize=None: Maximum total size of the results in bytes, or None for no limit
+        :param maxage=None: Maximum time in seconds since a result was last used, or None for no limit
+        '''
+
+        self.directory = directory
+        self.maxsize = maxsize
+        self.maxage = maxage
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError: # someone else made it first
+                pass
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        '''
+        Results for key, as returned by tracpy.run.run, or None if they are not in the cache.
+        '''
+
+        filename = self._file(key)
+        try:
+            d = np.load(filename)
+        except IOError:
+            return None
+
+        try:
+            result = tuple([d[name] if name in d.files else None for name in self.names])
+        finally:
+            d.close()
+        os.utime(filename, None) # used now, for evicting
+
+        return result
+
+    def store(self, key, result, inputs=None):
+        '''
+        Store the results of tracpy.run.run for key, along with the inputs that went
+        into the key, and evict old results.
+        '''
+
+        arrays = dict((name, np.asarray(value)) for name, value in zip(self.names, result)
+                        if value is not None)
+        if inputs is not None:
+            arrays['inputs'] = np.array(json.dumps(inputs, sort_keys=True))
+
+        # write under another name first so that no one reads a half-written file
+        tmp = os.path.join(self.directory, '%s.%d.tmp.npz' % (key, os.getpid()))
+        np.savez(tmp, **arrays)
+        os.rename(tmp, self._file(key))
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove results that are older than maxage, then the least recently used ones
+        until the cache is no bigger than maxsize.
+
+        Output:
+         removed    Keys of the results that were removed
+        '''
+
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, '*.npz')):
+            if filename.endswith('.tmp.npz'):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError: # removed by someone else
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        entries.sort() # least recently used first
+
+        now = time.time()
+        total = sum([size for _, size, _ in entries])
+        removed = []
+        for mtime, size, filename in entries:
+            if (self.maxage is not None and now - mtime > self.maxage) or \
+                    (self.maxsize is not None and total > self.maxsize):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                total -= size
+                removed.append(os.path.basename(filename)[:-4])
+
+        return removed
@@ -14,7 +14,7 @@ from scipy import ndimage
 import time
 import tracpy
 
-def Var(xp, yp, tp, varin, nc, units='seconds since 1970-01-01'):
+def Var(xp, yp, tp, varin, nc, units='seconds since 1970-01-01', raw=False):
     '''
     Calculate the given property, varin, along the input drifter tracks. This property can
     be changing in time and space.
@@ -26,8 +26,10 @@ def Var(xp, yp, tp, varin, nc, units='seconds since 1970-01-01'):
         tp          Times for drifter [ntime]
         varin       Variable to calculate. Available options are: u, v, salt, temp, h, zeta
         nc          Netcdf file object where the model output can be accessed which includes 
-                    all necessary times
+                    all necessary times, or its location, to use it from tracpy.handles
         units       For time conversion, not used for depths 
+        raw         True to read the model output with tracpy.inout.rawread, as a plain array with
+                    missing values of 0 (nan for salt and temp), instead of as a masked array
 
     Outputs:
         varp        Variable along the drifter track
@@ -36,14 +38,20 @@ def Var(xp, yp, tp, varin, nc, units='seconds since 1970-01-01'):
     first re-save drifter tracks in grid space using tracpy.inout.save_ll2grid()
     then open that drifter track file calling the object d
         d = netCDF.Dataset([trackfile in grid coords])
-    have the ocean simulation output available in nc
+    have the location of the ocean simulation output
         loc = 'http://barataria.tamu.edu:8080/thredds/dodsC/NcML/txla_nesting6.nc'
-        nc = netCDF.Dataset(loc)
-    Call this function 
-        varp = tracpy.calcs.Var(d.variables['xg'][:], d.variables['yg'][:], d.variables['tp'][:], 'h', nc)
+    Call this function, which uses the model output that is already open in this process, if it is
+        varp = tracpy.calcs.Var(d.variables['xg'][:], d.variables['yg'][:], d.variables['tp'][:], 'h', loc)
     '''
     tstart = time.time()
 
+    if isinstance(nc, (basestring, list)): # location of the model output
+        handle = tracpy.handles.acquire(nc)
+        try:
+            return Var(xp, yp, tp, varin, handle, units=units, raw=raw)
+        finally:
+            handle.close()
+
     # Time indices for the drifter track points
     if varin!='h': # don't need time for h
         t = nc.variables['ocean_time'][:] # model times
@@ -55,17 +63,23 @@ def Var(xp, yp, tp, varin, nc, units='seconds since 1970-01-01'):
     # Read in model information. Try reading it all in the for time, y, and x and then
     # interpolating from there.
 
+    if raw:
+        fill = np.nan if varin in ('salt', 'temp') else 0.
+        read = lambda index: tracpy.inout.rawread(nc.variables[varin], index, fill)
+    else:
+        read = lambda index: nc.variables[varin][index]
+
     # 4D variables
     if varin in ('u', 'v', 'salt', 'temp'):
-        var = nc.variables[varin][tinds, -1, :, :]
+        var = read((tinds, -1, slice(None), slice(None)))
 
     # 3D variables
     elif varin in ('zeta'):
-        var = nc.variables[varin][tinds, :, :]
+        var = read((tinds, slice(None), slice(None)))
 
     # 2D variables
     elif varin in ('h'):
-        var = nc.variables[varin][:, :]
+        var = read((slice(None), slice(None)))
 
 
     # Grid location of var. xp and yp are on staggered grids, counting from the cell
@@ -0,0 +1,355 @@
+"""
+Campaigns of many simulations, run by any number of workers on any number
+of machines that share a file system, without a scheduler.
+
+The simulations of a campaign are tasks, which are declared in a manifest in
+the campaign directory. A worker claims a task by making a lock file for it,
+which only one worker can make, runs the simulation, and records that the task
+is done, or that it failed, with timings. Done tasks are never run again, so a
+campaign can be stopped and started again at any time, and tasks can be added
+to it while workers are running.
+
+Directory layout:
+    manifest.json       Tasks, as {name: task}
+    manifest.lock       Manifest is being changed, with who is changing it
+    tasks/name.lock     Task is being run, with who is running it
+    tasks/name.done     Task is done, with timings and output file
+    tasks/name.failed   Task failed, with timings and the error
+    tracks/             Drifter tracks saved by the simulations
+
+A task is a dictionary with entries:
+    date                Start date, as 'YYYY-MM-DD HH:MM:SS'
+    lon0, lat0          Lists of drifter starting locations
+    params              Keyword arguments for Tracpy, including currents_filename
+
+Usage:
+    # once
+    c = Campaign('campaigns/shelf')
+    c.add({'shelf_20090101': {'date': '2009-01-01 00:00:00', 'lon0': [...], 'lat0': [...],
+                                'params': {'currents_filename': loc, 'ndays': 2}}})
+    # on each node, as many times as wanted
+    Campaign('campaigns/shelf').work()
+    # or from the command line
+    python -m tracpy.campaign campaigns/shelf
+
+Contains:
+    Campaign
+    run_task
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import datetime
+import traceback
+import tracpy
+
+datefmt = '%Y-%m-%d %H:%M:%S'
+
+def _write(filename, record):
+    '''
+    Write record to filename as json, so that it appears all at once.
+    '''
+
+    tmp = '%s.%s.%d.tmp' % (filename, socket.gethostname(), os.getpid())
+    f = open(tmp, 'w')
+    json.dump(record, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, filename)
+
+def _read(filename):
+    '''
+    Read json from filename, or None if there is no such file.
+    '''
+
+    try:
+        f = open(filename)
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    except ValueError: # still being written, for lock files
+        return None
+    finally:
+        f.close()
+
+def _lock(filename):
+    '''
+    Make lock file filename, with who holds it, unless it is already there.
+
+    Output:
+     locked     True if the lock was made by this process
+    '''
+
+    try:
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, json.dumps({'host': socket.gethostname(), 'pid': os.getpid(),
+                                'start': time.time()}))
+    os.close(fd)
+
+    return True
+
+def _stale(claim, maxage):
+    '''
+    Whether the holder of a lock, as written by _lock, has held it for longer than maxage
+    seconds, or is a process on this machine that is not running anymore.
+    '''
+
+    if claim is None: # still being written
+        return False
+    stale = time.time() - claim['start'] > maxage
+    if claim['host'] == socket.gethostname():
+        try:
+            os.kill(claim['pid'], 0)
+        except OSError, e:
+            stale = stale or e.errno != 1 # EPERM: running, as someone else
+    return stale
+
+def _str(value):
+    '''
+    Change the unicode strings that json reads in to str, which Tracpy expects for file names.
+    '''
+
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, list):
+        return [_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.items())
+    return value
+
+def run_task(campaign, name, task):
+    '''
+    Run the simulation of a task, saving the drifter tracks in the tracks directory
+    of the campaign.
+
+    Output:
+     filename   File with the drifter tracks
+    '''
+
+    from tracpy.tracpy_class import Tracpy # needs the kernel, only when actually running
+    import tracpy.run
+
+    params = _str(task['params'])
+    params['name'] = os.path.join(campaign.directory, 'tracks', name)
+    tp = Tracpy(**params)
+
+    date = datetime.datetime.strptime(task['date'], datefmt)
+    tracpy.run.run(tp, date, task['lon0'], task['lat0'])
+
+    if tp.savell:
+        return tp.name + '.nc'
+    else:
+        return tp.name + 'gc.nc'
+
+class Campaign(object):
+    '''
+    A campaign of simulations in a directory.
+    '''
+
+    def __init__(self, directory, run=run_task):
+        '''
+        :param directory: Campaign directory, on a file system shared by all of the workers
+        :param run=run_task: Function run(campaign, name, task) that runs a task and returns
+               the name of its output file
+        '''
+
+        self.directory = directory
+        self.run = run
+        self.manifest = os.path.join(directory, 'manifest.json')
+        self.taskdir = os.path.join(directory, 'tasks')
+
+        for d in [self.taskdir, os.path.join(directory, 'tracks')]:
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError: # another worker made it first
+                    pass
+
+    def _file(self, name, kind):
+        return os.path.join(self.taskdir, name + '.' + kind)
+
+    def tasks(self):
+        '''
+        The tasks in the manifest, as {name: task}.
+        '''
+
+        tasks = _read(self.manifest)
+        if tasks is None:
+            return {}
+        return tasks
+
+    def add(self, tasks, maxage=60.):
+        '''
+        Add tasks to the manifest. Adding a task that is already there, with the same
+        definition, does nothing, so the same campaign script can be run again.
+        A different definition for an existing name raises a ValueError.
+
+        Input:
+         tasks      Dictionary of {name: task}
+         maxage     (60.) Seconds after which a lock on the manifest is taken to be left
+                    behind by a process that died. Locks of processes on this machine that
+                    are not running anymore are removed whatever their age.
+        '''
+
+        # only one process changes the manifest at a time
+        lock = os.path.join(self.directory, 'manifest.lock')
+        while not _lock(lock):
+            if _stale(_read(lock), maxage):
+                try:
+                    os.remove(lock)
+                except OSError: # someone else got to it first
+                    pass
+            else:
+                time.sleep(0.1)
+
+        try:
+            manifest = self.tasks()
+            # round trip through json so that the comparison is with what would be stored
+            tasks = json.loads(json.dumps(tasks))
+            for name, task in tasks.items():
+                if '/' in name or name.startswith('.'):
+                    raise ValueError('task name %s is not a valid file name' % name)
+                if name in manifest and manifest[name] != task:
+                    raise ValueError('task %s is already in the manifest with a different definition' % name)
+                manifest[name] = task
+            _write(self.manifest, manifest)
+        finally:
+            os.remove(lock)
+
+    def status(self):
+        '''
+        What state each task is in: 'done', 'failed', 'running' or 'pending'.
+        '''
+
+        status = {}
+        for name in self.tasks():
+            for kind, state in [('done', 'done'), ('lock', 'running'), ('failed', 'failed')]:
+                if os.path.exists(self._file(name, kind)):
+                    status[name] = state
+                    break
+            else:
+                status[name] = 'pending'
+
+        return status
+
+    def claim(self, name, retry_failed=False):
+        '''
+        Try to claim a task for this process. Only one process can hold the claim for a task.
+
+        Output:
+         claimed    True if the task was claimed. False if it is claimed by someone else,
+                    done, or failed (unless retry_failed).
+        '''
+
+        if not _lock(self._file(name, 'lock')):
+            return False
+
+        # it may have been finished since it was looked at
+        if os.path.exists(self._file(name, 'done')) or \
+                (os.path.exists(self._file(name, 'failed')) and not retry_failed):
+            os.remove(self._file(name, 'lock'))
+            return False
+
+        return True
+
+    def release_stale(self, maxage):
+        '''
+        Remove claims that are older than maxage seconds, for tasks whose worker died
+        without recording that the task was done or failed. Claims by processes on
+        this machine that are not running anymore are removed whatever their age.
+
+        Output:
+         released   Names of the tasks that were released
+        '''
+
+        released = []
+        for name in self.tasks():
+            lock = self._file(name, 'lock')
+            if _stale(_read(lock), maxage):
+                try:
+                    os.remove(lock)
+                    released.append(name)
+                except OSError:
+                    pass
+
+        return released
+
+    def work(self, retry_failed=False, maxtasks=None):
+        '''
+        Claim and run tasks until there are none left to claim.
+
+        Input:
+         retry_failed   (False) True to also run tasks that failed before
+         maxtasks       (None) Maximum number of tasks to run
+
+        Output:
+         ran            Names of the tasks that were run, whether they succeeded or not
+        '''
+
+        self.release_stale(maxage=float('inf')) # claims of dead processes on this machine
+
+        ran = []
+        while maxtasks is None or len(ran) < maxtasks:
+            # the manifest is read again every time, since tasks can be added while working
+            names = [name for name, state in sorted(self.status().items())
+                        if state == 'pending' or (retry_failed and state == 'failed'
+                                                    and name not in ran)]
+            for name in names:
+                if self.claim(name, retry_failed=retry_failed):
+                    break
+            else: # nothing left to claim
+                break
+
+            self._runone(name)
+            ran.append(name)
+
+        return ran
+
+    def _runone(self, name):
+        '''
+        Run a claimed task, and record how it went.
+        '''
+
+        task = self.tasks()[name]
+        record = {'host': socket.gethostname(), 'pid': os.getpid(), 'start': time.time()}
+        try:
+            record['output'] = self.run(self, name, task)
+        except Exception:
+            record['end'] = time.time()
+            record['walltime'] = record['end'] - record['start']
+            record['error'] = traceback.format_exc()
+            _write(self._file(name, 'failed'), record)
+            print 'Task %s failed:' % name
+            print record['error']
+        else:
+            record['end'] = time.time()
+            record['walltime'] = record['end'] - record['start']
+            _write(self._file(name, 'done'), record)
+            if os.path.exists(self._file(name, 'failed')): # succeeded on retry
+                os.remove(self._file(name, 'failed'))
+        finally:
+            os.remove(self._file(name, 'lock'))
+
+    def summary(self):
+        '''
+        Number of tasks in each state, and the total wall time of the done tasks.
+        '''
+
+        status = self.status()
+        summary = dict((state, status.values().count(state))
+                        for state in ['done', 'failed', 'running', 'pending'])
+        summary['walltime'] = sum([_read(self._file(name, 'done'))['walltime']
+                                    for name, state in status.items() if state == 'done'])
+        return summary
+
+
+if __name__ == '__main__':
+    c = Campaign(sys.argv[1])
+    ran = c.work(retry_failed='--retry-failed' in sys.argv)
+    print 'Ran %d tasks' % len(ran)
+    print c.summary()
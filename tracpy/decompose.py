@@ -0,0 +1,345 @@
+"""
+Domain decomposition, for stepping drifters on tiles of the grid in separate
+processes when the model fields are too big to keep a copy of in every process.
+
+The grid is split into ni x nj tiles. Each tile is handled by a worker process,
+which reads in the model fields for its part of the grid and a halo of extra
+grid cells around it (with readfields(..., window=...)), and steps the drifters
+that are in its part of the grid. After each call to the kernel, drifters that
+have moved into another tile are handed over to that tile for the next call.
+Drifters are not allowed to leave the halo of their tile during a call, so the
+halo should be wider than the number of grid cells a drifter can cross in one
+call.
+
+Positions are in the grid index coordinates used by the kernel, as in
+Tracpy.step. Turbulence, periodic boundaries and stream functions are not
+supported.
+
+Usage:
+    dd = Decomposition(tp, FieldReader(tp), ni=2, nj=2, halo=10)
+    dd.read(tind) # for each model output, like Tracpy.prepare_for_model_step
+    xend, yend, zend, flag, ttend = dd.step(xstart, ystart, zstart, ta, tb)
+    dd.close()
+
+Contains:
+    edges
+    owners
+    FieldReader
+    Tile
+    Decomposition
+"""
+
+import numpy as np
+import multiprocessing
+import traceback
+import tracpy
+import tracpy.kernel
+import tracpy.inout
+import tracpy.fieldcache
+import tracpy.handles
+
+def edges(n, ntiles):
+    '''
+    Split grid points 0 to n-1 into ntiles pieces of nearly the same size.
+
+    Output:
+     edges      ntiles+1 edges, so that piece i is edges[i] to edges[i+1]-1
+    '''
+
+    return np.linspace(0, n, ntiles+1).round().astype(int)
+
+def owners(x, y, iedges, jedges):
+    '''
+    Find which tile drifters are in.
+
+    Input:
+     x, y           Drifter positions in kernel grid index coordinates
+     iedges, jedges Edges of the tiles in x and y, from edges
+
+    Output:
+     tile           Index of the tile for each drifter, numbered with j fastest
+    '''
+
+    # rho grid cell of the drifters, in python indexing
+    i = np.floor(x).astype(int)
+    j = np.floor(y).astype(int)
+
+    ti = np.searchsorted(iedges, i, side='right') - 1
+    tj = np.searchsorted(jedges, j, side='right') - 1
+    ti = ti.clip(0, iedges.size-2)
+    tj = tj.clip(0, jedges.size-2)
+
+    return ti*(jedges.size-1) + tj
+
+class FieldReader(object):
+    '''
+    Read in the model fields for a tile with readfields, through tracpy.fieldcache.
+    The model output is opened in the worker process the first time it is read from.
+    '''
+
+    def __init__(self, tp):
+        '''
+        :param tp: Tracpy object with the model output file names, the grid, and
+               the parameters for readfields.
+        '''
+
+        self.tp = tp
+        self.nc = None
+
+    def __call__(self, tind, window):
+        '''
+        Read model output tind for window, returning uflux, vflux and dzt.
+        '''
+
+        tp = self.tp
+        if self.nc is None:
+            self.nc = tracpy.handles.acquire(tp.currents_filename)
+
+        return tracpy.fieldcache.read(tp, tind, self.nc, window=window)[:3]
+
+class Tile(object):
+    '''
+    One tile of the grid: the model fields and grid arrays for its window, which
+    is its part of the grid and its halo, and stepping drifters in it.
+    '''
+
+    def __init__(self, tp, gridargs, window, reader):
+        '''
+        :param tp: Tracpy object with the parameters for the kernel
+        :param gridargs: Grid arrays for the whole grid, from tracpy.kernel.grid_args
+        :param window: (i0, i1, j0, j1), rho grid points i0 to i1-1 in x and j0 to j1-1 in y
+        :param reader: Function reader(tind, window) returning uflux, vflux and dzt
+               for model output tind in window, like FieldReader
+        '''
+
+        self.tp = tp
+        self.window = window
+        self.reader = reader
+        self.shape = gridargs['kmt'].shape # of the whole grid
+
+        i0, i1, j0, j1 = window
+        self.gridargs = {'kmt': np.asfortranarray(gridargs['kmt'][i0:i1,j0:j1]),
+                        'dxdy': np.asfortranarray(gridargs['dxdy'][i0:i1,j0:j1]),
+                        'dxv': np.asfortranarray(gridargs['dxv'][i0:i1,j0:j1-1]),
+                        'dyu': np.asfortranarray(gridargs['dyu'][i0:i1-1,j0:j1]),
+                        'h': np.asfortranarray(gridargs['h'][i0:i1,j0:j1])}
+
+        self.backend = tracpy.kernel.get_backend(tp._backend, usefloat32=tp.usefloat32)
+
+        # two time slabs of the model fields, as in Tracpy
+        self.uf = None
+        self.vf = None
+        self.dzt = None
+
+    def read(self, tind):
+        '''
+        Read in model output tind as the newer time slab, moving the newer slab to the older one.
+        '''
+
+        uf, vf, dzt = self.reader(tind, self.window)
+
+        if self.uf is None:
+            self.uf = np.ones(uf.shape + (2,), dtype=self.tp.dtype, order='F')*np.nan
+            self.vf = np.ones(vf.shape + (2,), dtype=self.tp.dtype, order='F')*np.nan
+            self.dzt = np.ones(dzt.shape + (2,), dtype=self.tp.dtype, order='F')*np.nan
+        else:
+            self.uf[:,:,:,0] = self.uf[:,:,:,1]
+            self.vf[:,:,:,0] = self.vf[:,:,:,1]
+            self.dzt[:,:,:,0] = self.dzt[:,:,:,1]
+
+        self.uf[:,:,:,1] = uf
+        self.vf[:,:,:,1] = vf
+        self.dzt[:,:,:,1] = dzt
+
+    def step(self, xstart, ystart, zstart, ta, tb):
+        '''
+        Step drifters that are in this tile with the kernel, as in Tracpy.step.
+
+        Output:
+         xend, yend, zend, flag, ttend  As from Tracpy.step
+         left       True for drifters that were stopped at the edge of the halo,
+                    instead of at the edge of the grid, as far as can be told
+        '''
+
+        tp = self.tp
+        i0, i1, j0, j1 = self.window
+        ntrac = xstart.size
+        km = self.uf.shape[2]
+
+        # positions in the grid of the window
+        x = np.asfortranarray(xstart - i0)
+        y = np.asfortranarray(ystart - j0)
+        z = np.asfortranarray(zstart, dtype=np.float64)
+
+        # outputs after a drifter is stopped are not written by the kernel, so start
+        # with nan's to be able to tell where it was last
+        xend = np.ones((ntrac, tp.N), order='F')*np.nan
+        yend = np.ones((ntrac, tp.N), order='F')*np.nan
+        zend = np.ones((ntrac, tp.N), order='F')*np.nan
+        ttend = np.ones((ntrac, tp.N), order='F')*np.nan
+        flag = np.zeros(ntrac, dtype=tracpy.kernel.inttype)
+        # TRACMASS doesn't look at these
+        wft = np.zeros((1, 1, km+1, 2), order='F')
+        dxyzt = np.zeros((1, 1, km, 2), order='F')
+        counts = np.zeros((1, len(tracpy.kernel.counternames)), dtype=tracpy.kernel.inttype, order='F')
+
+        g = self.gridargs
+        if ntrac > 0:
+            self.backend.step(x, y, z, tp.tseas_use*(tb-ta), self.uf, self.vf, ta, tb, tp.ff,
+                                g['kmt'], self.dzt, g['dxdy'], g['dxv'], g['dyu'], g['h'],
+                                xend, yend, zend, flag, ttend, tp.nsteps, tp.ah, tp.av,
+                                tp.do3d, 0, 0, 0, 0, wft, dxyzt, 0, counts, tp.maxiter)
+
+        # Where the drifters that were stopped at an edge of the window went out isn't
+        # kept by the kernel, so use the edge closest to their last position. If that 
+        # is not an edge of the grid, the drifter left through the halo.
+        written = ~np.isnan(xend)
+        last = written.sum(axis=1) - 1
+        x1 = np.where(last >= 0, xend[np.arange(ntrac), last], x)
+        y1 = np.where(last >= 0, yend[np.arange(ntrac), last], y)
+        imt, jmt = self.shape
+        distance = np.vstack((x1 - 1, (i1-i0-1) - x1, y1 - 1, (j1-j0-1) - y1))
+        inside = np.array([i0 > 0, i1 < imt, j0 > 0, j1 < jmt]) # which edges are inside the grid
+        left = (flag == 1) * inside[distance.argmin(axis=0)]
+
+        # back to the grid of the whole domain, with zeros after drifters are stopped as in Tracpy.step
+        xend = np.where(written, xend + i0, 0.)
+        yend = np.where(written, yend + j0, 0.)
+        zend = np.where(written, zend, 0.)
+        ttend = np.where(written, ttend, 0.)
+
+        return xend, yend, zend, flag, ttend, left
+
+def _work(conn, tile):
+    '''
+    Worker process for a tile: call methods of the tile that are sent through conn,
+    and send back the results, or the exception, until None is sent.
+    '''
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        method, args = message
+        try:
+            result = getattr(tile, method)(*args)
+        except Exception, e:
+            conn.send(('error', '%s\n%s' % (e, traceback.format_exc())))
+        else:
+            conn.send(('ok', result))
+    conn.close()
+
+class Decomposition(object):
+    '''
+    Tiles of the grid, each with its own worker process, for stepping drifters
+    without having the model fields for the whole grid in any one process.
+    '''
+
+    def __init__(self, tp, reader, ni=2, nj=2, halo=10, processes=True):
+        '''
+        :param tp: Tracpy object with the grid and the parameters for the kernel
+        :param reader: Function reader(tind, window) returning uflux, vflux and dzt
+               for model output tind for the window of a tile, like FieldReader
+        :param ni=2, nj=2: Number of tiles in x and in y
+        :param halo=10: Number of grid cells around each tile that its worker also reads in
+        :param processes=True: False to keep the tiles in this process, for debugging
+        '''
+
+        if tp.doturb != 0 or tp.doperiodic != 0 or tp.dostream != 0:
+            raise NotImplementedError('domain decomposition does not support doturb, doperiodic or dostream')
+
+        if tp._gridargs is None:
+            tp._gridargs = tracpy.kernel.grid_args(tp.grid)
+        imt, jmt = tp._gridargs['kmt'].shape
+
+        self.N = tp.N
+        self.iedges = edges(imt, ni)
+        self.jedges = edges(jmt, nj)
+
+        self.tiles = []
+        for ti in xrange(ni):
+            for tj in xrange(nj):
+                window = (max(self.iedges[ti]-halo, 0), min(self.iedges[ti+1]+halo, imt),
+                            max(self.jedges[tj]-halo, 0), min(self.jedges[tj+1]+halo, jmt))
+                self.tiles.append(Tile(tp, tp._gridargs, window, reader))
+
+        # start a worker process for each tile
+        self.conns = None
+        self.workers = None
+        if processes:
+            self.conns = []
+            self.workers = []
+            for tile in self.tiles:
+                conn, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=_work, args=(child, tile))
+                worker.daemon = True
+                worker.start()
+                self.conns.append(conn)
+                self.workers.append(worker)
+
+    def _call(self, method, args):
+        '''
+        Call method of every tile, with args[n] for tile n, in parallel if there are
+        worker processes.
+        '''
+
+        if self.conns is None:
+            return [getattr(tile, method)(*arg) for tile, arg in zip(self.tiles, args)]
+
+        for conn, arg in zip(self.conns, args):
+            conn.send((method, arg))
+
+        results = []
+        for conn in self.conns:
+            status, result = conn.recv()
+            if status == 'error':
+                raise RuntimeError('error in tile worker: ' + result)
+            results.append(result)
+
+        return results
+
+    def read(self, tind):
+        '''
+        Have every tile read in model output tind.
+        '''
+
+        self._call('read', [(tind,)]*len(self.tiles))
+
+    def step(self, xstart, ystart, zstart, ta, tb):
+        '''
+        Step drifters on the tiles that they are in, as in Tracpy.step. Drifters that
+        moved to another tile will be stepped by that tile the next time.
+        '''
+
+        tile = owners(xstart, ystart, self.iedges, self.jedges)
+        inds = [np.where(tile == n)[0] for n in xrange(len(self.tiles))]
+
+        results = self._call('step', [(xstart[ind], ystart[ind], zstart[ind], ta, tb)
+                                        for ind in inds])
+
+        ntrac = xstart.size
+        xend = np.zeros((ntrac, self.N))
+        yend = np.zeros((ntrac, self.N))
+        zend = np.zeros((ntrac, self.N))
+        ttend = np.zeros((ntrac, self.N))
+        flag = np.zeros(ntrac, dtype=tracpy.kernel.inttype)
+        for ind, result in zip(inds, results):
+            xend[ind], yend[ind], zend[ind], flag[ind], ttend[ind], left = result
+            if left.any():
+                raise ValueError('%d drifters left the halo of their tile in one step, use a larger halo'
+                                    % left.sum())
+
+        return xend, yend, zend, flag, ttend
+
+    def close(self):
+        '''
+        Stop the worker processes.
+        '''
+
+        if self.conns is not None:
+            for conn in self.conns:
+                conn.send(None)
+            for worker in self.workers:
+                worker.join()
+            self.conns = None
+            self.workers = None
@@ -0,0 +1,200 @@
+"""
+Cache of model fields prepared by readfields, shared by all of the Tracpy objects
+in a process, so that runs that use the same model output, like ones started on
+overlapping dates, don't read in and process the same time indices again.
+
+Fields are kept for each (model output fingerprint, grid fingerprint, tind, z0, zpar, zparuv,
+zband, window, rawread) as the (uflux, vflux, dzt, zrt, zwt) tuple from readfields, up to a total size in
+bytes. The least recently used fields are removed first when it is full. The
+cache can be used from many threads at once. The fields in it are shared, so they
+should be copied before they are changed.
+
+Usage:
+    tracpy.fieldcache.cache.maxbytes = 4e9 # or 0 to not keep any fields
+    tracpy.fieldcache.cache.stats()
+
+Contains:
+    FieldCache
+    gridprint
+    key
+    read
+    read_range
+"""
+
+import weakref
+import threading
+import numpy as np
+from collections import OrderedDict
+from matplotlib.pyplot import is_string_like
+import tracpy
+import tracpy.cache
+
+class FieldCache(object):
+    '''
+    Least recently used cache of model fields, up to a total size.
+    '''
+
+    def __init__(self, maxbytes=2e9):
+        '''
+        :param maxbytes=2e9: Maximum total size of the fields kept, in bytes
+        '''
+
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fields = OrderedDict() # least recently used first
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._fields
+
+    def __len__(self):
+        with self._lock:
+            return len(self._fields)
+
+    def get(self, key):
+        '''
+        Fields for key, or None if they aren't kept.
+        '''
+
+        with self._lock:
+            fields = self._fields.pop(key, None)
+            if fields is None:
+                self.misses += 1
+            else:
+                self._fields[key] = fields # most recently used now
+                self.hits += 1
+            return fields
+
+    def put(self, key, fields):
+        '''
+        Keep fields for key, if they fit, removing the least recently used fields
+        to make room.
+        '''
+
+        size = sum([f.nbytes for f in fields])
+        with self._lock:
+            if key in self._fields:
+                self.nbytes -= sum([f.nbytes for f in self._fields.pop(key)])
+            if size > self.maxbytes:
+                return
+            while self._fields and self.nbytes + size > self.maxbytes:
+                _, old = self._fields.popitem(last=False)
+                self.nbytes -= sum([f.nbytes for f in old])
+                self.evictions += 1
+            self._fields[key] = fields
+            self.nbytes += size
+
+    def clear(self):
+        '''
+        Remove all of the fields, and start the statistics over.
+        '''
+
+        with self._lock:
+            self._fields.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        '''
+        Hits, misses and evictions so far, and the number and total size of the fields kept.
+        '''
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._fields), 'nbytes': self.nbytes}
+
+# Model fields that have been read in this process
+cache = FieldCache()
+
+# Entries of the grid that the fields depend on: the sizes and vertical grid parameters,
+# and the arrays that readfields uses for the fluxes and the depths
+gridscalars = ['imt', 'jmt', 'km', 'hc', 'theta_s', 'theta_b', 'Vtransform', 'Vstretching']
+gridarrays = ['dxv', 'dyu', 'h', 'kmt', 'Cs_r', 'sc_r', 'zwt0']
+
+_digests = {} # {id(array): (weak reference to the array, digest)}, for the grid arrays
+
+def _digest(arr):
+    '''
+    Digest of a grid array, found once for each array object.
+    '''
+
+    i = id(arr)
+    ref, digest = _digests.get(i, (None, None))
+    if ref is None or ref() is not arr:
+        digest = tracpy.cache._digest(arr)
+        _digests[i] = (weakref.ref(arr, lambda ref: _digests.pop(i, None)), digest)
+    return digest
+
+def gridprint(grid):
+    '''
+    Fingerprint of the parts of grid dictionary grid that the model fields depend on,
+    so that the fields of different grids, like the same model output with another
+    vertical grid, are kept apart, while objects that share a grid share fields.
+    '''
+
+    fp = [(name, repr(np.asarray(grid[name]).tolist())) for name in gridscalars if name in grid]
+    fp += [(name, _digest(grid[name])) for name in gridarrays if name in grid]
+    return fp
+
+def key(tp, tind, window=None):
+    '''
+    Key for the model fields of Tracpy object tp at time index tind, for window
+    as in readfields.
+    '''
+
+    if is_string_like(tp.z0):
+        vert = (tp.z0, tp.zpar, tp.zparuv, tp.zband)
+    else: # 3d case
+        vert = (None, None, None, None)
+    if window is not None:
+        window = tuple(window)
+
+    return (repr(tracpy.cache.fingerprint(tp.currents_filename)), repr(gridprint(tp.grid)),
+            tind) + vert + (window, tp.rawread)
+
+def read(tp, tind, nc, window=None):
+    '''
+    Model fields of Tracpy object tp at time index tind, from the cache or read in
+    with readfields and then kept.
+
+    Output:
+     fields     (uflux1, vflux1, dzt, zrt, zwt) as from readfields
+    '''
+
+    k = key(tp, tind, window)
+    fields = cache.get(k)
+    if fields is None:
+        if is_string_like(tp.z0): # isoslice case
+            fields = tracpy.inout.readfields(tind, tp.grid, nc, tp.z0, tp.zpar,
+                                                zparuv=tp.zparuv, window=window, kband=tp.zband,
+                                                raw=tp.rawread)
+        else: # 3d case
+            fields = tracpy.inout.readfields(tind, tp.grid, nc, window=window, raw=tp.rawread)
+        cache.put(k, fields)
+
+    return fields
+
+def read_range(tp, tinds, nc):
+    '''
+    Model fields of Tracpy object tp at time indices tinds, read in
+    all at once with readfields_range and then kept.
+
+    Output:
+     fields     Dictionary of {tind: (uflux1, vflux1, dzt, zrt, zwt)}
+    '''
+
+    if is_string_like(tp.z0): # isoslice case
+        fields = tracpy.inout.readfields_range(tinds, tp.grid, nc, tp.z0, tp.zpar, zparuv=tp.zparuv,
+                                                kband=tp.zband, raw=tp.rawread)
+    else: # 3d case
+        fields = tracpy.inout.readfields_range(tinds, tp.grid, nc, raw=tp.rawread)
+    for tind in tinds:
+        cache.put(key(tp, tind), fields[tind])
+
+    return fields
@@ -0,0 +1,199 @@
+"""
+Pool of open handles to model output and grid files, shared by everything in a
+process that reads them, so that back-to-back runs and analysis of their results
+don't open the same datasets again. This matters most for thredds addresses and
+for long lists of files, which are slow to open.
+
+A handle is taken from the pool with acquire and given back with its close
+method. Handles are kept open after they are given back, and are closed when
+they haven't been used for idle seconds, which is checked whenever the pool is
+used. A handle that has been given back is checked before it is used again, and
+is opened again if it doesn't work anymore, like after a dropped connection. A
+process that is forked off gets a pool of its own.
+
+Handles from the pool should only be used from one thread at a time. Readers in
+other threads, like tracpy.prefetch, open their own.
+
+Usage:
+    nc = tracpy.handles.acquire(loc)
+    u = nc.variables['u'][0]
+    nc.close() # given back to the pool
+
+Contains:
+    Handle
+    HandlePool
+    acquire
+"""
+
+import os
+import time
+import threading
+import tracpy
+import tracpy.inout
+
+def _key(loc):
+    if isinstance(loc, basestring):
+        return loc
+    return tuple(loc)
+
+def _healthy(dataset):
+    '''
+    Whether a dataset can still be read from: it is open, and the first value of
+    a one-dimensional variable can be read.
+    '''
+
+    try:
+        if hasattr(dataset, 'isopen') and not dataset.isopen():
+            return False
+        for var in dataset.variables.values():
+            if len(var.shape) == 1 and var.shape[0] > 0:
+                var[0]
+                break
+    except (RuntimeError, IOError):
+        return False
+
+    return True
+
+class Handle(object):
+    '''
+    Dataset from a HandlePool. It is used like the netCDF4 Dataset, and close gives
+    it back to the pool.
+    '''
+
+    def __init__(self, pool, key, dataset):
+        self.pool = pool
+        self.key = key
+        self.dataset = dataset
+        self.closed = False
+
+    @property
+    def variables(self):
+        return self.dataset.variables
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.release(self.key)
+
+    def __getattr__(self, attr):
+        if attr == 'dataset': # not set yet
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+class HandlePool(object):
+    '''
+    Open datasets, by location, with how many users each has.
+    '''
+
+    def __init__(self, idle=600., opener=None):
+        '''
+        :param idle=600.: Seconds after which a dataset that no one is using is closed
+        :param opener=None: Function that opens a location, tracpy.inout.opendataset for None
+        '''
+
+        self.idle = idle
+        if opener is None:
+            opener = tracpy.inout.opendataset
+        self.opener = opener
+        self.opens = 0
+        self.reuses = 0
+        self._entries = {} # {key: [dataset, users, time last given back]}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _forked(self):
+        '''
+        Forget the datasets of the parent process in a forked process, without
+        closing them, since they are still the parent's.
+        '''
+
+        if os.getpid() != self._pid:
+            self._entries = {}
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _prune(self, now):
+        '''
+        Close the datasets that no one has used for idle seconds.
+        '''
+
+        for key, (dataset, users, last) in self._entries.items():
+            if users == 0 and now - last > self.idle:
+                del self._entries[key]
+                dataset.close()
+
+    def acquire(self, loc):
+        '''
+        Dataset at loc, from the pool if it is already open.
+
+        Input:
+         loc        Location as for tracpy.inout.opendataset
+
+        Output:
+         handle     Handle, to be closed when done with it
+        '''
+
+        self._forked()
+        key = _key(loc)
+        with self._lock:
+            self._prune(time.time())
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == 0 and not _healthy(entry[0]):
+                del self._entries[key]
+                try:
+                    entry[0].close()
+                except RuntimeError: # already closed
+                    pass
+                entry = None
+            if entry is None:
+                entry = [self.opener(loc), 0, None]
+                self._entries[key] = entry
+                self.opens += 1
+            else:
+                self.reuses += 1
+            entry[1] += 1
+
+        return Handle(self, key, entry[0])
+
+    def release(self, key):
+        '''
+        Give back a dataset that was acquired.
+        '''
+
+        self._forked()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                entry[2] = time.time()
+            self._prune(time.time())
+
+    def clear(self):
+        '''
+        Close all of the datasets that no one is using.
+        '''
+
+        with self._lock:
+            for key, (dataset, users, last) in self._entries.items():
+                if users == 0:
+                    del self._entries[key]
+                    dataset.close()
+
+    def stats(self):
+        '''
+        Number of datasets opened and reused so far, and of datasets open and in use now.
+        '''
+
+        with self._lock:
+            return {'opens': self.opens, 'reuses': self.reuses, 'open': len(self._entries),
+                    'inuse': len([e for e in self._entries.values() if e[1] > 0])}
+
+# Datasets that are open in this process
+pool = HandlePool()
+
+def acquire(loc):
+    '''
+    Dataset at loc from the pool of this process, as for HandlePool.acquire.
+    '''
+
+    return pool.acquire(loc)
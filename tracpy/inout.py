@@ -2,9 +2,14 @@
 Input/output routines for tracpy.
 
 Contains:
+    opendataset
     setupROMSfiles
     readgrid
+    isoslice_weights
+    isoslice
+    rawread
     readfields
+    readfields_range
     savetracks
     loadtracks
     loadtransport
@@ -24,6 +29,39 @@ import op
 import os
 import tracpy
 from matplotlib.mlab import find
+from fractions import gcd
+
+def opendataset(loc):
+    '''
+    Open model output, as for setupROMSfiles.
+
+    Input:
+     loc        File location. loc can be:
+                * a thredds server web address
+                * a single string of a file location
+                * a list of strings of multiple file locations, in chronological order
+
+    Output:
+     nc         NetCDF object for the files
+    '''
+
+    # This addresses an issue in netCDF4 that was then fixed, but
+    # this line makes updating unnecessary. Issue described here: 
+    # http://code.google.com/p/netcdf4-python/issues/detail?id=170
+    netCDF._set_default_format(format='NETCDF3_64BIT')
+
+    # For thredds server where all information is available in one place
+    # or for a single file
+    if 'http' in loc or type(loc)==str:
+        nc = tracpy.remote.dataset(loc) # through the disk cache for remote output
+
+    # This is for the case when we have a bunch of files to sort through
+    else:
+        # the globbing should happen ahead of time so this case looks different than
+        # the single file case
+        nc = netCDF.MFDataset(loc) # files in fname are in chronological order
+
+    return nc
 
 def setupROMSfiles(loc,date,ff,tout, time_units, tstride=1):
     '''
@@ -39,6 +77,7 @@ def setupROMSfiles(loc,date,ff,tout, time_units, tstride=1):
                 * a single string of a file location
                 * a list of strings of multiple file locations to be searched
                 through
+                * a tracpy.providers.Provider, which is then used in place of nc
      date       datetime format start date
      ff         Time direction. ff=1 forward, ff=-1 backward
      tout       Number of model outputs to use
@@ -47,27 +86,18 @@ def setupROMSfiles(loc,date,ff,tout, time_units, tstride=1):
                  than is available. Default is 1, using all output.
 
     Output:
-     nc         NetCDF object for relevant files
+     nc         NetCDF object for relevant files, from tracpy.handles
      tinds      Indices of outputs to use from fname files
     '''
-    # This addresses an issue in netCDF4 that was then fixed, but
-    # this line makes updating unnecessary. Issue described here: 
-    # http://code.google.com/p/netcdf4-python/issues/detail?id=170
-    netCDF._set_default_format(format='NETCDF3_64BIT')
-
-    # For thredds server where all information is available in one place
-    # or for a single file
-    if 'http' in loc or type(loc)==str:
-        nc = netCDF.Dataset(loc)
-
-    # This is for the case when we have a bunch of files to sort through
+    if isinstance(loc, tracpy.providers.Provider):
+        nc = loc
+        times = loc.times()
     else:
-        # the globbing should happen ahead of time so this case looks different than
-        # the single file case
-        nc = netCDF.MFDataset(loc) # files in fname are in chronological order
+        nc = tracpy.handles.acquire(loc) # reused if it is already open
+        times = nc.variables['ocean_time'][:]
 
     # Convert date to number
-    dates = netCDF.num2date(nc.variables['ocean_time'][:], time_units)
+    dates = netCDF.num2date(times, time_units)
     # time index with time value just below date (relative to file ifile)
     istart = find(dates<=date)[-1]
 
@@ -149,7 +179,7 @@ def readgrid(grid_filename, vert_filename=None, llcrnrlon=-98.5, llcrnrlat=22.5,
     # this line makes updating unnecessary. Issue described here:
     # http://code.google.com/p/netcdf4-python/issues/detail?id=170
     netCDF._set_default_format(format='NETCDF3_64BIT')
-    gridfile = netCDF.Dataset(grid_filename)
+    gridfile = tracpy.handles.acquire(grid_filename)
 
     # # Read in whether grid is spherical or not
     # try:
@@ -256,7 +286,7 @@ def readgrid(grid_filename, vert_filename=None, llcrnrlon=-98.5, llcrnrlat=22.5,
     # Still want vertical grid metrics, but are in separate file
     elif vert_filename is not None:
         try:
-            nc = netCDF.Dataset(vert_filename)
+            nc = tracpy.handles.acquire(vert_filename)
         except RuntimeError:
             nc = netCDF.MFDataset(vert_filename)
 
@@ -274,6 +304,7 @@ def readgrid(grid_filename, vert_filename=None, llcrnrlon=-98.5, llcrnrlat=22.5,
         else:
             Vtransform = 1
             Vstretching = 1
+        nc.close()
 
     if keeptime: 
         vgridtime = time.time()
@@ -430,7 +461,151 @@ def readgrid(grid_filename, vert_filename=None, llcrnrlon=-98.5, llcrnrlat=22.5,
     return grid
 
 
-def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
+def isoslice_weights(prop, isoval):
+    '''
+    Weights for taking slices of fields where prop is equal to isoval, found once
+    and then used for any number of fields on the same grid with isoslice. This
+    gives the same slices as octant.tools.isoslice(var, prop, isoval): linear
+    interpolation between the levels above and below where prop crosses isoval,
+    averaged over the crossings if there is more than one in a column, and masked
+    where there are none.
+
+    Input:
+     prop       Property to slice on, with the vertical as the first dimension
+     isoval     Value of prop for the slice
+
+    Output:
+     weights    Weight of each level, same shape as prop
+     mask       True where prop doesn't cross isoval, shape of prop without the vertical
+    '''
+
+    p = np.asarray(prop) - isoval
+    cross = p[:-1]*p[1:] < 0
+    ncross = cross.sum(axis=0)
+    dp = np.where(cross, p[1:] - p[:-1], 1.)
+
+    weights = np.zeros(p.shape)
+    weights[:-1] += np.where(cross, p[1:]/dp, 0.)
+    weights[1:] -= np.where(cross, p[:-1]/dp, 0.)
+    weights /= np.maximum(ncross, 1)
+
+    return weights, ncross == 0
+
+def isoslice(var, weights, mask):
+    '''
+    Slice of var, with the weights and mask from isoslice_weights for its grid.
+    '''
+
+    return np.ma.masked_where(mask, (weights*np.asarray(var)).sum(axis=0))
+
+def _layers(z0, zpar):
+    '''
+    The isoslice values of the layers for a list of zpar, or None for one zpar.
+    '''
+
+    if is_string_like(z0) and np.iterable(zpar) and not is_string_like(zpar):
+        return list(zpar)
+    return None
+
+def rawread(var, index, fill=0.):
+    '''
+    Read var[index] as a plain array, without netCDF4's masking and scaling, which
+    makes masked arrays and temporaries in each read. Fill values (and netCDF4's 
+    default fill value for the type) and values outside of valid_min/valid_max or
+    valid_range are replaced by fill, and scale_factor and add_offset are applied
+    in place, in one pass over the values that were read.
+
+    Input:
+     var        NetCDF variable
+     index      What to read, as for var[index]
+     fill       (0.) Value to use for missing values
+
+    Output:
+     values     Array of the values
+    '''
+
+    if not hasattr(var, 'set_auto_maskandscale'): # an array, like from tracpy.providers
+        return np.ma.filled(var[index], fill)
+
+    # put back the masking and scaling the variable had, which may have been turned off
+    mask, scale = getattr(var, 'mask', True), getattr(var, 'scale', True)
+    var.set_auto_maskandscale(False)
+    try:
+        values = var[index]
+    finally:
+        if hasattr(var, 'set_auto_mask'):
+            var.set_auto_mask(mask)
+            var.set_auto_scale(scale)
+        else:
+            var.set_auto_maskandscale(mask and scale)
+
+    if np.ma.isMaskedArray(values): # already masked, like reads from tracpy.remote.cache
+        return np.ma.filled(values, fill)
+    values = np.asarray(values)
+
+    # find the missing values before they are scaled, as netCDF4 does: fill values, and
+    # values outside of the valid range
+    missing = [getattr(var, attr) for attr in ['_FillValue', 'missing_value'] if hasattr(var, attr)]
+    if not missing and values.dtype.kind in 'fiu':
+        missing = [netCDF.default_fillvals['%s%d' % (values.dtype.kind, values.dtype.itemsize)]]
+    bad = None
+    for value in np.ravel(missing):
+        if bad is None:
+            bad = values == value
+        else:
+            bad |= values == value
+    validmin, validmax = getattr(var, 'valid_min', None), getattr(var, 'valid_max', None)
+    if hasattr(var, 'valid_range'):
+        validmin, validmax = np.ravel(var.valid_range)[:2]
+    if validmin is not None:
+        bad = values < validmin if bad is None else bad | (values < validmin)
+    if validmax is not None:
+        bad = values > validmax if bad is None else bad | (values > validmax)
+
+    scale = getattr(var, 'scale_factor', None)
+    offset = getattr(var, 'add_offset', None)
+    if scale is not None or offset is not None or (bad is not None and bad.any()):
+        if values.dtype.kind != 'f': # packed integers
+            values = values.astype(np.float64)
+        if scale is not None:
+            values *= scale
+        if offset is not None:
+            values += offset
+        if bad is not None:
+            values[bad] = fill
+
+    return values
+
+def _read(var, index, raw, fill=0.):
+    '''
+    Read var[index], with rawread for raw.
+    '''
+
+    if raw:
+        return rawread(var, index, fill)
+    return var[index]
+
+def _readlevels(var, index, k, rest, raw=False):
+    '''
+    Read in s levels k of var at index, which may be a list of levels, with one read.
+    '''
+
+    if np.iterable(k):
+        k = np.asarray(k)
+        lead = (slice(None),)*isinstance(index, slice) # keep the time dimension of a range
+        return _read(var, (index, slice(k.min(), k.max()+1)) + rest, raw)[lead + (k-k.min(),)]
+    return _read(var, (index, k) + rest, raw)
+
+def _stack(fields, layers, axis):
+    '''
+    Stack the slices for each layer along axis, or return the one slice if there are no layers.
+    '''
+
+    if layers is None:
+        return fields[0]
+    return np.ma.concatenate([np.ma.expand_dims(f, axis) for f in fields], axis=axis)
+
+def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None, window=None, kband=None, raw=False):
     '''
     readfields()
     Kristen Thyng, March 2013
@@ -454,6 +629,20 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
             from the k index in the grid. This might happen if, for example, only the surface current
             were saved, but the model run originally did have many layers. This parameter
             represents the k index for the u and v output, not for the grid.
+     window (optional) (i0, i1, j0, j1) to read in only the part of the model output for rho
+            grid points i0 to i1-1 in x and j0 to j1-1 in y (tracmass ordering), as for one 
+            tile in tracpy.decompose. The outputs are then the same as the corresponding part
+            of the outputs for the whole grid. Default is the whole grid.
+     kband  (optional) (k0, k1) for z0 of 'rho', 'salt', 'temp' or 'z', to read in only
+            s levels k0 to k1-1 (0 at the bottom), when the isosurface is known to be
+            between them everywhere. Columns where it isn't are masked. Default is all levels.
+     raw    (optional) True to read the model output with rawread, as plain arrays with 0 
+            (or nan for the isoslice property) where values are missing, instead of as 
+            masked arrays. Default is False.
+
+    zpar (and zparuv) can also be a list, for layers of isoslices that are all taken from
+    the same read of the model output. The slices are then stacked in place of the 
+    vertical levels, one for each layer in order, instead of having one placeholder level.
 
     Output:
      uflux1     Zonal (x) flux at tind
@@ -487,27 +676,40 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
     # pdb.set_trace()
     if zparuv is None:
         zparuv = zpar
+    layers = _layers(z0, zpar)
+    if layers is not None:
+        zpar = layers
+
+    if window is None:
+        window = (0, grid['imt'], 0, grid['jmt'])
+    i0, i1, j0, j1 = window
+
+    # levels to read in, for an isoslice within a band of levels
+    if kband is not None and z0 in ['rho', 'salt', 'temp', 'z']:
+        ks = slice(kband[0], kband[1])
+    else:
+        ks = slice(None)
 
     # tic_temp = time.time()
     # Read in model output for index tind
     if z0 == 's': # read in less model output to begin with, to save time
-        u = nc.variables['u'][tind,zparuv,:,:] 
-        v = nc.variables['v'][tind,zparuv,:,:]
+        u = _readlevels(nc.variables['u'], tind, zparuv, (slice(j0,j1),slice(i0,i1-1)), raw)
+        v = _readlevels(nc.variables['v'], tind, zparuv, (slice(j0,j1-1),slice(i0,i1)), raw)
         if 'zeta' in nc.variables:
-            ssh = nc.variables['zeta'][tind,:,:] # [t,j,i], ssh in tracmass
+            ssh = _read(nc.variables['zeta'], (tind,slice(j0,j1),slice(i0,i1)), raw) # [t,j,i], ssh in tracmass
             sshread = True
         else:
             sshread = False
     else:
-        u = nc.variables['u'][tind,:,:,:] 
-        v = nc.variables['v'][tind,:,:,:]
+        u = _read(nc.variables['u'], (tind,ks,slice(j0,j1),slice(i0,i1-1)), raw)
+        v = _read(nc.variables['v'], (tind,ks,slice(j0,j1-1),slice(i0,i1)), raw)
         if 'zeta' in nc.variables:
-            ssh = nc.variables['zeta'][tind,:,:] # [t,j,i], ssh in tracmass
+            ssh = _read(nc.variables['zeta'], (tind,slice(j0,j1),slice(i0,i1)), raw) # [t,j,i], ssh in tracmass
             sshread = True
         else:
             sshread = False
 
-    h = grid['h'].T.copy(order='c')
+    h = grid['h'][i0:i1,j0:j1].T.copy(order='c')
     # Use octant to calculate depths for the appropriate vertical grid parameters
     # have to transform a few back to ROMS coordinates and python ordering for this
     if sshread:
@@ -527,12 +729,12 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
         zrt = octant.depths.get_zrho(grid['Vtransform'], grid['Vstretching'], grid['km'], grid['theta_s'], grid['theta_b'], 
                         h, grid['hc'], zeta=0, Hscale=3)
 
-    dzu = .5*(dzt[:,:,0:grid['imt']-1] + dzt[:,:,1:grid['imt']])
-    dzv = .5*(dzt[:,0:grid['jmt']-1,:] + dzt[:,1:grid['jmt'],:])
+    dzu = .5*(dzt[:,:,0:i1-i0-1] + dzt[:,:,1:i1-i0])
+    dzv = .5*(dzt[:,0:j1-j0-1,:] + dzt[:,1:j1-j0,:])
 
     # Change order back to ROMS/python for this calculation
-    dyu = grid['dyu'].T.copy(order='c')
-    dxv = grid['dxv'].T.copy(order='c')
+    dyu = grid['dyu'][i0:i1-1,j0:j1].T.copy(order='c')
+    dxv = grid['dxv'][i0:i1,j0:j1-1].T.copy(order='c')
 
     # I think I can avoid this loop for the isoslice case
     if z0 == None: # 3d case
@@ -543,20 +745,28 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
         vflux1 = v*dzv[zpar,:,:]*dxv
         dzt = dzt[zpar,:,:]
         zrt = zrt[zpar,:,:]
-    elif z0 == 'rho' or z0 == 'salt' or z0 == 'temp':
+    elif z0 == 'rho' or z0 == 'salt' or z0 == 'temp' or z0 == 'z':
         # the vertical setup we're selecting an isovalue of
-        vert = nc.variables[z0][tind,:,:,:]
-        # Calculate flux and then take slice
-        uflux1 = octant.tools.isoslice(u*dzu*dyu,op.resize(vert,2),zpar)
-        vflux1 = octant.tools.isoslice(v*dzv*dxv,op.resize(vert,1),zpar)
-        dzt = octant.tools.isoslice(dzt,vert,zpar)
-        zrt = octant.tools.isoslice(zrt,vert,zpar)
-    elif z0 == 'z':
-        # Calculate flux and then take slice
-        uflux1 = octant.tools.isoslice(u*dzu*dyu,op.resize(zrt,2),zpar)
-        vflux1 = octant.tools.isoslice(v*dzv*dxv,op.resize(zrt,1),zpar)
-        dzt = octant.tools.isoslice(dzt,zrt,zpar)
-        zrt = np.ones(uflux1.shape)*zpar # array of the input desired depth
+        if z0 == 'z':
+            vert = zrt[ks]
+        else:
+            vert = _read(nc.variables[z0], (tind,ks,slice(j0,j1),slice(i0,i1)), raw, np.nan)
+        # Find where the slice is on each grid once for each layer, then take slices
+        # of the fluxes (dyu and dxv don't change with depth, so they are put in after)
+        udz = u*dzu[ks]
+        vdz = v*dzv[ks]
+        slices = []
+        for iso in (zpar if layers is not None else [zpar]):
+            wu, masku = isoslice_weights(op.resize(vert,2), iso)
+            wv, maskv = isoslice_weights(op.resize(vert,1), iso)
+            wr, maskr = isoslice_weights(vert, iso)
+            dzslice = isoslice(dzt[ks], wr, maskr)
+            if z0 == 'z':
+                zslice = np.ones(dzslice.shape)*iso # array of the input desired depth
+            else:
+                zslice = isoslice(zrt[ks], wr, maskr)
+            slices.append((isoslice(udz, wu, masku)*dyu, isoslice(vdz, wv, maskv)*dxv, dzslice, zslice))
+        uflux1, vflux1, dzt, zrt = [_stack(f, layers, 0) for f in zip(*slices)]
 
     # Change all back to tracmass/fortran ordering if being used again
     # This is faster than copying arrays
@@ -571,7 +781,7 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
     zwt = np.asfortranarray(zwt.T)
 
     # make sure that all fluxes have a placeholder for depth
-    if is_string_like(z0):
+    if is_string_like(z0) and layers is None:
         uflux1 = uflux1.reshape(np.append(uflux1.shape,1))
         vflux1 = vflux1.reshape(np.append(vflux1.shape,1))
         dzt = dzt.reshape(np.append(dzt.shape,1))
@@ -579,10 +789,119 @@ def readfields(tind,grid,nc,z0=None, zpar=None, zparuv=None):
 
     return uflux1, vflux1, dzt, zrt, zwt
 
+def readfields_range(tinds, grid, nc, z0=None, zpar=None, zparuv=None, kband=None, raw=False):
+    '''
+    Read in model output for many time indices at once, with one read of each
+    variable for the whole range of time indices, and calculate the fluxes and z grid
+    properties for all of them together. This is faster than calling readfields for
+    each time index when the model output for a whole simulation is needed, as long
+    as it fits in memory.
+
+    Input:
+     tinds  Time indices for model output to read in, like those from setupROMSfiles
+     grid, nc, z0, zpar, zparuv, kband, raw As for readfields
+
+    Output:
+     fields Dictionary of {tind: (uflux1, vflux1, dzt, zrt, zwt)}, the same as what
+            readfields returns for tind
+    '''
+
+    if zparuv is None:
+        zparuv = zpar
+    layers = _layers(z0, zpar)
+    if layers is not None:
+        zpar = layers
+
+    # one hyperslab for all of the time indices
+    tinds = list(tinds)
+    tmin, tmax = min(tinds), max(tinds)
+    # stride that reaches all of them, also when some are missing from an even spacing
+    tstride = reduce(gcd, [abs(t1 - t0) for t0, t1 in zip(tinds[:-1], tinds[1:])], 0) or 1
+    tslice = slice(tmin, tmax+1, tstride)
+    it = [(tind - tmin)//tstride for tind in tinds] # tinds in the hyperslab
+
+    # levels to read in, for an isoslice within a band of levels
+    if kband is not None and z0 in ['rho', 'salt', 'temp', 'z']:
+        ks = slice(kband[0], kband[1])
+    else:
+        ks = slice(None)
+
+    if z0 == 's': # read in less model output to begin with, to save time
+        u = _readlevels(nc.variables['u'], tslice, zparuv, (slice(None),slice(None)), raw)
+        v = _readlevels(nc.variables['v'], tslice, zparuv, (slice(None),slice(None)), raw)
+    else:
+        u = _read(nc.variables['u'], (tslice,ks,slice(None),slice(None)), raw)
+        v = _read(nc.variables['v'], (tslice,ks,slice(None),slice(None)), raw)
+    nt = u.shape[0]
+    if 'zeta' in nc.variables:
+        ssh = _read(nc.variables['zeta'], (tslice,slice(None),slice(None)), raw) # [t,j,i]
+    else: # if ssh isn't available, approximate as 0
+        ssh = np.zeros((nt, grid['jmt'], grid['imt']))
+
+    # Depths of s levels are linear in the free surface, z = z(0) + zeta*(1 + z(0)/h),
+    # for both ROMS vertical transforms, so they only need to be found once for zeta=0
+    h = grid['h'].T.copy(order='c')
+    zw0 = octant.depths.get_zw(grid['Vtransform'], grid['Vstretching'], grid['km']+1, grid['theta_s'], grid['theta_b'], 
+                    h, grid['hc'], zeta=0, Hscale=3)
+    zr0 = octant.depths.get_zrho(grid['Vtransform'], grid['Vstretching'], grid['km'], grid['theta_s'], grid['theta_b'], 
+                    h, grid['hc'], zeta=0, Hscale=3)
+    ssh = np.asarray(np.ma.filled(ssh, 0.))[:,np.newaxis,:,:]
+    zwt = zw0 + ssh*(1 + zw0/h) # [t,k,j,i]
+    zrt = zr0 + ssh*(1 + zr0/h)
+    dzt = zwt[:,1:,:,:] - zwt[:,:-1,:,:]
+    dzu = .5*(dzt[:,:,:,:-1] + dzt[:,:,:,1:])
+    dzv = .5*(dzt[:,:,:-1,:] + dzt[:,:,1:,:])
+
+    dyu = grid['dyu'].T.copy(order='c')
+    dxv = grid['dxv'].T.copy(order='c')
+
+    # vertical is the first dimension for isoslice
+    if z0 == None: # 3d case
+        uflux1 = u*dzu*dyu
+        vflux1 = v*dzv*dxv
+    elif z0 == 's': # want a specific s level zpar
+        uflux1 = u*dzu[:,zpar,:,:]*dyu
+        vflux1 = v*dzv[:,zpar,:,:]*dxv
+        dzt = dzt[:,zpar,:,:]
+        zrt = zrt[:,zpar,:,:]
+    elif z0 == 'rho' or z0 == 'salt' or z0 == 'temp' or z0 == 'z':
+        # the vertical setup we're selecting an isovalue of
+        if z0 == 'z':
+            vert = np.rollaxis(zrt[:,ks], 1)
+        else:
+            vert = np.rollaxis(_read(nc.variables[z0], (tslice,ks,slice(None),slice(None)), raw, np.nan), 1)
+        udz = np.rollaxis(u*dzu[:,ks], 1)
+        vdz = np.rollaxis(v*dzv[:,ks], 1)
+        slices = []
+        for iso in (zpar if layers is not None else [zpar]):
+            wu, masku = isoslice_weights(op.resize(vert,3), iso)
+            wv, maskv = isoslice_weights(op.resize(vert,2), iso)
+            wr, maskr = isoslice_weights(vert, iso)
+            dzslice = isoslice(np.rollaxis(dzt[:,ks], 1), wr, maskr)
+            if z0 == 'z':
+                zslice = np.ones(dzslice.shape)*iso # array of the input desired depth
+            else:
+                zslice = isoslice(np.rollaxis(zrt[:,ks], 1), wr, maskr)
+            slices.append((isoslice(udz, wu, masku)*dyu, isoslice(vdz, wv, maskv)*dxv, dzslice, zslice))
+        uflux1, vflux1, dzt, zrt = [_stack(f, layers, 1) for f in zip(*slices)]
+
+    # Split up by time index, in tracmass/fortran ordering as from readfields.
+    # Each is copied so that it doesn't keep the arrays for the other times in memory.
+    fields = {}
+    for tind, i in zip(tinds, it):
+        f = [uflux1[i].T.copy(order='f'), vflux1[i].T.copy(order='f'), np.array(dzt[i].T, order='f'),
+                np.array(zrt[i].T, order='f'), np.array(zwt[i].T, order='f')]
+        if is_string_like(z0) and layers is None: # placeholder for depth
+            for j in xrange(4):
+                f[j] = f[j].reshape(np.append(f[j].shape,1), order='f')
+        fields[tind] = tuple(f)
+
+    return fields
+
 def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
                 ahin, avin, do3din, doturbin, locin, 
                 doperiodicin, time_unitsin, T0in=None, Uin=None, Vin=None,
-                savell=True):
+                savell=True, usefloat32=False, counts=None, layers=None):
     """
     Save tracks that have been calculated by tracmass into a netcdf file.
 
@@ -591,6 +910,13 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         tpin                Time vector for drifters [drifter x time]
         name                Name of simulation, to use for saving file
         savell              Whether saving in latlon (True) or grid coords (False). Default True.
+        usefloat32          Whether to save drifter positions in single precision (True) or
+                            double precision (False). Times are always saved in double
+                            precision. Default False.
+        counts              Kernel counters for each drifter [drifter x 4], from a run 
+                            with docounters=1, to save too. Default None.
+        layers              zpar of the layer of each drifter [drifter], from a run with
+                            a list of zpar, to save too. Default None.
     """
 
     # name for ll is basic, otherwise add 'gc' to indicate as grid indices
@@ -646,13 +972,19 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         rootgrp.createDimension('xvl',xvl)
         rootgrp.createDimension('yvl',yvl)
 
+    # floating point type for drifter positions
+    if usefloat32:
+        ftype = 'f4'
+    else:
+        ftype = 'f8'
+
     # save githash as global attribute
     rootgrp.git_hash = git_hash_in
 
     # Do the rest of this by variable so they can be deleted as I go for memory.
     if savell: # if saving in latlon
         # Create variable
-        lonp = rootgrp.createVariable('lonp','f8',('ntrac','nt'), zlib=True) # 64-bit floating point, with lossless compression
+        lonp = rootgrp.createVariable('lonp',ftype,('ntrac','nt'), zlib=True) # floating point, with lossless compression
         # Set some attributes
         lonp.long_name = 'longitudinal position of drifter'
         lonp.units = 'degrees'
@@ -662,7 +994,7 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         # Delete to save space
         del(xin)
 
-        latp = rootgrp.createVariable('latp','f8',('ntrac','nt'), zlib=True) # 64-bit floating point, with lossless compression
+        latp = rootgrp.createVariable('latp',ftype,('ntrac','nt'), zlib=True) # floating point, with lossless compression
         latp.long_name = 'latitudinal position of drifter'
         latp.units = 'degrees'
         latp.time = 'tp'
@@ -670,7 +1002,7 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         del(yin)
     else: # then saving in grid coordinates
         # Create variable
-        xg = rootgrp.createVariable('xg','f8',('ntrac','nt'), zlib=True) # 64-bit floating point, with lossless compression
+        xg = rootgrp.createVariable('xg',ftype,('ntrac','nt'), zlib=True) # floating point, with lossless compression
         # Set some attributes
         xg.long_name = 'x grid position of drifter'
         xg.units = 'grid units'
@@ -680,7 +1012,7 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         # Delete to save space
         del(xin)
 
-        yg = rootgrp.createVariable('yg','f8',('ntrac','nt'), zlib=True) # 64-bit floating point, with lossless compression
+        yg = rootgrp.createVariable('yg',ftype,('ntrac','nt'), zlib=True) # floating point, with lossless compression
         yg.long_name = 'y grid position of drifter'
         yg.units = 'grid units'
         yg.time = 'tp'
@@ -689,7 +1021,7 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
 
 
     if do3din:
-        zp = rootgrp.createVariable('zp','f8',('ntrac','nt'), zlib=True) # 64-bit floating point, with lossless compression
+        zp = rootgrp.createVariable('zp',ftype,('ntrac','nt'), zlib=True) # floating point, with lossless compression
         zp.long_name = 'vertical position of drifter (negative is downward from surface)'
         zp.units = 'meter'
         zp.time = 'tp'
@@ -719,6 +1051,25 @@ def savetracks(xin, yin ,zpin, tpin, name, nstepsin, Nin, ffin, tseasin,
         V[:] = Vin
         del(T0in,Uin,Vin)
 
+    if counts is not None:
+        ncross = rootgrp.createVariable('ncross','i4',('ntrac'), zlib=True)
+        niter = rootgrp.createVariable('niter','i4',('ntrac'), zlib=True)
+        nretry = rootgrp.createVariable('nretry','i4',('ntrac'), zlib=True)
+        errcode = rootgrp.createVariable('errcode','i4',('ntrac'), zlib=True)
+        ncross.long_name = 'number of grid cell crossings of drifter in TRACMASS'
+        niter.long_name = 'number of iterations for drifter in TRACMASS'
+        nretry.long_name = 'number of extra tries to find a diffusion displacement within the model area in TRACMASS'
+        errcode.long_name = 'TRACMASS error code that stopped drifter, 0 if none'
+        ncross[:] = counts[:,0]
+        niter[:] = counts[:,1]
+        nretry[:] = counts[:,2]
+        errcode[:] = counts[:,3]
+
+    if layers is not None:
+        zpar = rootgrp.createVariable('zpar','f8',('ntrac'), zlib=True)
+        zpar.long_name = 'isoslice value of the layer of drifter'
+        zpar[:] = layers
+
     # Create variables
     # Main track information
     # Include other run details
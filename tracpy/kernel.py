@@ -0,0 +1,537 @@
+"""
+The TRACMASS kernel, tracmass.step, and the backends for stepping drifters.
+
+f2py silently makes a Fortran-ordered copy of every array argument that is
+not Fortran-contiguous or not of the type declared in step.f95, on every
+call. These functions prepare the arguments so that they can be handed over
+without a copy, and can optionally complain when a copy would have been made.
+
+Drifters are stepped by a backend, chosen with Tracpy(backend=...). The
+backends take the same arguments as tracmass.step:
+    FortranBackend  the compiled TRACMASS kernel (tracmass or tracmass32)
+    NumpyBackend    the same analytic cell-crossing scheme, vectorized in
+                    numpy over all drifters at once, which doesn't need the
+                    compiled kernel
+
+Contains:
+    fortran_arg
+    grid_args
+    calc_wflux
+    calc_dxyz
+    FortranBackend
+    NumpyBackend
+    get_backend
+"""
+
+import numpy as np
+import warnings
+try:
+    import tracmass
+except ImportError: # kernel hasn't been built, so only NumpyBackend can be used
+    tracmass = None
+try:
+    import tracmass32
+except ImportError: # single precision kernel is only built on request, with make f2py32
+    tracmass32 = None
+
+# numpy types matching the declarations in step.f95
+inttype = np.intc # integer
+realtype = np.float64 # real*8
+
+# what is counted in the columns of the counts argument for docounters=1
+counternames = ['cell crossings', 'iterations', 'diffusion retries', 'error code']
+
+def fortran_arg(name, arr, dtype=realtype, checkcopies=None):
+    '''
+    Make sure that an array can be passed to the kernel without a copy by f2py.
+
+    Input:
+     name           Name of the argument, for messages
+     arr            Array that will be passed to the kernel
+     dtype          numpy type the kernel expects for this argument
+     checkcopies    (None) What to do if arr would have been copied by f2py:
+                    None to convert it quietly, 'warn' to convert it and warn about it,
+                    'raise' to raise a ValueError instead.
+
+    Output:
+     arr            Fortran-contiguous array of type dtype. This is the input array
+                    itself if it was already fine.
+    '''
+
+    if arr.dtype == dtype and arr.flags['F_CONTIGUOUS']:
+        return arr
+
+    msg = 'kernel argument %s (%s, F_CONTIGUOUS=%s) would be copied by f2py to %s' \
+            % (name, arr.dtype, arr.flags['F_CONTIGUOUS'], np.dtype(dtype))
+    if checkcopies == 'raise':
+        raise ValueError(msg)
+    elif checkcopies == 'warn':
+        warnings.warn(msg)
+
+    return np.asfortranarray(arr, dtype=dtype)
+
+def grid_args(grid):
+    '''
+    Convert the static grid arrays that are sent to the kernel on every call
+    to the types and ordering that step.f95 expects. This should be done once
+    when the grid is read in, instead of in every call to the kernel.
+
+    Input:
+     grid       Dictionary containing all necessary time-independent grid fields
+
+    Output:
+     gridargs   Dictionary of kmt, dxdy, dxv, dyu and h, ready for tracmass.step
+    '''
+
+    gridargs = {'kmt': np.asfortranarray(grid['kmt'], dtype=inttype)}
+    for key in ['dxdy', 'dxv', 'dyu', 'h']:
+        gridargs[key] = np.asfortranarray(grid[key], dtype=realtype)
+
+    return gridargs
+
+def calc_wflux(uf, vf, ff, wf=None):
+    '''
+    Calculate the vertical volume fluxes for one time slab of the horizontal
+    fluxes, for use with doprecompute=1 in the kernel. This integrates
+    continuity up from the bottom the same way as vertvel.f95 does for a
+    single column, but for all columns at once.
+
+    Input:
+     uf     Zonal volume fluxes [imt-1,jmt,km]
+     vf     Meridional volume fluxes [imt,jmt-1,km]
+     ff     Time direction, 1 forward and -1 backward
+     wf     (None) Optional array [imt,jmt,km+1] to store the result in
+
+    Output:
+     wf     Vertical volume fluxes on the cell faces [imt,jmt,km+1], from
+            the bottom of the water column. Zero in the boundary cells,
+            which drifters are stopped in before they are used.
+    '''
+
+    imt, jmt, km = vf.shape[0], uf.shape[1], uf.shape[2]
+    if wf is None:
+        wf = np.zeros((imt, jmt, km+1), order='F')
+    else:
+        wf[:] = 0.
+
+    # flux divergence of the interior cells, summed in the same order as vertvel
+    div = uf[1:,1:-1,:] - uf[:-1,1:-1,:] + vf[1:-1,1:,:] - vf[1:-1,:-1,:]
+    np.cumsum((-ff*div).astype(realtype), axis=2, out=wf[1:-1,1:-1,1:])
+
+    return wf
+
+def calc_dxyz(dzt, dxdy):
+    '''
+    Calculate the grid cell volumes for one time slab of the layer
+    thicknesses, for use with doprecompute=1 in the kernel.
+
+    Input:
+     dzt    Layer thicknesses [imt,jmt,km]
+     dxdy   Horizontal cell areas [imt,jmt]
+
+    Output:
+     dxyz   Grid cell volumes [imt,jmt,km]
+    '''
+
+    return np.asfortranarray(dzt*dxdy[:,:,np.newaxis], dtype=realtype)
+
+class FortranBackend(object):
+    '''
+    Step drifters with the compiled TRACMASS kernel.
+    '''
+
+    name = 'fortran'
+
+    def __init__(self, usefloat32=False):
+        '''
+        :param usefloat32=False: True to use the single precision kernel tracmass32, for
+               fields stored in single precision.
+        '''
+
+        if usefloat32:
+            if tracmass32 is None:
+                raise ImportError('usefloat32=True requires the single precision kernel tracmass32. Build it with make f2py32 in src.')
+            self.module = tracmass32
+        else:
+            if tracmass is None:
+                raise ImportError('The fortran backend requires the TRACMASS kernel tracmass. Build it with make f2py in src, or use the numpy backend.')
+            self.module = tracmass
+
+    def step(self, xstart, ystart, zstart, tseas, uf, vf, ta, tb, ff, kmt, dzt, dxdy, dxv, dyu, h, 
+            xend, yend, zend, flag, ttend, iter, ah, av, do3d, doturb, doperiodic, dostream, 
+            doprecompute, wft, dxyzt, docounters, counts, maxiter, T0=None, U=None, V=None):
+        '''
+        Step drifters through the time window [ta, tb]. The arguments are those of 
+        tracmass.step, see step.f95. xend, yend, zend, flag, ttend and counts are 
+        written in place.
+
+        Output:
+         U, V       Stream function transports, added to the input U, V if given
+        '''
+
+        if T0 is not None:
+            return self.module.step(xstart, ystart, zstart, tseas, uf, vf, ta, tb, ff, 
+                                    kmt, dzt, dxdy, dxv, dyu, h, xend, yend, zend, flag, ttend, 
+                                    iter, ah, av, do3d, doturb, doperiodic, dostream, 
+                                    doprecompute, wft, dxyzt, docounters, counts, maxiter, 
+                                    t0=T0, ut=U, vt=V)
+        else:
+            return self.module.step(xstart, ystart, zstart, tseas, uf, vf, ta, tb, ff, 
+                                    kmt, dzt, dxdy, dxv, dyu, h, xend, yend, zend, flag, ttend, 
+                                    iter, ah, av, do3d, doturb, doperiodic, dostream, 
+                                    doprecompute, wft, dxyzt, docounters, counts, maxiter)
+
+
+UNDEF = 1.e20 # as in the kernel, for no crossing
+
+def _cross(r0, ii, uu, um):
+    '''
+    Times for drifters at r0 to cross the walls ii (sp) and ii-1 (sn) of their grid 
+    cells, given the transports uu and um through those walls, as in cross.f95. 
+    UNDEF if a wall isn't crossed.
+    '''
+
+    sp = np.empty(r0.size); sp.fill(UNDEF)
+    sn = np.empty(r0.size); sn.fill(UNDEF)
+    same = um == uu
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ind = (uu > 0.) & (r0 != ii)
+        ba = (r0 + (-ii + 1.))*(uu - um) + um # linear interpolation of the transport
+        i = ind & ~same & (ba > 0.)
+        sp[i] = (np.log(ba[i]) - np.log(uu[i]))/(um[i] - uu[i])
+        i = ind & same
+        sp[i] = (ii[i] - r0[i])/uu[i]
+        sp[sp <= 0.] = UNDEF
+
+        ind = (um < 0.) & (r0 != ii - 1)
+        ba = -((r0 - ii)*(uu - um) + uu)
+        i = ind & ~same & (ba > 0.)
+        sn[i] = (np.log(ba[i]) - np.log(-um[i]))/(um[i] - uu[i])
+        i = ind & same
+        sn[i] = (ii[i] - 1. - r0[i])/uu[i]
+        sn[sn <= 0.] = UNDEF
+
+    return sp, sn
+
+def _pos_orgn(r0, ii, uu, um, ds):
+    '''
+    Position after time ds of drifters starting at r0 in grid cells with walls ii-1 and
+    ii, given the transports um and uu through those walls, as in pos.f95.
+    '''
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        r1 = (r0 + (-(ii - 1.) + um/(uu - um)))*np.exp((uu - um)*ds) + (ii - 1.) - um/(uu - um)
+    same = um == uu
+    r1[same] = r0[same] + uu[same]*ds[same]
+
+    return r1
+
+class NumpyBackend(object):
+    '''
+    Step drifters with a numpy version of the TRACMASS kernel, for when the compiled
+    kernel isn't available or to compare against it. All drifters are moved together,
+    one iteration of the kernel at a time, until they are all done. This follows 
+    step.f95, cross.f95, calc_time.f95, loop_pos.f95 and pos.f95 in the same order 
+    of operations, so results agree with the compiled kernel to round-off.
+
+    Turbulence and diffusion (doturb!=0) and periodic boundary conditions are not
+    available in this backend.
+    '''
+
+    name = 'numpy'
+
+    def __init__(self, usefloat32=False):
+        '''
+        :param usefloat32=False: Not needed, since fields of either precision can be used.
+        '''
+
+        pass
+
+    def step(self, xstart, ystart, zstart, tseas, uf, vf, ta, tb, ff, kmt, dzt, dxdy, dxv, dyu, h, 
+            xend, yend, zend, flag, ttend, iter, ah, av, do3d, doturb, doperiodic, dostream, 
+            doprecompute, wft, dxyzt, docounters, counts, maxiter, T0=None, U=None, V=None):
+        '''
+        Step drifters through the time window [ta, tb]. The arguments are those of 
+        tracmass.step, see step.f95, with the same (Fortran) grid index conventions. 
+        xend, yend, zend, flag, ttend and counts are written in place.
+
+        Output:
+         U, V       Stream function transports, added to the input U, V if given
+        '''
+
+        if doturb != 0:
+            raise NotImplementedError('doturb=%d is not available in the numpy backend' % doturb)
+        if doperiodic != 0:
+            raise NotImplementedError('doperiodic=%d is not available in the numpy backend' % doperiodic)
+
+        imt, jmt, km = dzt.shape[:3]
+        ntrac, N = xend.shape
+        dstep = 1./iter
+        dtmin = dstep*tseas
+
+        if U is None:
+            U = np.zeros((imt-1, jmt), order='F')
+        if V is None:
+            V = np.zeros((imt, jmt-1), order='F')
+
+        # vertical fluxes on the cell faces, for both times, as vertvel.f95 calculates them
+        if do3d == 1:
+            if doprecompute == 1:
+                wf = wft
+            else:
+                wf = np.zeros((imt, jmt, km+1, 2), order='F')
+                for n in xrange(2):
+                    calc_wflux(uf[:,:,:,n], vf[:,:,:,n], ff, wf=wf[:,:,:,n])
+
+        # Drifter state, with grid indices as in the kernel, starting from 1
+        x1 = np.array(xstart, dtype=np.float64)
+        y1 = np.array(ystart, dtype=np.float64)
+        z1 = np.array(zstart, dtype=np.float64)
+        ib = np.ceil(x1).astype(int)
+        jb = np.ceil(y1).astype(int)
+        kb = np.ceil(z1).astype(int)
+        tt = np.zeros(ntrac) # time of trajectory in seconds
+        ts = np.zeros(ntrac) # model dataset time step of trajectory
+        tss = np.zeros(ntrac)
+        Ni = np.ones(ntrac, dtype=int) # counter for when to write to file
+        niter = np.zeros(ntrac, dtype=int)
+        dsc = np.empty(ntrac); dsc.fill(UNDEF)
+        flag[:] = 0
+
+        active = np.arange(ntrac)
+        while active.size > 0:
+
+            a = active
+            niter[a] += 1
+            if docounters == 1:
+                counts[a,1] += 1
+
+            rr = 1. - (ta + ts[a]*(tb - ta)) # time interpolation weight of the earlier fields
+            rg = 1. - rr
+            x0, y0, z0 = x1[a], y1[a], z1[a]
+            ia, ja, ka = ib[a], jb[a], kb[a]
+            # zero-based indices for the flux arrays
+            i, j, k = ia - 1, ja - 1, ka - 1
+            errcode = np.zeros(a.size, dtype=int)
+
+            # grid box volume
+            if doprecompute == 1:
+                dxyz = rg*dxyzt[i,j,k,1] + rr*dxyzt[i,j,k,0]
+            else:
+                dxyz = (rg*dzt[i,j,k,1] + rr*dzt[i,j,k,0])*dxdy[i,j]
+            errcode[dxyz == 0.] = -39
+
+            if (((ia-1) > x0) | (ia < x0) | ((ja-1) > y0) | (ja < y0) \
+                    | (((ka-1) > z0) & (ka != km)) | (ka < z0)).any():
+                raise RuntimeError('Particle overshoot out of its grid box')
+
+            # iteration budget used up, so hold the drifters where they are for this call
+            over = np.where(niter[a] > maxiter)[0]
+            errcode[over] = -48
+            for n in over:
+                xend[a[n],Ni[a[n]]-1:] = x0[n]
+                yend[a[n],Ni[a[n]]-1:] = y0[n]
+                zend[a[n],Ni[a[n]]-1:] = z0[n]
+                ttend[a[n],Ni[a[n]]-1:] = (tseas/N)*np.arange(Ni[a[n]], N+1)*ff
+
+            dxyz[errcode != 0] = 1. # these are dropped below, avoid dividing by zero
+            dsmin = dtmin/dxyz
+
+            # crossing times for the walls of the grid cells
+            uu = (rg*uf[i,j,k,1] + rr*uf[i,j,k,0])*ff
+            um = (rg*uf[i-1,j,k,1] + rr*uf[i-1,j,k,0])*ff
+            dse, dsw = _cross(x0, ia, uu, um)
+            uu = (rg*vf[i,j,k,1] + rr*vf[i,j,k,0])*ff
+            um = (rg*vf[i,j-1,k,1] + rr*vf[i,j-1,k,0])*ff
+            dsn, dss = _cross(y0, ja, uu, um)
+            if do3d == 1:
+                uu = rg*wf[i,j,ka,1] + rr*wf[i,j,ka,0]
+                um = rg*wf[i,j,ka-1,1] + rr*wf[i,j,ka-1,0]
+                dsu, dsd = _cross(z0, ka, uu, um)
+            else:
+                dsu = np.empty(a.size); dsu.fill(UNDEF)
+                dsd = dsu.copy()
+            ds = np.minimum(np.minimum(np.minimum(dse, dsw), np.minimum(dsn, dss)), 
+                            np.minimum(np.minimum(dsu, dsd), dsmin))
+            errcode[(errcode == 0) & ((ds == UNDEF) | (ds == 0.))] = -56 # can't find any path
+
+            # calc_time: time step, and time at the end of the step
+            dt = np.where(ds == dsmin, dtmin, ds*dxyz)
+            tta, tsa, tssa, dsca = tt[a], ts[a], tss[a], dsc[a]
+            end = tssa + dt/tseas*iter >= iter # reaches the end of the time window
+            ok = errcode == 0
+            if (dt[ok] < 0.).any():
+                raise RuntimeError('Negative time step in calc_time')
+            ie = end
+            dt[ie] = (np.trunc(tsa[ie]) + 1.)*tseas - tta[ie]
+            tta[ie] = (np.trunc(tsa[ie]) + 1.)*tseas
+            tsa[ie] = np.trunc(tsa[ie]) + 1.
+            tssa[ie] = iter
+            ds[ie] = dt[ie]/dxyz[ie]
+            dsca[ie] = ds[ie]
+            ie = ~end
+            tta[ie] = tta[ie] + dt[ie]
+            full = ie & (dt == dtmin)
+            tsa[full] = tsa[full] + dstep
+            tssa[full] = tssa[full] + 1.
+            part = ie & (dt != dtmin)
+            tsa[part] = tsa[part] + dt[part]/tseas
+            tssa[part] = tssa[part] + dt[part]/tseas*iter
+            rb = 1. - (ta + tsa*(tb - ta))
+            rbg = 1. - rb
+
+            # pos: new positions and grid cells
+            xo = _pos_orgn(x0, ia, (rg*uf[i,j,k,1] + rr*uf[i,j,k,0])*ff, 
+                                (rg*uf[i-1,j,k,1] + rr*uf[i-1,j,k,0])*ff, ds)
+            yo = _pos_orgn(y0, ja, (rg*vf[i,j,k,1] + rr*vf[i,j,k,0])*ff, 
+                                (rg*vf[i,j-1,k,1] + rr*vf[i,j-1,k,0])*ff, ds)
+            if do3d == 1:
+                zo = _pos_orgn(z0, ka, rg*wf[i,j,ka,1] + rr*wf[i,j,ka,0], 
+                                    rg*wf[i,j,ka-1,1] + rr*wf[i,j,ka-1,0], ds)
+            else:
+                zo = z0.copy()
+            xn, yn, zn = x0.copy(), y0.copy(), z0.copy()
+            ibn, jbn, kbn = ia.copy(), ja.copy(), ka.copy()
+
+            left = np.ones(a.size, dtype=bool)
+            c = left & (ds == dse) # eastward grid-cell exit
+            left &= ~c
+            ibn[c & ((rbg*uf[i,j,k,1] + rb*uf[i,j,k,0])*ff > 0.)] += 1
+            xn[c] = ia[c]; yn[c] = yo[c]; zn[c] = zo[c]
+            c = left & (ds == dsw) # westward grid-cell exit
+            left &= ~c
+            ibn[c & ((rbg*uf[i-1,j,k,1] + rb*uf[i-1,j,k,0])*ff < 0.)] -= 1
+            xn[c] = ia[c] - 1; yn[c] = yo[c]; zn[c] = zo[c]
+            c = left & (ds == dsn) # northward grid-cell exit
+            left &= ~c
+            jbn[c & ((rbg*vf[i,j,k,1] + rb*vf[i,j,k,0])*ff > 0.)] += 1
+            yn[c] = ja[c]; xn[c] = xo[c]; zn[c] = zo[c]
+            c = left & (ds == dss) # southward grid-cell exit
+            left &= ~c
+            jbn[c & ((rbg*vf[i,j-1,k,1] + rb*vf[i,j-1,k,0])*ff < 0.)] -= 1
+            yn[c] = ja[c] - 1; xn[c] = xo[c]; zn[c] = zo[c]
+            if do3d == 1:
+                c = left & (ds == dsu) # upward grid-cell exit
+                left &= ~c
+                kbn[c & (rbg*wf[i,j,ka,1] + rb*wf[i,j,ka,0] > 0.)] += 1
+                zn[c] = ka[c]; xn[c] = xo[c]; yn[c] = yo[c]
+                surf = c & (kbn == km+1) # prevent evaporation
+                kbn[surf] = km
+                zn[surf] = km - 0.5
+                c = left & (ds == dsd) # downward grid-cell exit
+                left &= ~c
+                kbn[c & (rbg*wf[i,j,ka-1,1] + rb*wf[i,j,ka-1,0] < 0.)] -= 1
+                zn[c] = ka[c] - 1; xn[c] = xo[c]; yn[c] = yo[c]
+            c = left & ((ds == dsca) | (ds == dsmin)) # time step ends inside the grid cell
+            xn[c] = xo[c]; yn[c] = yo[c]; zn[c] = zo[c]
+
+            # make sure that the drifters are inside their grid cells
+            c = xn != np.trunc(xn)
+            ibn[c] = np.trunc(xn[c]).astype(int) + 1
+            c = yn != np.trunc(yn)
+            jbn[c] = np.trunc(yn[c]).astype(int) + 1
+
+            if docounters == 1:
+                ok = errcode == 0
+                counts[a[ok],0] += ((ibn != ia) | (jbn != ja) | (kbn != ka))[ok]
+
+            leaving = (ibn > imt) | (jbn > jmt) | (ibn < 1) | (jbn < 1)
+            errcode[(errcode == 0) & leaving] = -50
+
+            # put drifters above sea level back in the shallowest layer, and
+            # set the right level for the depth
+            c = zn >= km
+            zn[c] = km - 0.5
+            kbn[c] = km
+            c = zn != np.trunc(zn)
+            kbn[c] = np.trunc(zn[c]).astype(int) + 1
+            kbn[kbn == km+1] = km
+
+            # corner problems, which should really not happen at all
+            corner = (xn == np.trunc(xn)) & (yn == np.trunc(yn)) & (errcode == 0)
+            for n in np.where(corner)[0]:
+                print 'corner problem'
+                if ds[n] == dse[n] or ds[n] == dsw[n]:
+                    if yn[n] != y0[n]:
+                        yn[n] = y0[n]; jbn[n] = ja[n]
+                    else:
+                        yn[n] = jbn[n] - 0.5
+                elif ds[n] == dsn[n] or ds[n] == dss[n]:
+                    if yn[n] != y0[n]:
+                        xn[n] = x0[n]; ibn[n] = ia[n]
+                    else:
+                        xn[n] = ibn[n] - 0.5
+                else:
+                    xn[n] = ibn[n] - 0.5
+                    yn[n] = jbn[n] - 0.5
+
+            # drifters that stop for errors
+            err = errcode != 0
+            flag[a[err & (errcode != -48)]] = 1
+            flag[a[errcode == -48]] = 2
+            if docounters == 1:
+                counts[a[err],3] = errcode[err]
+
+            # drifters that exit the domain
+            exit = ~err & ((xn <= 1.) | (xn >= imt-1) | (yn <= 1.) | (yn >= jmt-1))
+            flag[a[exit]] = 1
+
+            # Add initial volume transport of drifters that just crossed a wall
+            go = ~err & ~exit
+            if dostream == 1:
+                ix0, ix1 = np.trunc(x0), np.trunc(xn)
+                iy0, iy1 = np.trunc(y0), np.trunc(yn)
+                c = go & (ix1 > ix0)
+                np.add.at(U, (i[c], j[c]), T0[a[c]])
+                c2 = go & ~c & (ix1 < ix0)
+                np.add.at(U, (i[c2]-1, j[c2]), -T0[a[c2]])
+                c3 = go & ~c & ~c2 & (iy1 > iy0)
+                np.add.at(V, (i[c3], j[c3]), T0[a[c3]])
+                c4 = go & ~c & ~c2 & ~c3 & (iy1 < iy0)
+                np.add.at(V, (i[c4], j[c4]-1), -T0[a[c4]])
+
+            # write out drifters that passed an output time, or several, when an 
+            # iteration is longer than the time between outputs
+            while True:
+                Nia = Ni[a]
+                w = go & (Nia <= N) & (tta/tseas >= Nia/float(N))
+                if not w.any():
+                    break
+                rwn = 1. - (((tseas/N)*Nia[w] - (tta[w] - dt[w]))/dt[w])
+                rwp = 1. - rwn
+                xend[a[w],Nia[w]-1] = rwn*x0[w] + rwp*xn[w]
+                yend[a[w],Nia[w]-1] = rwn*y0[w] + rwp*yn[w]
+                zend[a[w],Nia[w]-1] = rwn*z0[w] + rwp*zn[w]
+                ttend[a[w],Nia[w]-1] = (rwn*(tta[w] - dt[w]) + rwp*tta[w])*ff
+                Ni[a[w]] += 1
+
+            # save the state of the drifters, and stop the ones that are done
+            x1[a], y1[a], z1[a] = xn, yn, zn
+            ib[a], jb[a], kb[a] = ibn, jbn, kbn
+            tt[a], ts[a], tss[a], dsc[a] = tta, tsa, tssa, dsca
+            done = err | exit | (tta >= tseas)
+            active = a[~done]
+
+        return U, V
+
+# backends by name, for Tracpy(backend=...)
+backends = {'fortran': FortranBackend, 'numpy': NumpyBackend}
+
+def get_backend(backend, usefloat32=False):
+    '''
+    Find the backend for stepping drifters.
+
+    Input:
+     backend        Name of the backend in backends ('fortran' or 'numpy'), or an 
+                    object with a step method taking the arguments of tracmass.step
+     usefloat32     (False) Whether the fields are stored in single precision
+
+    Output:
+     backend        Backend object
+    '''
+
+    if isinstance(backend, basestring):
+        return backends[backend](usefloat32=usefloat32)
+    else:
+        return backend
@@ -0,0 +1,98 @@
+"""
+Choosing how to run a simulation within a memory budget.
+
+A plan says
+    fields      'stream' to read in the model output for each step as it is needed,
+                or 'preload' to read in the model output for all of the steps at
+                the start and keep it in memory
+    tracks      'memory' to keep the drifter tracks in memory, or 'disk' to keep them
+                in temporary files that are memory-mapped
+    nbatches    Number of batches of drifters that are run through the time loop
+                one after the other, to bound the memory used for each step
+
+The plan for a Tracpy object comes from Tracpy.make_plan, which uses choose with
+Tracpy(memory_budget=...), and can be given outright with Tracpy(plan=...).
+
+Contains:
+    Plan
+    choose
+"""
+
+import numpy as np
+
+# Memory used in each step for each drifter, for the arrays in run.run and
+# Tracpy.step, per time in the output of a step (N) and otherwise.
+step_bytes_per_output = 12*8
+step_bytes = 10*8
+
+class Plan(object):
+    '''
+    How to run a simulation.
+    '''
+
+    def __init__(self, fields='stream', tracks='memory', nbatches=1, reason='default'):
+        '''
+        :param fields='stream': 'stream' or 'preload'
+        :param tracks='memory': 'memory' or 'disk'
+        :param nbatches=1: Number of batches of drifters
+        :param reason='default': Why this plan was chosen, for the log
+        '''
+
+        if fields not in ['stream', 'preload']:
+            raise ValueError("fields should be 'stream' or 'preload', not %s" % fields)
+        if tracks not in ['memory', 'disk']:
+            raise ValueError("tracks should be 'memory' or 'disk', not %s" % tracks)
+
+        self.fields = fields
+        self.tracks = tracks
+        self.nbatches = int(nbatches)
+        self.reason = reason
+
+    def __str__(self):
+        return 'fields: %s, tracks: %s, batches of drifters: %d (%s)' \
+                % (self.fields, self.tracks, self.nbatches, self.reason)
+
+def choose(est, budget):
+    '''
+    Choose a plan that fits in a memory budget.
+
+    Tracks are kept in memory if they fit along with the model fields and the
+    memory used in a step for all drifters. Otherwise they are kept on disk, and
+    the drifters are split into as many batches as are needed for the memory used
+    in a step to fit. Model output is preloaded if it fits in what is left.
+
+    Input:
+     est        From Tracpy.estimate
+     budget     Memory budget in bytes
+
+    Output:
+     plan       Plan
+    '''
+
+    # two time slabs of the model fields are always needed
+    fixed = est['fields_bytes']
+    work = est['ntrac']*(step_bytes_per_output*est['nt']/max(est['noutputs']-1, 1) + step_bytes)
+    preload = est['noutputs']*est['fields_bytes']/2
+
+    if fixed >= budget:
+        return Plan('stream', 'disk', 1, 'budget is smaller than the model fields, using as little memory as possible')
+
+    if fixed + est['tracks_bytes'] + work <= budget:
+        tracks = 'memory'
+        left = budget - fixed - est['tracks_bytes']
+    else:
+        tracks = 'disk'
+        left = budget - fixed
+
+    nbatches = int(min(np.ceil(work/float(left)), max(est['ntrac'], 1)))
+    left -= work/nbatches
+
+    if preload <= left:
+        fields = 'preload'
+    else:
+        fields = 'stream'
+
+    reason = 'budget %.1f MB: fields %.1f MB, tracks %.1f MB, steps %.1f MB, preloading %.1f MB' \
+                % (budget/1e6, fixed/1e6, est['tracks_bytes']/1e6, work/1e6, preload/1e6)
+
+    return Plan(fields, tracks, nbatches, reason)
@@ -0,0 +1,166 @@
+"""
+Reading in the model fields of upcoming steps in background threads while the
+drifters are being stepped, for model output where the time to wait for a read,
+like from a thredds server, is more than the time to transfer it.
+
+A Prefetcher reads ahead up to lookahead model outputs past the one that is being
+used. Adjacent time indices are read together, up to coalesce at a time, with one
+request for each variable (as in readfields_range), and up to workers of these
+reads are in flight at once, each with its own handle to the model output. Reads
+that fail are tried again after waiting backoff, 2*backoff, ... seconds. The fields
+that are read are also kept in tracpy.fieldcache.
+
+Prefetchers are made by Tracpy.prepare_for_model_run for Tracpy(prefetch=...).
+
+Contains:
+    Prefetcher
+"""
+
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+import tracpy
+import tracpy.inout
+import tracpy.fieldcache
+
+# Defaults for Prefetchers made by Tracpy
+workers = 4
+coalesce = 4
+retries = 3
+backoff = 1.
+
+class Prefetcher(object):
+    '''
+    Model fields for the time indices of a run, read in ahead of when they are used.
+    '''
+
+    def __init__(self, tp, tinds, lookahead, workers=workers, coalesce=coalesce, retries=retries,
+                    backoff=backoff, opener=None):
+        '''
+        :param tp: Tracpy object of the run
+        :param tinds: Time indices of the model output for the run, in the order they are used
+        :param lookahead: Number of model outputs to read ahead
+        :param workers=4: Maximum number of reads at once
+        :param coalesce=4: Maximum number of adjacent time indices to read at once
+        :param retries=3: Number of times to try a read again when it fails
+        :param backoff=1.: Seconds to wait before trying again the first time, doubled after that
+        :param opener=None: Function that opens tp.currents_filename, tracpy.inout.opendataset for None
+        '''
+
+        self.tp = tp
+        self.tinds = list(tinds)
+        self.lookahead = lookahead
+        self.coalesce = max(min(coalesce, lookahead), 1)
+        self.retries = retries
+        self.backoff = backoff
+        if opener is None:
+            opener = tracpy.inout.opendataset
+        self.opener = opener
+
+        self.pool = ThreadPool(workers)
+        self.reads = 0 # requests made, including retries
+        self.failures = 0
+        self._pending = {} # {tind: AsyncResult of the read with tind}
+        self._local = threading.local() # handle of each worker
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def _nc(self):
+        '''
+        Handle to the model output for this worker.
+        '''
+
+        nc = getattr(self._local, 'nc', None)
+        if nc is None:
+            nc = self.opener(self.tp.currents_filename)
+            self._local.nc = nc
+            with self._lock:
+                self._handles.append(nc)
+        return nc
+
+    def _drop(self):
+        '''
+        Close the handle of this worker, so that the next read opens a new one.
+        '''
+
+        nc = self._local.nc
+        self._local.nc = None
+        with self._lock:
+            self._handles.remove(nc)
+        try:
+            nc.close()
+        except RuntimeError: # it is broken anyway
+            pass
+
+    def _read(self, tinds):
+        '''
+        Read in the fields at tinds, in a worker.
+        '''
+
+        for attempt in xrange(self.retries + 1):
+            with self._lock:
+                self.reads += 1
+            try:
+                return tracpy.fieldcache.read_range(self.tp, tinds, self._nc())
+            except (RuntimeError, IOError):
+                with self._lock:
+                    self.failures += 1
+                if attempt == self.retries:
+                    raise
+                if getattr(self._local, 'nc', None) is not None:
+                    self._drop()
+                time.sleep(self.backoff*2**attempt)
+
+    def ahead(self, tind):
+        '''
+        Start reading in the model outputs after tind that aren't read in or being
+        read in yet, once there are enough of them to read together.
+        '''
+
+        i = self.tinds.index(tind) + 1
+        upcoming = self.tinds[i:i+self.lookahead]
+        new = [t for t in upcoming if t not in self._pending
+                and tracpy.fieldcache.key(self.tp, t) not in tracpy.fieldcache.cache]
+        if not new or (len(new) < self.coalesce and i + self.lookahead < len(self.tinds)):
+            return
+
+        # adjacent ones, evenly spaced, together
+        chunks = [[new[0]]]
+        for t in new[1:]:
+            chunk = chunks[-1]
+            if len(chunk) < self.coalesce and self.tinds.index(t) == self.tinds.index(chunk[-1]) + 1:
+                chunk.append(t)
+            else:
+                chunks.append([t])
+        for chunk in chunks:
+            result = self.pool.apply_async(self._read, (chunk,))
+            for t in chunk:
+                self._pending[t] = result
+
+    def get(self, tind):
+        '''
+        Fields at tind, waiting for them if they are being read in, and start reading
+        in the ones after it.
+
+        Output:
+         fields     (uflux1, vflux1, dzt, zrt, zwt) as from readfields, or None if tind
+                    wasn't read ahead
+        '''
+
+        self.ahead(tind)
+        result = self._pending.pop(tind, None)
+        if result is None:
+            return None
+        return result.get()[tind] # errors of the read are raised here
+
+    def close(self):
+        '''
+        Stop the reads that haven't started, wait for the others, and close the handles.
+        '''
+
+        self.pool.terminate()
+        self.pool.join()
+        self._pending = {}
+        for nc in self._handles:
+            nc.close()
+        self._handles = []
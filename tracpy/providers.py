@@ -0,0 +1,185 @@
+"""
+Providers of model fields, for running drifters on model output that isn't in
+files, like arrays that are already in memory or fields from an ocean model
+that tracpy is coupled to, without writing them to disk first.
+
+A provider is given to Tracpy in place of currents_filename. It has the times
+of the model outputs, in the time_units of the Tracpy object, and gives the
+fields for a time index with get_fields, which Tracpy.prepare_for_model_run and
+Tracpy.prepare_for_model_step use instead of reading them in with readfields.
+The grid has to come from grid_filename (with vert_filename, if the vertical
+grid isn't in the grid file) or be given with grid=.
+
+Providers:
+    NetCDFProvider      Model output files or thredds addresses, read in with readfields.
+                        Tracpy uses the location itself, so this is the same as giving it.
+    ArrayProvider       Arrays of u, v and optionally zeta and the isoslice property,
+                        in ROMS ordering [t,k,j,i]. The arrays aren't copied.
+    CallbackProvider    A function of the time index that returns those arrays for one
+                        time, or fluxes that are ready for the kernel.
+
+Fields from ArrayProvider and CallbackProvider are not kept in tracpy.fieldcache,
+are not preloaded or read ahead, and can't be used with tracpy.decompose. A
+CallbackProvider gives the fields for each time index only once, so the drifters
+can't be run in more than one batch with it, and runs with it aren't kept in
+tracpy.cache, since its fields can't be identified.
+
+Usage:
+    provider = tracpy.providers.ArrayProvider(ocean_time, u, v, zeta=zeta)
+    tp = Tracpy(provider, grid_filename=grid_filename, vert_filename=vert_filename)
+    lonp, latp, zp, t, T0, U, V = tracpy.run.run(tp, date, lon0, lat0)
+
+Contains:
+    Provider
+    NetCDFProvider
+    ArrayProvider
+    CallbackProvider
+"""
+
+import numpy as np
+from matplotlib.pyplot import is_string_like
+import tracpy
+import tracpy.cache
+import tracpy.inout
+import tracpy.handles
+import tracpy.fieldcache
+
+class Provider(object):
+    '''
+    Model fields at a series of times.
+    '''
+
+    # Whether get_fields can give the fields for a time index again, which runs of the
+    # drifters in batches (more than one for the plan of tracpy.run.run) need
+    replay = True
+
+    def times(self):
+        '''
+        Times of the model outputs, in the time_units of the Tracpy object.
+        '''
+
+        raise NotImplementedError
+
+    def get_fields(self, tp, tind):
+        '''
+        Fields for Tracpy object tp at time index tind.
+
+        Output:
+         fields     (uflux1, vflux1, dzt, zrt, zwt) as from readfields
+        '''
+
+        raise NotImplementedError
+
+    def fingerprint(self):
+        '''
+        What identifies the fields, for tracpy.cache, or None if they can't be identified.
+        '''
+
+        return None
+
+    def close(self):
+        '''
+        Let go of what the fields come from, at the end of a run.
+        '''
+
+        pass
+
+class NetCDFProvider(Provider):
+    '''
+    Model output in files, or on a thredds server.
+    '''
+
+    def __init__(self, loc):
+        '''
+        :param loc: Location of the model output, as for setupROMSfiles
+        '''
+
+        self.loc = loc
+        self.nc = None
+
+    def _nc(self):
+        if self.nc is None:
+            self.nc = tracpy.handles.acquire(self.loc)
+        return self.nc
+
+    def times(self):
+        return self._nc().variables['ocean_time'][:]
+
+    def get_fields(self, tp, tind):
+        return tracpy.fieldcache.read(tp, tind, self._nc())
+
+    def fingerprint(self):
+        return tracpy.cache.fingerprint(self.loc)
+
+    def close(self):
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+class ArrayProvider(Provider):
+    '''
+    Model output in arrays, in ROMS ordering.
+    '''
+
+    def __init__(self, times, u, v, zeta=None, **tracers):
+        '''
+        :param times: Times of the model outputs [t]
+        :param u: Zonal velocity [t,k,j,i-1] (m/s)
+        :param v: Meridional velocity [t,k,j-1,i] (m/s)
+        :param zeta=None: Free surface [t,j,i] (m), or None for 0
+        :param tracers: Other fields [t,k,j,i] by name, like salt=salt for isoslices of salt
+        '''
+
+        self.time = np.asarray(times)
+        # readfields reads from these like from the variables of a NetCDF object
+        self.variables = {'ocean_time': self.time, 'u': u, 'v': v}
+        if zeta is not None:
+            self.variables['zeta'] = zeta
+        self.variables.update(tracers)
+
+    def times(self):
+        return self.time
+
+    def get_fields(self, tp, tind):
+        if is_string_like(tp.z0): # isoslice case
+            return tracpy.inout.readfields(tind, tp.grid, self, tp.z0, tp.zpar, zparuv=tp.zparuv,
+                                            kband=tp.zband, raw=tp.rawread)
+        else: # 3d case
+            return tracpy.inout.readfields(tind, tp.grid, self, raw=tp.rawread)
+
+    def fingerprint(self):
+        return ['arrays'] + [tracpy.cache._digest(self.variables[name])
+                                for name in sorted(self.variables)]
+
+class CallbackProvider(Provider):
+    '''
+    Model output from a function, like one that steps a coupled ocean model.
+    '''
+
+    replay = False
+
+    def __init__(self, times, callback):
+        '''
+        :param times: Times of the model outputs [t]
+        :param callback: Function callback(tind) that returns either a dictionary of
+               arrays as for ArrayProvider for one time ({'u': [k,j,i-1], 'v': [k,j-1,i],
+               'zeta': [j,i], ...}), or the tuple (uflux1, vflux1, dzt, zrt, zwt) in
+               tracmass ordering, as from readfields. It is called once for each time
+               index that is used, in order, so a run with it can't be split into batches
+               of drifters (Tracpy.make_plan raises a ValueError for that) or calibrated
+               with Tracpy.estimate.
+        '''
+
+        self.time = np.asarray(times)
+        self.callback = callback
+
+    def times(self):
+        return self.time
+
+    def get_fields(self, tp, tind):
+        fields = self.callback(tind)
+        if isinstance(fields, dict):
+            # a time axis of length one, without copying
+            arrays = dict((name, np.asanyarray(value)[np.newaxis]) for name, value in fields.items())
+            fields = ArrayProvider(self.time[tind:tind+1], **arrays).get_fields(tp, 0)
+        return fields
@@ -0,0 +1,284 @@
+"""
+Disk cache for reads from remote model output, like thredds servers, so that
+runs that read the same parts of a remote dataset, even in other processes or
+on other days, don't download them again.
+
+Each read of a variable of a remote dataset (a hyperslab) is stored as one .npz
+file in the cache directory, keyed by the address of the dataset, the variable
+name and the index that was read. Entries that were fetched more than maxage
+seconds ago are fetched again, since remote datasets like forecasts change. The
+least recently used entries are removed when the cache is bigger than maxsize.
+
+The cache is used by opendataset and readgrid in tracpy.inout for addresses that
+start with http, when tracpy.remote.cache is set. It is set to a cache in the
+directory in the TRACPY_REMOTE_CACHE environment variable, if there is one.
+
+Usage:
+    tracpy.remote.cache = tracpy.remote.RemoteCache('remote', maxsize=20e9, maxage=7*24*3600.)
+    grid = tracpy.inout.readgrid('http://barataria.tamu.edu:8080/thredds/dodsC/NcML/txla_nesting6.nc')
+
+Contains:
+    RemoteCache
+    CachedDataset
+    CachedVariable
+    dataset
+"""
+
+import os
+import glob
+import time
+import hashlib
+import numpy as np
+import netCDF4 as netCDF
+
+def _int(value):
+    if value is None:
+        return None
+    return int(value)
+
+def _index(index):
+    '''
+    Version of an index into a variable that can be written the same way every time.
+    '''
+
+    if not isinstance(index, tuple):
+        index = (index,)
+
+    canonical = []
+    for i in index:
+        if isinstance(i, slice):
+            canonical.append(('slice', _int(i.start), _int(i.stop), _int(i.step)))
+        elif i is Ellipsis:
+            canonical.append('...')
+        elif np.ndim(i) == 0:
+            canonical.append(int(i))
+        else: # list or array of indices
+            canonical.append(('list', np.shape(i), tuple(np.asarray(i).ravel().tolist())))
+
+    return tuple(canonical)
+
+class RemoteCache(object):
+    '''
+    Directory of reads from remote datasets.
+    '''
+
+    def __init__(self, directory, maxsize=None, maxage=None):
+        '''
+        :param directory: Where the reads are kept
+        :param maxsize=None: Maximum total size of the reads in bytes, or None for no limit
+        :param maxage=None: Time in seconds after which a read is fetched again, or None to keep it
+        '''
+
+        self.directory = directory
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = None # total size, found when first needed
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError: # someone else made it first
+                pass
+
+    def _file(self, url, name, index):
+        key = hashlib.sha1(repr((str(url), str(name), _index(index)))).hexdigest()
+        return os.path.join(self.directory, key + '.npz')
+
+    def _expired(self, mtime, now):
+        return self.maxage is not None and now - mtime > self.maxage
+
+    def load(self, url, name, index):
+        '''
+        Values of variable name at index of the dataset at url, or None if they are
+        not in the cache or have expired.
+        '''
+
+        filename = self._file(url, name, index)
+        now = time.time()
+        try:
+            mtime = os.stat(filename).st_mtime
+            if self._expired(mtime, now):
+                os.remove(filename)
+                raise OSError
+            d = np.load(filename)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        try:
+            if 'mask' in d.files:
+                values = np.ma.array(d['data'], mask=d['mask'], fill_value=d['fill_value'])
+            else:
+                values = d['data']
+        finally:
+            d.close()
+
+        # the access time is when it was last used, for evicting, and the
+        # modification time is still when it was fetched, for expiring
+        try:
+            os.utime(filename, (now, mtime))
+        except OSError: # removed by someone else
+            pass
+        self.hits += 1
+
+        return values
+
+    def store(self, url, name, index, values):
+        '''
+        Store the values of variable name at index of the dataset at url, and evict
+        old reads if the cache is too big.
+        '''
+
+        if np.ma.isMaskedArray(values):
+            arrays = {'data': np.ma.getdata(values), 'mask': np.ma.getmaskarray(values),
+                        'fill_value': values.fill_value}
+        else:
+            arrays = {'data': np.asarray(values)}
+
+        # write under another name first so that no one reads a half-written file
+        filename = self._file(url, name, index)
+        tmp = '%s.%d.tmp.npz' % (filename[:-4], os.getpid())
+        np.savez(tmp, **arrays)
+        size = os.stat(tmp).st_size
+        os.rename(tmp, filename)
+
+        if self.maxsize is not None:
+            if self._nbytes is None:
+                self.evict()
+            else:
+                self._nbytes += size
+                if self._nbytes > self.maxsize:
+                    self.evict()
+
+    def evict(self):
+        '''
+        Remove reads that have expired, then the least recently used ones until the
+        cache is no bigger than maxsize.
+
+        Output:
+         removed    Number of reads that were removed
+        '''
+
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, '*.npz')):
+            if filename.endswith('.tmp.npz'):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError: # removed by someone else
+                continue
+            entries.append((st.st_atime, st.st_mtime, st.st_size, filename))
+        entries.sort() # least recently used first
+
+        now = time.time()
+        total = sum([size for _, _, size, _ in entries])
+        removed = 0
+        for atime, mtime, size, filename in entries:
+            if self._expired(mtime, now) or (self.maxsize is not None and total > self.maxsize):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                total -= size
+                removed += 1
+        self._nbytes = total
+
+        return removed
+
+    def clear(self):
+        '''
+        Remove all of the reads, and start the statistics over.
+        '''
+
+        for filename in glob.glob(os.path.join(self.directory, '*.npz')):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+class CachedVariable(object):
+    '''
+    Variable of a CachedDataset. Reads go through the cache, and everything else,
+    like attributes and shape, comes from the remote variable.
+    '''
+
+    def __init__(self, dataset, name, variable):
+        '''
+        :param dataset: CachedDataset that the variable is in
+        :param name: Name of the variable
+        :param variable: Remote variable
+        '''
+
+        self.dataset = dataset
+        self.name = name
+        self.variable = variable
+
+    def __getitem__(self, index):
+        cache = self.dataset.cache
+        values = cache.load(self.dataset.url, self.name, index)
+        if values is None:
+            values = self.variable[index]
+            cache.store(self.dataset.url, self.name, index, values)
+        return values
+
+    def __len__(self):
+        return len(self.variable)
+
+    def set_auto_maskandscale(self, value):
+        '''
+        Does nothing: reads are kept in the cache masked and scaled, whatever this is.
+        '''
+
+        pass
+
+    def __getattr__(self, attr):
+        if attr == 'variable': # not set yet
+            raise AttributeError(attr)
+        return getattr(self.variable, attr)
+
+class CachedDataset(object):
+    '''
+    Remote dataset whose variables are read through a RemoteCache. It can be used
+    in place of the netCDF4 Dataset.
+    '''
+
+    def __init__(self, url, cache, opener=netCDF.Dataset):
+        '''
+        :param url: Address of the dataset
+        :param cache: RemoteCache to use
+        :param opener=netCDF.Dataset: Function that opens url
+        '''
+
+        self.url = url
+        self.cache = cache
+        self.dataset = opener(url)
+        self.variables = dict((name, CachedVariable(self, name, var))
+                                for name, var in self.dataset.variables.items())
+
+    def close(self):
+        self.dataset.close()
+
+    def __getattr__(self, attr):
+        if attr == 'dataset': # not set yet
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+# Cache for reads from remote datasets, or None to not keep them
+cache = None
+if 'TRACPY_REMOTE_CACHE' in os.environ:
+    cache = RemoteCache(os.environ['TRACPY_REMOTE_CACHE'])
+
+def dataset(loc):
+    '''
+    Open the dataset at loc, through the cache if loc is a remote address and
+    there is a cache.
+    '''
+
+    if cache is not None and isinstance(loc, basestring) and loc.startswith('http'):
+        return CachedDataset(loc, cache)
+    return netCDF.Dataset(loc)
@@ -0,0 +1,111 @@
+"""
+Rewriting ROMS model output for how tracpy reads it: one time step of a few
+variables at a time. Archives that are chunked over many time steps, or across
+the grid, make each of these reads decompress and read much more than it
+needs. The repacked file has one chunk for each time step of each variable, only
+the variables that tracpy uses, and optionally float32 fields and lossless
+compression. It is a NetCDF4 (classic model) file, so it can be used as
+currents_filename, or with setupROMSfiles, as it is.
+
+Usage:
+    tracpy.repack.repack(sorted(glob.glob('ocean_his_*.nc')), 'his_packed.nc', float32=True)
+    tp = Tracpy('his_packed.nc', grid_filename=grid_filename)
+    # or from the command line
+    python -m tracpy.repack his_packed.nc ocean_his_*.nc
+
+Contains:
+    repack
+"""
+
+import sys
+import time
+import netCDF4 as netCDF
+import numpy as np
+import tracpy
+import tracpy.inout
+
+# Model fields, which can be changed to float32
+fields = ['u', 'v', 'zeta']
+
+# Vertical grid information, which readgrid reads from the model output when there
+# isn't a separate vertical grid file
+vertical = ['s_w', 'sc_w', 'Cs_w', 's_rho', 'sc_r', 'Cs_r', 'hc', 'theta_s', 'theta_b',
+            'Vtransform', 'Vstretching']
+
+def repack(loc, outname, tracers=None, float32=False, zlib=True, complevel=1, verbose=False):
+    '''
+    Rewrite model output with one chunk for each time step of each variable.
+
+    Input:
+     loc        Model output, as for setupROMSfiles: a file name, a list of file names in
+                chronological order, or a thredds server address
+     outname    Name of the file to write
+     tracers    (None) List of other variables to carry, like ['salt'] for isoslices of salt
+     float32    (False) True to store u, v, zeta and the tracers as float32
+     zlib       (True) True to compress the variables (losslessly, with shuffling)
+     complevel  (1) Compression level from 1 to 9, for zlib=True
+     verbose    (False) True to print progress
+
+    Output:
+     outname    Name of the file that was written
+    '''
+
+    if tracers is None:
+        tracers = []
+
+    nc = tracpy.inout.opendataset(loc)
+    for name in tracers:
+        if name not in nc.variables:
+            raise ValueError('there is no variable %s in the model output' % name)
+
+    tdim = nc.variables['ocean_time'].dimensions[0]
+    names = [name for name in ['ocean_time'] + fields + tracers + vertical if name in nc.variables]
+
+    out = netCDF.Dataset(outname, 'w', format='NETCDF4_CLASSIC')
+    for attr in nc.ncattrs():
+        out.setncattr(attr, getattr(nc, attr))
+    out.setncattr('history', 'repacked by tracpy.repack on %s\n%s' % (time.ctime(), getattr(nc, 'history', '')))
+
+    for name in names:
+        var = nc.variables[name]
+        for dim in var.dimensions:
+            if dim not in out.dimensions:
+                out.createDimension(dim, len(nc.dimensions[dim]))
+
+        if float32 and name in fields + tracers:
+            dtype = np.float32
+        else:
+            dtype = var.dtype
+        kwargs = {}
+        if len(var.dimensions) > 1 and var.dimensions[0] == tdim:
+            kwargs['chunksizes'] = (1,) + var.shape[1:]
+        if hasattr(var, '_FillValue'):
+            kwargs['fill_value'] = var._FillValue
+        if var.dimensions: # scalars can't be compressed
+            kwargs['zlib'] = zlib
+            kwargs['complevel'] = complevel
+            kwargs['shuffle'] = zlib
+        outvar = out.createVariable(name, dtype, var.dimensions, **kwargs)
+        for attr in var.ncattrs():
+            if attr != '_FillValue':
+                outvar.setncattr(attr, getattr(var, attr))
+
+        # one time step at a time, so that memory use doesn't depend on the number of them
+        if 'chunksizes' in kwargs:
+            for t in xrange(var.shape[0]):
+                outvar[t] = var[t]
+                if verbose:
+                    print '%s: %d / %d' % (name, t+1, var.shape[0])
+        elif var.dimensions:
+            outvar[:] = var[:]
+        else:
+            outvar.assignValue(var.getValue())
+
+    out.close()
+    nc.close()
+
+    return outname
+
+
+if __name__ == '__main__':
+    repack(sys.argv[2:] if len(sys.argv) > 3 else sys.argv[2], sys.argv[1], verbose=True)
@@ -2,9 +2,12 @@ import numpy as np
 import op
 import netCDF4 as netCDF
 import pdb
+from matplotlib.pyplot import is_string_like
 from tracpy.time_class import Time
+import tracpy.cache
+import tracpy.fieldcache
 
-def run(tp, date, lon0, lat0, T0=None, U=None, V=None):
+def run(tp, date, lon0, lat0, T0=None, U=None, V=None, cache=None):
     '''
     some variables are not specifically called because f2py is hides them
      like imt, jmt, km, ntractot
@@ -20,6 +23,11 @@ def run(tp, date, lon0, lat0, T0=None, U=None, V=None):
                 Is not used if dostream=0.
     U,V         Optional array for east-west/north-south transport, is updated by TRACMASS. 
                 Only used if dostream=1.
+    cache       Optional tracpy.cache.ResultCache, or the name of a directory for one.
+                If a simulation with the same inputs was already run with this cache,
+                its results are returned instead of running it again, and no tracks
+                file is saved. Simulations on model output that can't be identified,
+                like from a tracpy.providers.CallbackProvider, are not cached.
 
     Other variables:
 
@@ -29,52 +37,128 @@ def run(tp, date, lon0, lat0, T0=None, U=None, V=None):
     t           time for drifter tracks
     '''
 
-    timer = Time() # start timer for simulation
-
-    # Initialize everything for a simulation
-    tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0, lat0)
-
-    timer.addtime('1: Preparing for simulation   ')
-
-    # Loop through model outputs.
-    for j,tind in enumerate(tinds[:-1]):
-
-        print 'Using GCM model output index ', tind, '/', tinds.max()
-
-        # Loop through substeps in call to TRACMASS in case we want to add on windage, etc, for each step
-        for nsubstep in xrange(tp.nsubsteps):
-
-            xstart, ystart, zstart, ufsub, vfsub, T0 = tp.prepare_for_model_step(tinds[j+1], nc, flag, xend, yend, zend, j, nsubstep, T0)
-            ind = (flag[:] == 0) # indices where the drifters are still inside the domain
-
-            timer.addtime('2: Preparing for model step   ')
-
-            if not np.ma.compressed(xstart).any(): # exit if all of the drifters have exited the domain
-                break
+    # Use the results of an identical simulation if there are some
+    if cache is not None and tracpy.cache.fingerprint(tp.currents_filename) is None:
+        print 'Not caching this simulation, since its model output can\'t be identified'
+        cache = None
+    if cache is not None:
+        if isinstance(cache, basestring):
+            cache = tracpy.cache.ResultCache(cache)
+        key, inputs = tracpy.cache.input_hash(tp, date, lon0, lat0, T0, U, V)
+        result = cache.load(key)
+        if result is not None:
+            print 'Using results of simulation %s from the cache' % key
+            return result
 
-            # Do stepping in Tracpy class
-            xend_temp,\
-                yend_temp,\
-                zend_temp,\
-                flag[ind],\
-                ttend_temp, U, V = tp.step(xstart, ystart, zstart, ufsub, vfsub, T0, U, V)
-
-            timer.addtime('3: Stepping, using TRACMASS   ')
-
-            xend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
-                yend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
-                zend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
-                zp[ind,j*tp.N+1:j*tp.N+tp.N+1], \
-                ttend[ind,j*tp.N+1:j*tp.N+tp.N+1] = tp.model_step_is_done(xend_temp, yend_temp, zend_temp, ttend_temp, ttend[ind,j*tp.N])
-
-            timer.addtime('4: Processing after model step')
-
-    nc.close()
+    timer = Time() # start timer for simulation
+    fieldstats = tracpy.fieldcache.cache.stats()
+
+    # Choose how to run within the memory budget, if there is one
+    plan = tp.make_plan(date, lon0, lat0)
+    print 'Plan: ', plan
+
+    lon0 = np.asarray(lon0)
+    lat0 = np.asarray(lat0)
+    z0 = tp.z0
+
+    # Run the batches of drifters one after the other
+    batches = [batch for batch in np.array_split(np.arange(lon0.size), plan.nbatches) if batch.size]
+    results = []
+    for batch in batches:
+
+        if len(batches) > 1:
+            print 'Drifters ', batch[0], '-', batch[-1], '/', lon0.size-1
+            if not is_string_like(z0) and np.size(z0) == lon0.size: # depths for each drifter
+                tp.z0 = np.asarray(z0).ravel()[batch]
+        T0b = T0 if T0 is None or len(batches) == 1 else T0[batch]
+
+        # Initialize everything for a simulation
+        tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = tp.prepare_for_model_run(date, lon0[batch], lat0[batch], plan=plan)
+
+        timer.addtime('1: Preparing for simulation   ')
+
+        # Loop through model outputs.
+        for j,tind in enumerate(tinds[:-1]):
+
+            print 'Using GCM model output index ', tind, '/', max(tinds)
+
+            # Loop through substeps in call to TRACMASS in case we want to add on windage, etc, for each step
+            for nsubstep in xrange(tp.nsubsteps):
+
+                xstart, ystart, zstart, ta, tb, T0b = tp.prepare_for_model_step(tinds[j+1], nc, flag, xend, yend, zend, j, nsubstep, T0b)
+                ind = ~np.ma.getmaskarray(xstart) # indices of the drifters that are being stepped
+
+                timer.addtime('2: Preparing for model step   ')
+
+                if not np.ma.compressed(xstart).any(): # exit if all of the drifters have exited the domain
+                    break
+
+                # Do stepping in Tracpy class
+                xend_temp,\
+                    yend_temp,\
+                    zend_temp,\
+                    flag[ind],\
+                    ttend_temp, U, V = tp.step(xstart, ystart, zstart, ta, tb, T0b, U, V)
+
+                timer.addtime('3: Stepping, using TRACMASS   ')
+
+                if (flag[ind] == 2).any():
+                    timer.addcount('Drifters over maxiter     ', (flag[ind] == 2).sum())
+
+                xend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
+                    yend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
+                    zend[ind,j*tp.N+1:j*tp.N+tp.N+1], \
+                    zp[ind,j*tp.N+1:j*tp.N+tp.N+1], \
+                    ttend[ind,j*tp.N+1:j*tp.N+tp.N+1] = tp.model_step_is_done(xend_temp, yend_temp, zend_temp, ttend_temp, ttend[ind,(j+(nsubstep>0))*tp.N])
+
+                timer.addtime('4: Processing after model step')
+
+        tp.state.close() # the model output, and reading ahead
+        results.append((xend, yend, zp, ttend, T0b, tp.counts, tp.layer))
+
+    tp.z0 = z0
+    tp._preloaded = None
+
+    if len(results) == 1:
+        xend, yend, zp, ttend, T0, _, _ = results[0]
+    else: # put the batches back together
+        nt = results[0][0].shape[1]
+        ntrac = sum([result[0].shape[0] for result in results])
+        xend, yend, zp = [tp._trackarray((ntrac, nt), np.nan) for i in xrange(3)]
+        ttend = tp._trackarray((ntrac, nt), 0.)
+        i0 = 0
+        for xendb, yendb, zpb, ttendb, T0b, counts, layer in results:
+            i1 = i0 + xendb.shape[0]
+            xend[i0:i1], yend[i0:i1], zp[i0:i1], ttend[i0:i1] = xendb, yendb, zpb, ttendb
+            i0 = i1
+        if T0 is not None:
+            T0 = np.ma.concatenate([result[4] for result in results])
+        if tp.counts is not None:
+            tp.counts = np.concatenate([result[5] for result in results])
+        if tp.layer is not None: # in order of layer, then drifter, as for one batch
+            tp.layer = np.concatenate([result[6] for result in results])
+            order = np.argsort(tp.layer, kind='mergesort')
+            xend[:], yend[:], zp[:], ttend[:] = xend[order], yend[order], zp[order], ttend[order]
+            tp.layer = tp.layer[order]
+            if tp.counts is not None:
+                tp.counts = tp.counts[order]
 
     lonp, latp, zp, ttend, T0, U, V = tp.finishSimulation(ttend, t0save, xend, yend, zp, T0, U, V)
 
     timer.addtime('5: Processing after simulation')
 
+    if tp.counts is not None: # kernel counters, summed over drifters
+        timer.addcount('Cell crossings            ', tp.counts[:,0].sum())
+        timer.addcount('Iterations                ', tp.counts[:,1].sum())
+        timer.addcount('Diffusion retries         ', tp.counts[:,2].sum())
+        timer.addcount('Drifters stopped by errors', (tp.counts[:,3] != 0).sum())
+
+    # use of the cache of model fields during this run
+    stats = tracpy.fieldcache.cache.stats()
+    timer.addcount('Field cache hits          ', stats['hits'] - fieldstats['hits'])
+    timer.addcount('Field cache misses        ', stats['misses'] - fieldstats['misses'])
+    timer.addcount('Field cache evictions     ', stats['evictions'] - fieldstats['evictions'])
+
     print "============================================="
     print ""
     print "Simulation name: ", tp.name
@@ -83,4 +167,7 @@ def run(tp, date, lon0, lat0, T0=None, U=None, V=None):
 
     timer.write()
 
+    if cache is not None:
+        cache.store(key, (lonp, latp, zp, ttend, T0, U, V), inputs)
+
     return lonp, latp, zp, ttend, T0, U, V
@@ -0,0 +1,225 @@
+"""
+Arrays in named shared memory, so that several processes can use one copy
+of the grid and of the model field slabs.
+
+Each array is a file in /dev/shm (a memory-backed file system) that is
+memory-mapped with numpy, so attaching to it from another process doesn't
+copy anything. Making an array again with the same name, shape and dtype
+refills the one that is there, so processes that attached to it see the new
+values. An array of a new shape or dtype is a new file, and the old one is
+removed: processes that attached to it find it with changed and have to
+attach again. The process that creates the arrays owns them and removes
+them when it closes them or exits. Names include the process id of the owner, so
+that arrays left behind by an owner that crashed are removed the next time
+arrays are created.
+
+Usage:
+    # in the main process
+    shared = SharedArrays()
+    uf = shared.empty('uf', (imt-1, jmt, km, 2))
+    descriptor = shared.descriptor() # can be pickled and sent to workers
+    # in a worker process
+    arrays = attach(descriptor)
+    uf = arrays['uf']
+    ...
+    if changed(descriptor): # the owner made new arrays, get a new descriptor
+        arrays = attach(new_descriptor)
+
+Contains:
+    SharedArrays
+    attach
+    changed
+    cleanup_stale
+"""
+
+import os
+import atexit
+import itertools
+import tempfile
+import numpy as np
+
+# memory-backed directory for the arrays if there is one, otherwise a temporary directory
+if os.path.isdir('/dev/shm'):
+    shmdir = '/dev/shm'
+else:
+    shmdir = tempfile.gettempdir()
+
+prefix = 'tracpy-shm-'
+
+_tags = itertools.count()
+
+def _alive(pid):
+    '''
+    Whether process pid is still running.
+    '''
+
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == 1 # EPERM: exists, but belongs to someone else
+    return True
+
+def cleanup_stale(directory=shmdir):
+    '''
+    Remove shared arrays in directory that were left behind by owners that are not
+    running anymore.
+
+    Output:
+     removed    List of files that were removed
+    '''
+
+    removed = []
+    for filename in os.listdir(directory):
+        if not filename.startswith(prefix):
+            continue
+        try:
+            pid = int(filename[len(prefix):].split('-')[0])
+        except ValueError:
+            continue
+        if not _alive(pid):
+            try:
+                os.remove(os.path.join(directory, filename))
+                removed.append(filename)
+            except OSError: # someone else got to it first
+                pass
+
+    return removed
+
+class SharedArrays(object):
+    '''
+    A set of named arrays in shared memory, owned by this process.
+    '''
+
+    def __init__(self, directory=shmdir):
+        '''
+        :param directory=shmdir: Where the files behind the arrays go. This should be a
+               memory-backed file system for the arrays to really be in shared memory.
+        '''
+
+        self.directory = directory
+        self.pid = os.getpid()
+        self.tag = '%s%d-%d-' % (prefix, self.pid, _tags.next())
+        self.arrays = {} # name: (filename, array)
+        self.versions = {} # name: how many times an array of that name was made
+
+        cleanup_stale(directory)
+        atexit.register(self.close)
+
+    def empty(self, name, shape, dtype=np.float64, order='F'):
+        '''
+        Make a new shared array called name, replacing an existing one of that name.
+        Like np.empty, except that it is filled with zeros. An existing array of the
+        same shape, dtype and order is filled with zeros and used again, so that other
+        processes that attached to it keep seeing it. Otherwise the new array is in a
+        new file.
+        '''
+
+        if name in self.arrays:
+            arr = self.arrays[name][1]
+            if isinstance(arr, np.memmap) and arr.shape == tuple(shape) \
+                and arr.dtype == np.dtype(dtype) and arr.flags[order + '_CONTIGUOUS']:
+                arr[...] = 0
+                return arr
+        self.remove(name)
+
+        version = self.versions.get(name, 0)
+        self.versions[name] = version + 1
+        filename = os.path.join(self.directory, self.tag + name.replace('/', '.'))
+        if version:
+            filename += '.%d' % version
+        if np.prod(shape) == 0: # can't memory-map an empty file
+            arr = np.zeros(shape, dtype=dtype, order=order)
+        else:
+            arr = np.memmap(filename, dtype=dtype, mode='w+', shape=shape, order=order)
+        self.arrays[name] = (filename, arr)
+
+        return arr
+
+    def share(self, name, arr):
+        '''
+        Copy array arr into a new shared array called name, and return the shared array.
+        '''
+
+        arr = np.asanyarray(arr)
+        if arr.flags['F_CONTIGUOUS']:
+            order = 'F'
+        else:
+            order = 'C'
+        shared = self.empty(name, arr.shape, dtype=arr.dtype, order=order)
+        shared[...] = arr
+
+        return shared
+
+    def descriptor(self):
+        '''
+        Description of the shared arrays for attach, which can be pickled.
+
+        Output:
+         descriptor     Dictionary of name: (filename, shape, dtype, order)
+        '''
+
+        descriptor = {}
+        for name, (filename, arr) in self.arrays.items():
+            if arr.size == 0:
+                continue
+            if arr.flags['F_CONTIGUOUS']:
+                order = 'F'
+            else:
+                order = 'C'
+            descriptor[name] = (filename, arr.shape, arr.dtype.str, order)
+
+        return descriptor
+
+    def remove(self, name):
+        '''
+        Remove the shared array called name, if there is one.
+        '''
+
+        if name in self.arrays:
+            filename, arr = self.arrays.pop(name)
+            if isinstance(arr, np.memmap):
+                del(arr)
+                try:
+                    os.remove(filename)
+                except OSError: # already gone
+                    pass
+
+    def close(self):
+        '''
+        Remove all of the shared arrays. Only the owner removes them, so that this
+        is harmless in forked children.
+        '''
+
+        if os.getpid() != self.pid:
+            return
+
+        for name in self.arrays.keys():
+            self.remove(name)
+
+def changed(descriptor):
+    '''
+    Names of the shared arrays in descriptor that the owner has replaced or removed
+    since, which have to be attached again with a new descriptor.
+    '''
+
+    return sorted([name for name, (filename, shape, dtype, order) in descriptor.items()
+                    if not os.path.exists(filename)])
+
+def attach(descriptor, mode='r'):
+    '''
+    Attach to shared arrays made by another process, without copying them.
+
+    Input:
+     descriptor     From SharedArrays.descriptor in the owner
+     mode           ('r') 'r' for read-only arrays, 'r+' to be able to change them
+
+    Output:
+     arrays         Dictionary of name: array
+    '''
+
+    arrays = {}
+    for name, (filename, shape, dtype, order) in descriptor.items():
+        arrays[name] = np.memmap(filename, dtype=np.dtype(dtype), mode=mode,
+                                    shape=shape, order=order)
+
+    return arrays
@@ -21,6 +21,8 @@ class Time(object):
 
         self.total = 0. # will keep track of total time for simulation
 
+        self.counts = {} # initialized dictionary of counters, such as from TRACMASS
+
         # This will get reset each time Time is called for calculating time differences
         self.time_at_last_call = time.time()
 
@@ -41,6 +43,14 @@ class Time(object):
         # Update to current time
         self.time_at_last_call = time.time()
 
+    def addcount(self, name, count):
+        '''
+        Add count to the counter called name. If used before, it will be summed,
+        otherwise it will start from 0.
+        '''
+
+        self.counts[name] = self.counts.get(name, 0) + count
+
     def write(self):
         '''
         Write out all available times.
@@ -53,4 +63,11 @@ class Time(object):
         for key in sorted(self.times.keys()):
             print "\t%s \t\t%4.4f (%4.4f%%)" % (key, self.times[key], (self.times[key]/self.total)*100)
 
+        if self.counts:
+            print "---------------------------------------------"
+            print "Counts:"
+
+            for key in sorted(self.counts.keys()):
+                print "\t%s \t\t%d" % (key, self.counts[key])
+
         print "============================================="
@@ -9,6 +9,7 @@ Functions include:
 * convert_indices
 * check_points
 * seed
+* morton_order
 """
 
 import numpy as np
@@ -370,3 +371,43 @@ def seed(lon, lat, dlon=.5, dlat=.5, N=30):
                                     [[dlon**2,0],[0,dlat**2]], \
                                     [N,N])
     return dist[:,:,0], dist[:,:,1]
+
+def _spread_bits(v):
+    '''
+    Spread the lower 32 bits of integer array v out to the even bits of a 64 bit integer, 
+    for interleaving in morton_order.
+    '''
+
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), 
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), 
+                        (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+def morton_order(x, y):
+    '''
+    Find the order of drifters along a Morton (Z-order) space-filling curve through 
+    their grid cells, so that drifters that are next to each other in this order are 
+    also close to each other on the grid. Stepping drifters in this order makes 
+    TRACMASS read the flux arrays from nearby places in memory.
+
+    Usage:
+        ind = morton_order(xstart, ystart)
+        # step xstart[ind], ystart[ind], ... then put the results back with
+        xend[ind] = xend_sorted
+
+    Inputs:
+        x, y    Drifter locations in grid index coordinates
+    
+    Returns:
+        ind     Indices that sort the drifters along the curve
+    '''
+
+    # grid cell indices, which are the same in Python and Fortran indexing for ordering
+    i = np.floor(np.asarray(x)).astype(np.int64).clip(0)
+    j = np.floor(np.asarray(y)).astype(np.int64).clip(0)
+
+    key = _spread_bits(i) | (_spread_bits(j) << np.uint64(1))
+
+    return np.argsort(key)
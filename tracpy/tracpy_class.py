@@ -8,20 +8,112 @@ import tracpy
 import numpy as np
 from matplotlib.pyplot import is_string_like
 import pdb
-import tracmass
 import datetime
+import time
+import tempfile
 import netCDF4 as netCDF
 from matplotlib.mlab import find
 
+class RunState(object):
+    '''
+    What changes over a simulation: the model fields at the two model outputs that 
+    drifters are being stepped between, the precomputed fields, the kernel counters, 
+    and the model output file that is being read from. The file is reopened from 
+    currents_filename when it is needed after the state has been pickled.
+    '''
+
+    def __init__(self, currents_filename=None):
+
+        self.currents_filename = currents_filename
+        self._nc = None
+
+        # fluxes
+        self.uf = None
+        self.vf = None
+        self.dzt = None
+        self.zrt = None
+        self.zwt = None
+        # precomputed vertical fluxes and grid cell volumes, for doprecompute=1
+        self.wft = None
+        self.dxyzt = None
+
+        # kernel counters for each drifter, for docounters=1
+        self.counts = None
+
+        # index in zpar of the layer of each drifter, for a list of zpar
+        self.layer = None
+
+        # how the simulation is being run, a tracpy.planner.Plan
+        self.plan = None
+
+        # tracpy.prefetch.Prefetcher reading in upcoming model output, for prefetch > 0
+        self.prefetcher = None
+
+    def _getnc(self):
+        if self._nc is None and isinstance(self.currents_filename, tracpy.providers.Provider):
+            self._nc = self.currents_filename
+        elif self._nc is None and self.currents_filename is not None:
+            self._nc = tracpy.handles.acquire(self.currents_filename)
+        return self._nc
+
+    def _setnc(self, nc):
+        self._nc = nc
+
+    nc = property(_getnc, _setnc, doc='NetCDF object for the model output, opened when needed')
+
+    def close(self):
+        '''
+        Close the model output file, if it is open, and stop reading ahead.
+        '''
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_nc'] = None # reopened from currents_filename
+        state['prefetcher'] = None
+        return state
+
+def _stateproperty(name):
+    '''
+    Attribute of a Tracpy object that is kept in its RunState.
+    '''
+
+    return property(lambda self: getattr(self.state, name), 
+                    lambda self, val: setattr(self.state, name, val))
+
 class Tracpy(object):
     '''
     TracPy class.
+
+    The parameters of a simulation are kept separately from what changes during it,
+    which is in a RunState. A Tracpy object can be pickled, to send it to other
+    processes for example, in which case only the parameters are kept. The grid is 
+    read in again when it is next needed, and the state starts over.
     '''
 
+    uf = _stateproperty('uf')
+    vf = _stateproperty('vf')
+    dzt = _stateproperty('dzt')
+    zrt = _stateproperty('zrt')
+    zwt = _stateproperty('zwt')
+    wft = _stateproperty('wft')
+    dxyzt = _stateproperty('dxyzt')
+    counts = _stateproperty('counts')
+    layer = _stateproperty('layer')
+
     def __init__(self, currents_filename, grid_filename=None, vert_filename=None, nsteps=1, ndays=1, ff=1, tseas=3600.,
                 ah=0., av=0., z0='s', zpar=1, do3d=0, doturb=0, name='test', dostream=0, N=1, 
                 time_units='seconds since 1970-01-01', dtFromTracmass=None, zparuv=None, tseas_use=None,
-                usebasemap=False, savell=True, doperiodic=0, usespherical=True, grid=None):
+                usebasemap=False, savell=True, doperiodic=0, usespherical=True, grid=None,
+                usefloat32=False, checkcopies=None, doprecompute=0, sortdrifters=False,
+                docounters=0, maxiter=30000, quarantine=False, backend='fortran', useshared=False,
+                memory_budget=None, plan=None, zband=None, prefetch=0, rawread=False):
         '''
         Initialize class.
 
@@ -29,6 +121,8 @@ class Tracpy(object):
         into TracPy to run the drifters.
 
         :param currents_filename: NetCDF file name (with extension), list of file names, or OpenDAP url to GCM output.
+               Or a tracpy.providers.Provider of the model fields, like arrays in memory, which then
+               needs grid_filename or grid.
         :param grid_filename=None: NetCDF grid file name or OpenDAP url to GCM grid.
         :param vert_filename=None: If vertical grid information is not included in the grid file, or if all grid info is not in output file, use two.
         :param nsteps=1: sets the max time step between GCM model outputs between drifter steps.
@@ -65,6 +159,11 @@ class Tracpy(object):
                 and zpar to be the constant (negative) depth value you want to use
                To simulate drifters at the surface, set z0 to 's' 
                 and zpar = grid['km']-1 to put them in the upper s level
+               For 2D drifters in several layers at once, set zpar to a list of values,
+                like z0='z' and zpar=[-1, -10, -50]. Each drifter is started in each layer
+                and moves in it with the fluxes for that layer, which are all sliced from
+                the same read of the model output. The tracks are in order of layer, then
+                drifter, and the zpar of each track is saved with them.
         :param do3d=0: 1 for 3D or 0 for 2D
         :param doturb=0: 0 for no added diffusion, 1 for diffusion via velocity fluctuation, 
                2/3 for diffusion via random walk (3 for aligned with isobaths)
@@ -99,14 +198,75 @@ class Tracpy(object):
         :param usespherical=True: True if want to use spherical (lon/lat) coordinates and False
                for idealized applications where it isn't necessary to project from spherical coordinates.
         :param grid=None: Grid is initialized to None and is found subsequently normally, but can be set with the TracPy object in order to save time when running a series of simulations.
+        :param usefloat32=False: True to store the model fields in single precision, step drifters
+               with the single precision kernel (tracmass32, built with make f2py32 in src), and save
+               the drifter tracks in single precision. This halves the memory used for the fields.
+               Drifter positions and times are still calculated in double precision in the kernel.
+        :param checkcopies=None: Debug mode for the arguments sent to TRACMASS. Arrays that are not
+               Fortran-contiguous or not of the type expected by the kernel are silently copied by f2py
+               in every call. None quietly converts them, 'warn' converts them with a warning, and 'raise'
+               raises a ValueError instead.
+        :param doprecompute=0: 1 to calculate the vertical fluxes (for do3d=1) and grid cell volumes
+               for all grid cells once for each model output that is read in, and send them to
+               TRACMASS, instead of having TRACMASS recalculate them for every drifter iteration.
+               This is faster for many drifters, at the cost of memory for two more 3D fields.
+               Vertical fluxes are the same as with doprecompute=0, and grid cell volumes
+               differ only by round-off.
+        :param sortdrifters=False: True to send drifters to TRACMASS in the order of their grid cells
+               along a space-filling (Morton) curve, so that drifters that are stepped one after
+               the other read fluxes from nearby memory. This helps for large numbers of drifters
+               on large grids. Drifters are returned in their original order.
+        :param docounters=0: 1 to have TRACMASS count, for each drifter, the grid cell crossings, 
+               iterations, extra tries to find a diffusion displacement within the model area, and 
+               the error code that stopped the drifter, if any. These are summed over the simulation 
+               in counts, included in the timing report of the run, and saved with the tracks. 
+        :param maxiter=30000: Maximum number of TRACMASS iterations for a drifter in one call to
+               TRACMASS. A drifter that needs more, for example because it is stuck going back and
+               forth at a wall, is held in place for the rest of the call and gets flag 2, so that
+               it doesn't hold up all of the other drifters.
+        :param quarantine=False: True to stop stepping drifters after they have gone over maxiter,
+               as is done for drifters that exit the domain. If False, they are tried again in the
+               next call to TRACMASS.
+        :param backend='fortran': What steps the drifters. 'fortran' for the compiled TRACMASS kernel,
+               'numpy' for the same scheme vectorized in numpy (see tracpy.kernel.NumpyBackend), which
+               doesn't need the compiled kernel but is slower and doesn't do doturb!=0 or doperiodic!=0,
+               or an object with a step method that takes the arguments of tracmass.step.
+        :param useshared=False: True to keep the grid arrays and the two time slabs of the model
+               fields in shared memory (see tracpy.shared), so that worker processes can step
+               drifters with them after attach_shared(tp.shared.descriptor()) instead of each
+               reading in and storing its own copy. The shared memory is freed by this object
+               at exit.
+        :param memory_budget=None: Memory in bytes that tracpy.run.run should stay within. The
+               model output is then read in once and kept (preloaded) or read in for each step
+               (streamed), the drifter tracks are kept in memory or in temporary files on disk, and
+               the drifters are run in batches, as chosen by tracpy.planner.choose. None to run all
+               of the drifters together, streaming the model output and keeping the tracks in memory.
+        :param plan=None: A tracpy.planner.Plan to use instead of choosing one, or a dictionary of
+               Plan arguments to use instead of what would be chosen, like {'nbatches': 4}.
+        :param zband=None: (k0, k1) for z0 of 'rho', 'salt', 'temp' or 'z', when the isosurface 
+               is known to be between s levels k0 and k1-1 (0 at the bottom) everywhere, so that 
+               only those levels of the model output are read in. Drifters in columns where the
+               isosurface isn't in the band see no flux there. None to read in all levels.
+        :param prefetch=0: Number of model outputs to read in ahead of when they are used, in
+               background threads (see tracpy.prefetch), while the model output is streamed.
+               This hides the wait for each read from remote model output. 0 to read in each
+               model output when it is needed.
+        :param rawread=False: True to read the model output as plain arrays, without netCDF4's
+               masking and scaling, which is faster and makes fewer temporary arrays (see 
+               tracpy.inout.rawread). Missing values are then 0 in the fields, and nan in the
+               property of an isoslice, instead of being masked.
         '''
 
+        if isinstance(currents_filename, tracpy.providers.NetCDFProvider): # the same as its location
+            currents_filename = currents_filename.loc
         self.currents_filename = currents_filename
         self.grid_filename = grid_filename
 
         # If grid_filename is distinct, assume we need a separate vert_filename for vertical grid info
         # use what is input or use info from currents_filename
-        if grid_filename is not None: 
+        if isinstance(currents_filename, tracpy.providers.Provider): # not a file to read it from
+            self.vert_filename = vert_filename
+        elif grid_filename is not None: 
             if vert_filename is not None:
                 self.vert_filename = vert_filename
             else:
@@ -127,6 +287,10 @@ class Tracpy(object):
         self.ah = ah
         self.av = av
         self.z0 = z0
+        if is_string_like(z0) and np.iterable(zpar) and not is_string_like(zpar): # layers
+            zpar = tuple(zpar)
+            if zparuv is not None:
+                zparuv = tuple(zparuv)
         self.zpar = zpar
         self.do3d = do3d
         self.doturb = doturb
@@ -138,6 +302,29 @@ class Tracpy(object):
         self.savell = savell
         self.doperiodic = doperiodic
         self.usespherical = usespherical
+        self.usefloat32 = usefloat32
+        self.checkcopies = checkcopies
+        self.doprecompute = doprecompute
+        self.sortdrifters = sortdrifters
+        self.docounters = docounters
+        self.maxiter = maxiter
+        self.quarantine = quarantine
+        self.useshared = useshared
+        self.memory_budget = memory_budget
+        self.plan = plan
+        if zband is not None:
+            zband = tuple(zband)
+        self.zband = zband
+        self.prefetch = prefetch
+        self.rawread = rawread
+
+        self._backend = backend # what backend was, for pickling
+        self.backend = tracpy.kernel.get_backend(backend, usefloat32=usefloat32)
+
+        if usefloat32:
+            self.dtype = np.float32
+        else:
+            self.dtype = np.float64
 
         # if loopsteps is None and nsteps is not None:
         #     # Use nsteps in TRACMASS and have inner loop collapse
@@ -186,12 +373,37 @@ class Tracpy(object):
         self.tstride = int(self.tseas_use/self.tseas) # will round down
 
         # For later use
-        # fluxes
-        self.uf = None
-        self.vf = None
-        self.dzt = None
-        self.zrt = None
-        self.zwt = None
+        # fields, counters and model output of the current simulation
+        self.state = RunState(self.currents_filename)
+
+        # static grid arrays prepared for the kernel
+        self._gridargs = None
+
+        # shared memory for the grid and model fields, for useshared=True
+        self.shared = None
+
+        # model fields for each time index, for plans that preload them
+        self._preloaded = None
+
+    def __getstate__(self):
+        '''
+        Keep only the parameters of the simulation when pickling. The grid, the kernel 
+        backend, shared memory and the state of a simulation are left out.
+        '''
+
+        state = self.__dict__.copy()
+        state['grid'] = None
+        state['_gridargs'] = None
+        state['backend'] = None
+        state['shared'] = None
+        state['state'] = RunState(self.currents_filename)
+        state['_preloaded'] = None
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.backend = tracpy.kernel.get_backend(self._backend, usefloat32=self.usefloat32)
 
     def _readgrid(self):
         '''
@@ -203,13 +415,60 @@ class Tracpy(object):
         if self.grid_filename is not None:
             self.grid = tracpy.inout.readgrid(self.grid_filename, self.vert_filename, 
                                                 usebasemap=self.usebasemap, usespherical=self.usespherical)
+        elif isinstance(self.currents_filename, tracpy.providers.Provider):
+            raise ValueError('grid_filename or grid is needed for a provider of model fields')
         else:
             self.grid = tracpy.inout.readgrid(self.currents_filename, usebasemap=self.usebasemap,
                                                 usespherical=self.usespherical)
 
-    def prepare_for_model_run(self, date, lon0, lat0):
+        self._gridargs = None # grid changed, so these need to be remade
+
+    @property
+    def layers(self):
+        '''
+        isoslice values of the layers for a list of zpar, or None.
+        '''
+
+        if is_string_like(self.z0) and isinstance(self.zpar, tuple):
+            return list(self.zpar)
+        return None
+
+    def make_plan(self, date, lon0, lat0):
+        '''
+        Plan how to run a simulation, from memory_budget and plan.
+
+        :param date, lon0, lat0: As for tracpy.run.run
+
+        Output:
+         plan   tracpy.planner.Plan
+        '''
+
+        if isinstance(self.plan, tracpy.planner.Plan):
+            plan = self.plan
+        elif self.memory_budget is None:
+            plan = tracpy.planner.Plan()
+        else:
+            est = self.estimate(date, lon0, lat0, calibrate=False, verbose=False)
+            plan = tracpy.planner.choose(est, self.memory_budget)
+
+        if self.plan is not None and not isinstance(self.plan, tracpy.planner.Plan): # overrides
+            args = {'fields': plan.fields, 'tracks': plan.tracks, 'nbatches': plan.nbatches}
+            args.update(self.plan)
+            plan = tracpy.planner.Plan(reason='overridden: %s' % plan.reason, **args)
+
+        # every batch gets the fields from the start again
+        provider = self.currents_filename
+        if isinstance(provider, tracpy.providers.Provider) and not provider.replay and plan.nbatches > 1:
+            raise ValueError('%s gives the model fields only once, so the drifters can not be run in %d batches (%s)'
+                                % (type(provider).__name__, plan.nbatches, plan.reason))
+
+        return plan
+
+    def prepare_for_model_run(self, date, lon0, lat0, plan=None):
         '''
         Get everything ready so that we can get to the simulation.
+
+        :param plan=None: tracpy.planner.Plan for how the tracks are kept. None for in memory.
         '''
 
         # # Convert date to number
@@ -217,11 +476,32 @@ class Tracpy(object):
 
         # Figure out what files will be used for this tracking
         nc, tinds = tracpy.inout.setupROMSfiles(self.currents_filename, date, self.ff, self.tout, self.time_units, tstride=self.tstride)
+        self.state = RunState(self.currents_filename)
+        self.state.nc = nc
+        if plan is None:
+            plan = tracpy.planner.Plan()
+        self.state.plan = plan
 
         # Read in grid parameters into dictionary, grid, if haven't already
         if self.grid is None:
             self._readgrid()
 
+        # Convert the static grid arrays once for the kernel instead of in every call to it
+        if self._gridargs is None:
+            self._gridargs = tracpy.kernel.grid_args(self.grid)
+
+        if self.useshared:
+            if self.shared is None:
+                self.shared = tracpy.shared.SharedArrays()
+            self._share_grid()
+
+        if isinstance(self.currents_filename, tracpy.providers.Provider):
+            pass # the provider gives the fields when they are needed
+        elif plan.fields == 'preload':
+            self._preload(tinds, nc)
+        elif self.prefetch:
+            self.state.prefetcher = tracpy.prefetch.Prefetcher(self, tinds, self.prefetch)
+
         # Interpolate to get starting positions in grid space
         if self.usespherical: # convert from assumed input lon/lat coord locations to grid space
             xstart0, ystart0, _ = tracpy.tools.interpolate2d(lon0, lat0, self.grid, 'd_ll2ij')
@@ -241,46 +521,73 @@ class Tracpy(object):
         xstart0 = xstart0[ind2]
         ystart0 = ystart0[ind2]
 
-        dates = nc.variables['ocean_time'][:]   
+        # every drifter in every layer
+        if self.layers is not None:
+            if self.dostream or self.doturb == 1:
+                raise NotImplementedError('layers of zpar do not work with dostream or doturb=1')
+            nlayers = len(self.layers)
+            self.layer = np.repeat(np.arange(nlayers), ia.size)
+            ia, ja = np.tile(ia, nlayers), np.tile(ja, nlayers)
+            xstart0, ystart0 = np.tile(xstart0, nlayers), np.tile(ystart0, nlayers)
+
+        if isinstance(nc, tracpy.providers.Provider):
+            dates = nc.times()
+        else:
+            dates = nc.variables['ocean_time'][:]
         t0save = dates[tinds[0]] # time at start of drifter test from file in seconds since 1970-01-01, add this on at the end since it is big
 
         # Initialize drifter grid positions and indices
-        xend = np.ones((ia.size,(len(tinds)-1)*self.N+1))*np.nan
-        yend = np.ones((ia.size,(len(tinds)-1)*self.N+1))*np.nan
-        zend = np.ones((ia.size,(len(tinds)-1)*self.N+1))*np.nan
-        zp = np.ones((ia.size,(len(tinds)-1)*self.N+1))*np.nan
-        ttend = np.zeros((ia.size,(len(tinds)-1)*self.N+1))
+        xend = self._trackarray((ia.size,(len(tinds)-1)*self.N+1), np.nan)
+        yend = self._trackarray((ia.size,(len(tinds)-1)*self.N+1), np.nan)
+        zend = self._trackarray((ia.size,(len(tinds)-1)*self.N+1), np.nan)
+        zp = self._trackarray((ia.size,(len(tinds)-1)*self.N+1), np.nan)
+        ttend = self._trackarray((ia.size,(len(tinds)-1)*self.N+1), 0.)
         flag = np.zeros((ia.size),dtype=np.int) # initialize all exit flags for in the domain
 
+        if self.docounters:
+            self.counts = np.zeros((ia.size, len(tracpy.kernel.counternames)), dtype=np.int)
+
         # Initialize vertical stuff and fluxes
         # Read initial field in - to 'new' variable since will be moved
         # at the beginning of the time loop ahead
         lx = self.grid['xr'].shape[0]
         ly = self.grid['xr'].shape[1]
         lk = self.grid['sc_r'].size
+        if self.layers is not None: # the layers are in place of the vertical levels
+            nk = len(self.layers)
+        else:
+            nk = lk-1
         if is_string_like(self.z0): # isoslice case
             # Now that we have the grid, initialize the info for the two bounding model 
             # steps using the grid size
-            self.uf = np.asfortranarray(np.ones((lx-1, ly, lk-1, 2)))*np.nan
-            self.vf = np.asfortranarray(np.ones((lx, ly-1, lk-1, 2)))*np.nan
-            self.dzt = np.asfortranarray(np.ones((lx, ly, lk-1, 2)))*np.nan
-            self.zrt = np.asfortranarray(np.ones((lx, ly, lk-1, 2)))*np.nan
-            self.zwt = np.asfortranarray(np.ones((lx, ly, lk, 2)))*np.nan
+            self.uf = self._fieldarray('uf', (lx-1, ly, nk, 2), np.nan)
+            self.vf = self._fieldarray('vf', (lx, ly-1, nk, 2), np.nan)
+            self.dzt = self._fieldarray('dzt', (lx, ly, nk, 2), np.nan)
+            self.zrt = self._fieldarray('zrt', (lx, ly, nk, 2), np.nan)
+            self.zwt = self._fieldarray('zwt', (lx, ly, lk, 2), np.nan)
             self.uf[:,:,:,1], self.vf[:,:,:,1], \
                 self.dzt[:,:,:,1], self.zrt[:,:,:,1], \
-                self.zwt[:,:,:,1] = tracpy.inout.readfields(tinds[0], self.grid, nc, self.z0, self.zpar, zparuv=self.zparuv)
+                self.zwt[:,:,:,1] = self._readfields(tinds[0], nc)
 
         else: # 3d case
             # Now that we have the grid, initialize the info for the two bounding model 
             # steps using the grid size
-            self.uf = np.asfortranarray(np.ones((lx-1, ly, lk-1, 2)))*np.nan
-            self.vf = np.asfortranarray(np.ones((lx, ly-1, lk-1, 2)))*np.nan
-            self.dzt = np.asfortranarray(np.ones((lx, ly, lk-1, 2)))*np.nan
-            self.zrt = np.asfortranarray(np.ones((lx, ly, lk-1, 2)))*np.nan
-            self.zwt = np.asfortranarray(np.ones((lx, ly, lk, 2)))*np.nan
+            self.uf = self._fieldarray('uf', (lx-1, ly, lk-1, 2), np.nan)
+            self.vf = self._fieldarray('vf', (lx, ly-1, lk-1, 2), np.nan)
+            self.dzt = self._fieldarray('dzt', (lx, ly, lk-1, 2), np.nan)
+            self.zrt = self._fieldarray('zrt', (lx, ly, lk-1, 2), np.nan)
+            self.zwt = self._fieldarray('zwt', (lx, ly, lk, 2), np.nan)
             self.uf[:,:,:,1], self.vf[:,:,:,1], \
                 self.dzt[:,:,:,1], self.zrt[:,:,:,1], \
-                self.zwt[:,:,:,1] = tracpy.inout.readfields(tinds[0], self.grid, nc)
+                self.zwt[:,:,:,1] = self._readfields(tinds[0], nc)
+
+        if self.doprecompute:
+            self.wft = self._fieldarray('wft', (lx, ly, nk+1, 2), 0., dtype=np.float64)
+            self.dxyzt = self._fieldarray('dxyzt', (lx, ly, nk, 2), 0., dtype=np.float64)
+            self._precompute()
+        else: # TRACMASS doesn't look at these, so they only need the right number of levels
+            self.wft = self._fieldarray('wft', (1, 1, nk+1, 2), 0., dtype=np.float64)
+            self.dxyzt = self._fieldarray('dxyzt', (1, 1, nk, 2), 0., dtype=np.float64)
 
         ## Find zstart0 and ka
         # The k indices and z grid ratios should be on a wflux vertical grid,
@@ -300,6 +607,12 @@ class Tracpy(object):
             # is treated as being at the center of the grid cells vertically.
             zstart0 = np.ones(ia.size)*0.5
 
+            # with layers, each layer is a grid cell vertically, and drifters don't
+            # move between them since there is no vertical flux in 2D
+            if self.layers is not None:
+                ka = ka + self.layer
+                zstart0 = zstart0 + self.layer
+
         else:   # 3d case
             # Convert initial real space vertical locations to grid space
             # first find indices of grid cells vertically
@@ -348,93 +661,266 @@ class Tracpy(object):
 
         return tinds, nc, t0save, xend, yend, zend, zp, ttend, flag
 
+    def _readfields(self, tind, nc):
+        '''
+        Read in the model fields at time index tind, for the isoslice or the 3d case,
+        or use the preloaded ones, the ones read ahead or the ones in tracpy.fieldcache,
+        or get them from the provider of the model fields.
+        '''
+
+        if isinstance(self.currents_filename, tracpy.providers.Provider):
+            return self.currents_filename.get_fields(self, tind)
+
+        if self._preloaded is not None and tind in self._preloaded:
+            return self._preloaded[tind]
+
+        if self.state.prefetcher is not None:
+            fields = self.state.prefetcher.get(tind)
+            if fields is not None:
+                return fields
+
+        return tracpy.fieldcache.read(self, tind, nc)
+
+    def _preload(self, tinds, nc):
+        '''
+        Get the model fields for all of tinds ready for the run, from the ones kept in 
+        tracpy.fieldcache by earlier runs in this process, and by reading in the rest
+        all at once with tracpy.inout.readfields_range.
+        '''
+
+        if self._preloaded is None:
+            self._preloaded = {}
+
+        missing = []
+        for tind in tinds:
+            if tind in self._preloaded:
+                continue
+            fields = tracpy.fieldcache.cache.get(tracpy.fieldcache.key(self, tind))
+            if fields is None:
+                missing.append(tind)
+            else:
+                self._preloaded[tind] = fields
+
+        if missing:
+            self._preloaded.update(tracpy.fieldcache.read_range(self, missing, nc))
+
+    def _trackarray(self, shape, fill):
+        '''
+        Make an array for drifter tracks, in a temporary file on disk if the plan
+        of the run keeps tracks there, otherwise in memory.
+        '''
+
+        if self.state.plan is not None and self.state.plan.tracks == 'disk':
+            arr = np.memmap(tempfile.TemporaryFile(), dtype=np.float64, mode='w+', shape=shape)
+        else:
+            arr = np.empty(shape)
+        arr[:] = fill
+        return arr
+
+    def _fieldarray(self, name, shape, fill, dtype=None):
+        '''
+        Make a Fortran-ordered array for a model field, in shared memory for useshared=True,
+        filled with fill.
+        '''
+
+        if dtype is None:
+            dtype = self.dtype
+
+        if self.shared is not None:
+            arr = self.shared.empty(name, shape, dtype=dtype)
+        else:
+            arr = np.empty(shape, dtype=dtype, order='F')
+        arr[...] = fill
+
+        return arr
+
+    def _share_grid(self):
+        '''
+        Move the grid arrays and the grid arrays prepared for the kernel into shared memory.
+        Other entries of the grid, like the triangulations and the basemap, stay in this process.
+        '''
+
+        for key, val in self.grid.items():
+            if type(val) == np.ndarray and val.size > 1:
+                self.grid[key] = self.shared.share('grid/' + key, val)
+
+        for key, val in self._gridargs.items():
+            if not isinstance(val, np.memmap):
+                self._gridargs[key] = self.shared.share('gridargs/' + key, val)
+
+    def attach_shared(self, descriptor):
+        '''
+        Use the grid and model field arrays that another TracPy object, run with useshared=True,
+        keeps in shared memory, for stepping drifters in another process. Arrays are attached
+        read-only, without copying them, and are updated as the other object reads in model output,
+        also in its later runs on the same grid. If tracpy.shared.changed(descriptor) isn't
+        empty, the other object made new arrays (for a new number of vertical levels or a
+        new precision, say), and this has to be called again with its new descriptor.
+
+        Input:
+         descriptor     From tp.shared.descriptor() of the other TracPy object,
+                        after its prepare_for_model_run
+        '''
+
+        arrays = tracpy.shared.attach(descriptor)
+
+        if self.grid is None:
+            self.grid = {}
+        if self._gridargs is None:
+            self._gridargs = {}
+
+        for name, arr in arrays.items():
+            if name.startswith('grid/'):
+                self.grid[name[5:]] = arr
+            elif name.startswith('gridargs/'):
+                self._gridargs[name[9:]] = arr
+            else: # model fields
+                setattr(self, name, arr)
+
+    def _precompute(self):
+        '''
+        Calculate the vertical fluxes and grid cell volumes for the newest model 
+        output, which is in the second time slab of uf, vf, and dzt.
+        '''
+
+        if self.do3d:
+            tracpy.kernel.calc_wflux(self.uf[:,:,:,1], self.vf[:,:,:,1], self.ff, 
+                                        wf=self.wft[:,:,:,1])
+        self.dxyzt[:,:,:,1] = tracpy.kernel.calc_dxyz(self.dzt[:,:,:,1], self._gridargs['dxdy'])
+
     def prepare_for_model_step(self, tind, nc, flag, xend, yend, zend, j, nsubstep, T0):
         '''
         Already in a step, get ready to actually do step
         '''
 
-        xstart = xend[:,j*self.N]
-        ystart = yend[:,j*self.N]
-        zstart = zend[:,j*self.N]
+        # substeps after the first start where the one before left the drifters
+        if nsubstep == 0:
+            xstart = xend[:,j*self.N]
+            ystart = yend[:,j*self.N]
+            zstart = zend[:,j*self.N]
+        else:
+            xstart = xend[:,(j+1)*self.N]
+            ystart = yend[:,(j+1)*self.N]
+            zstart = zend[:,(j+1)*self.N]
 
-        # mask out drifters that have exited the domain
-        xstart = np.ma.masked_where(flag[:]==1,xstart)
-        ystart = np.ma.masked_where(flag[:]==1,ystart)
-        zstart = np.ma.masked_where(flag[:]==1,zstart)
+        # mask out drifters that have exited the domain, and ones that went over
+        # maxiter if they are quarantined
+        if self.quarantine:
+            stopped = flag[:] != 0
+        else:
+            stopped = flag[:] == 1
+        xstart = np.ma.masked_where(stopped,xstart)
+        ystart = np.ma.masked_where(stopped,ystart)
+        zstart = np.ma.masked_where(stopped,zstart)
         if T0 is not None:
-            T0 = np.ma.masked_where(flag[:]==1,T0)
+            T0 = np.ma.masked_where(stopped,T0)
 
-        # Move previous new time step to old time step info
-        self.uf[:,:,:,0] = self.uf[:,:,:,1].copy()
-        self.vf[:,:,:,0] = self.vf[:,:,:,1].copy()
-        self.dzt[:,:,:,0] = self.dzt[:,:,:,1].copy()
-        self.zrt[:,:,:,0] = self.zrt[:,:,:,1].copy()
-        self.zwt[:,:,:,0] = self.zwt[:,:,:,1].copy()
+        # The substeps all step between the same two model outputs, which are 
+        # read in for the first one
+        if nsubstep == 0:
 
-        # Read stuff in for next time loop
-        if is_string_like(self.z0): # isoslice case
-            self.uf[:,:,:,1],self.vf[:,:,:,1],self.dzt[:,:,:,1],self.zrt[:,:,:,1],self.zwt[:,:,:,1] = tracpy.inout.readfields(tind, self.grid, nc, self.z0, self.zpar, zparuv=self.zparuv)
-        else: # 3d case
-            self.uf[:,:,:,1],self.vf[:,:,:,1],self.dzt[:,:,:,1],self.zrt[:,:,:,1],self.zwt[:,:,:,1] = tracpy.inout.readfields(tind, self.grid, nc)
-
-        # Find the fluxes of the immediately bounding range for the desired time step, which can be less than 1 model output
-        # SHOULD THIS BE PART OF SELF TOO? Leave uf and vf as is, though, because they may be used for interpolating the
-        # input fluxes for substeps.
-        ufsub = np.ones(self.uf.shape)*np.nan
-        vfsub = np.ones(self.vf.shape)*np.nan
-        # for earlier bounding flux info
-        rp = nsubstep/self.nsubsteps # weighting for later time step
-        rm = 1 - rp # timing for earlier time step
-        ufsub[:,:,:,0] = rm*self.uf[:,:,:,0] + rp*self.uf[:,:,:,1]
-        vfsub[:,:,:,0] = rm*self.vf[:,:,:,0] + rp*self.vf[:,:,:,1]
-        # for later bounding flux info
-        rp = (nsubstep+1)/self.nsubsteps # weighting for later time step
-        rm = 1 - rp # timing for earlier time step
-        ufsub[:,:,:,1] = rm*self.uf[:,:,:,0] + rp*self.uf[:,:,:,1]
-        vfsub[:,:,:,1] = rm*self.vf[:,:,:,0] + rp*self.vf[:,:,:,1]
+            # Move previous new time step to old time step info
+            self.uf[:,:,:,0] = self.uf[:,:,:,1].copy()
+            self.vf[:,:,:,0] = self.vf[:,:,:,1].copy()
+            self.dzt[:,:,:,0] = self.dzt[:,:,:,1].copy()
+            self.zrt[:,:,:,0] = self.zrt[:,:,:,1].copy()
+            self.zwt[:,:,:,0] = self.zwt[:,:,:,1].copy()
+
+            # Read stuff in for next time loop
+            self.uf[:,:,:,1],self.vf[:,:,:,1],self.dzt[:,:,:,1],self.zrt[:,:,:,1],self.zwt[:,:,:,1] = self._readfields(tind, nc)
+
+            if self.doprecompute:
+                self.wft[:,:,:,0] = self.wft[:,:,:,1]
+                self.dxyzt[:,:,:,0] = self.dxyzt[:,:,:,1]
+                self._precompute()
+
+        # Find the time window of the immediately bounding range for the desired time step, which can be 
+        # less than 1 model output, as fractions of the time between the two model outputs. 
+        # TRACMASS interpolates the fluxes in uf and vf to this window itself.
+        ta = float(nsubstep)/self.nsubsteps # start of window
+        tb = float(nsubstep+1)/self.nsubsteps # end of window
 
         # Change the horizontal indices from python to fortran indexing 
         # (vertical are zero-based in tracmass)
         xstart, ystart = tracpy.tools.convert_indices('py2f',xstart,ystart)
 
-        return xstart, ystart, zstart, ufsub, vfsub, T0
+        return xstart, ystart, zstart, ta, tb, T0
 
-    def step(self, xstart, ystart, zstart, ufsub, vfsub, T0, U, V):
+    def step(self, xstart, ystart, zstart, ta, tb, T0, U, V):
         '''
         Take some number of steps between a start and end time.
         FIGURE OUT HOW TO KEEP TRACK OF TIME FOR EACH SET OF LINES
 
         :param tind: Time index to use for stepping
+        :param ta, tb: Time window to step over, as fractions of the time between the two
+               model outputs in uf and vf.
         FILL IN
         '''
 
         # Figure out where in time we are 
-        
+
+        # only the drifters that are still in the domain are stepped
+        if self.docounters:
+            active = np.where(~np.ma.getmaskarray(xstart))[0]
+        xstart = np.ma.compressed(xstart)
+        ystart = np.ma.compressed(ystart)
+        zstart = np.ma.compressed(zstart)
         if T0 is not None:
-            xend, yend, zend, flag,\
-                ttend, U, V = \
-                    tracmass.step(np.ma.compressed(xstart),
-                                    np.ma.compressed(ystart),
-                                    np.ma.compressed(zstart),
-                                    self.tseas_use, ufsub, vfsub, self.ff, 
-                                    self.grid['kmt'].astype(int), 
-                                    self.dzt, self.grid['dxdy'], self.grid['dxv'], 
-                                    self.grid['dyu'], self.grid['h'], self.nsteps, 
-                                    self.ah, self.av, self.do3d, self.doturb, 
-                                    self.doperiodic, self.dostream, self.N, 
-                                    t0=np.ma.compressed(T0), ut=U, vt=V)
-        else:
-            xend, yend, zend, flag,\
-                ttend, U, V = \
-                    tracmass.step(np.ma.compressed(xstart),
-                                    np.ma.compressed(ystart),
-                                    np.ma.compressed(zstart),
-                                    self.tseas_use, ufsub, vfsub, self.ff, 
-                                    self.grid['kmt'].astype(int), 
-                                    self.dzt, self.grid['dxdy'], self.grid['dxv'], 
-                                    self.grid['dyu'], self.grid['h'], self.nsteps, 
-                                    self.ah, self.av, self.do3d, self.doturb, 
-                                    self.doperiodic, self.dostream, self.N)
+            T0 = np.ma.compressed(T0)
+
+        # Step drifters in the order of their grid cells along a space-filling curve
+        if self.sortdrifters:
+            ind = tracpy.tools.morton_order(xstart, ystart)
+            xstart, ystart, zstart = xstart[ind], ystart[ind], zstart[ind]
+            if T0 is not None:
+                T0 = T0[ind]
+
+        # Make sure nothing is copied on the way into the kernel
+        check = self.checkcopies
+        xstart = tracpy.kernel.fortran_arg('xstart', xstart, checkcopies=check)
+        ystart = tracpy.kernel.fortran_arg('ystart', ystart, checkcopies=check)
+        zstart = tracpy.kernel.fortran_arg('zstart', zstart, checkcopies=check)
+        uf = tracpy.kernel.fortran_arg('uf', self.uf, self.dtype, checkcopies=check)
+        vf = tracpy.kernel.fortran_arg('vf', self.vf, self.dtype, checkcopies=check)
+        dzt = tracpy.kernel.fortran_arg('dzt', self.dzt, self.dtype, checkcopies=check)
+
+        # Output arrays, which are written in place by the kernel (intent(inout))
+        ntrac = xstart.size
+        xend = np.zeros((ntrac, self.N), order='F')
+        yend = np.zeros((ntrac, self.N), order='F')
+        zend = np.zeros((ntrac, self.N), order='F')
+        ttend = np.zeros((ntrac, self.N), order='F')
+        flag = np.zeros(ntrac, dtype=tracpy.kernel.inttype)
+        if self.docounters:
+            counts = np.zeros((ntrac, len(tracpy.kernel.counternames)), dtype=tracpy.kernel.inttype, order='F')
+        else: # TRACMASS doesn't look at this
+            counts = np.zeros((1, len(tracpy.kernel.counternames)), dtype=tracpy.kernel.inttype, order='F')
+
+        # TRACMASS steps for the part of the time between the model outputs in the window
+        U, V = self.backend.step(xstart, ystart, zstart,
+                                self.tseas_use*(tb-ta), uf, vf, ta, tb, self.ff, 
+                                self._gridargs['kmt'], dzt, self._gridargs['dxdy'], 
+                                self._gridargs['dxv'], self._gridargs['dyu'], self._gridargs['h'], 
+                                xend, yend, zend, flag, ttend, self.nsteps, 
+                                self.ah, self.av, self.do3d, self.doturb, 
+                                self.doperiodic, self.dostream, 
+                                self.doprecompute, self.wft, self.dxyzt, 
+                                self.docounters, counts, self.maxiter, 
+                                T0=T0, U=U, V=V)
+
+        # Put drifters back in their original order
+        if self.sortdrifters:
+            unsort = np.argsort(ind)
+            xend, yend, zend = xend[unsort], yend[unsort], zend[unsort]
+            flag, ttend = flag[unsort], ttend[unsort]
+            if self.docounters:
+                counts = counts[unsort]
+
+        # Add to the counters of the stepped drifters, keeping the last error code
+        if self.docounters:
+            self.counts[active,:3] += counts[:,:3]
+            stopped = counts[:,3] != 0
+            self.counts[active[stopped],3] = counts[stopped,3]
 
         # return the new positions or the delta lat/lon
         return xend, yend, zend, flag, ttend, U, V
@@ -450,8 +936,17 @@ class Tracpy(object):
         # Change the horizontal indices from python to fortran indexing
         xend, yend = tracpy.tools.convert_indices('f2py', xend, yend)
 
+        if self.layers is not None:
+
+            # Depth of the layer at the drifter locations, from the slices of the depths
+            r = np.linspace(1./self.N,1,self.N) # linear time interpolation constant that is used in tracmass
+            zp = np.empty(zend.shape)
+            for n in xrange(self.N):
+                zrt = (1.-r[n])*self.zrt[:,:,:,0] + r[n]*self.zrt[:,:,:,1]
+                zp[:,n], dt = tracpy.tools.interpolate3d(xend[:,n], yend[:,n], zend[:,n]-0.5, zrt)
+
         # Skip calculating real z position if we are doing surface-only drifters anyway
-        if self.z0 != 's' and self.zpar != self.grid['km']-1:
+        elif self.z0 != 's' and self.zpar != self.grid['km']-1:
 
             # Calculate real z position
             r = np.linspace(1./self.N,1,self.N) # linear time interpolation constant that is used in tracmass
@@ -490,6 +985,134 @@ class Tracpy(object):
                             self.tseas_use, self.ah, self.av,
                             self.do3d, self.doturb, self.currents_filename, 
                             self.doperiodic, self.time_units, T0, U, 
-                            V, savell=self.savell)
+                            V, savell=self.savell, usefloat32=self.usefloat32, counts=self.counts,
+                            layers=None if self.layer is None else np.asarray(self.zpar)[self.layer])
 
         return lonp, latp, zp, ttend, T0, U, V
+
+    def estimate(self, date, lon0, lat0, calibrate=True, ncalibrate=10, verbose=True):
+        '''
+        Estimate the memory use and the run time of a simulation before running it.
+        Sizes come from the grid and the model output. The run time comes from a short 
+        calibration run on this machine, of a few of the drifters for one model output.
+
+        :param date, lon0, lat0: As for tracpy.run.run
+        :param calibrate=True: False to skip the calibration run and only find the sizes. 
+               Has to be False for a provider that gives the fields only once, like 
+               tracpy.providers.CallbackProvider.
+        :param ncalibrate=10: Number of drifters in the calibration run
+        :param verbose=True: Print a summary
+
+        Output:
+         est    Dictionary of
+                ntrac           number of drifters
+                nt              number of times in the drifter tracks
+                noutputs        number of model outputs used
+                ncalls          number of calls to TRACMASS
+                nreads          number of calls to readfields
+                tracks_bytes    memory for the drifter track arrays
+                fields_bytes    memory for the model fields
+                memory_bytes    tracks_bytes + fields_bytes
+                read_bytes      amount of model output read in
+                and, with calibrate=True:
+                read_time       seconds per call to readfields
+                step_time       seconds per drifter per call to TRACMASS
+                walltime        predicted seconds for the simulation
+        '''
+
+        nc, tinds = tracpy.inout.setupROMSfiles(self.currents_filename, date, self.ff, self.tout, self.time_units, tstride=self.tstride)
+
+        if self.grid is None:
+            self._readgrid()
+
+        lx = self.grid['xr'].shape[0]
+        ly = self.grid['xr'].shape[1]
+        lk = self.grid['sc_r'].size
+
+        if self.layers is not None:
+            nk = len(self.layers)
+        else:
+            nk = lk-1
+
+        est = {'ntrac': np.size(lon0)*(1 if self.layers is None else nk), 'noutputs': len(tinds)}
+        est['nt'] = (est['noutputs']-1)*self.N+1
+        est['ncalls'] = (est['noutputs']-1)*self.nsubsteps
+        est['nreads'] = est['noutputs'] # model output is read in once for each, not for each substep
+
+        # xend, yend, zend, zp and ttend in prepare_for_model_run, and lonp and latp in finishSimulation
+        est['tracks_bytes'] = 7*est['ntrac']*est['nt']*8
+        # uf, vf, dzt, zrt and zwt, and wft and dxyzt for doprecompute=1
+        est['fields_bytes'] = ((lx-1)*ly*nk + lx*(ly-1)*nk + 2*lx*ly*nk + lx*ly*lk) \
+                                *2*np.dtype(self.dtype).itemsize
+        if self.doprecompute:
+            est['fields_bytes'] += (lx*ly*(nk+1) + lx*ly*nk)*2*8
+        est['memory_bytes'] = est['tracks_bytes'] + est['fields_bytes']
+
+        # number of values readfields reads in for each variable
+        nread = {'u': (lx-1)*ly, 'v': lx*(ly-1)}
+        if is_string_like(self.z0) and self.z0 == 's' and self.layers is not None: # range of levels
+            nread['u'] *= max(self.zparuv) - min(self.zparuv) + 1
+            nread['v'] *= max(self.zparuv) - min(self.zparuv) + 1
+        elif not (is_string_like(self.z0) and self.z0 == 's'): # whole water column
+            nlevels = lk-1
+            if is_string_like(self.z0) and self.zband is not None: # or a band of levels
+                nlevels = len(xrange(lk-1)[self.zband[0]:self.zband[1]])
+            nread['u'] *= nlevels
+            nread['v'] *= nlevels
+            if is_string_like(self.z0) and self.z0 in ['rho', 'salt', 'temp']:
+                nread[self.z0] = lx*ly*nlevels
+        variables = getattr(nc, 'variables', {}) # a provider of model fields may not have any
+        if 'zeta' in variables:
+            nread['zeta'] = lx*ly
+        est['read_bytes'] = est['nreads']*sum([n*(variables[name].dtype.itemsize if name in variables else 8)
+                                                for name, n in nread.items()])
+        nc.close()
+
+        provider = self.currents_filename
+        if calibrate and isinstance(provider, tracpy.providers.Provider) and not provider.replay:
+            raise ValueError('%s gives the model fields only once, so they can not be used for calibrating'
+                                % type(provider).__name__)
+
+        if calibrate:
+            # run a few drifters on a copy, which shares the grid but has its own state
+            tp = Tracpy.__new__(Tracpy) # not copy.copy, which would pickle and leave out the grid
+            tp.__dict__.update(self.__dict__)
+            tp.state = RunState(self.currents_filename)
+            tp.useshared = False
+            tp.shared = None
+            tp.dostream = 0
+            tp.prefetch = 0 # time the reads themselves
+            # from the drifters as given, which are repeated for each layer in the run
+            ndrifters = np.size(lon0)
+            ind = np.unique(np.linspace(0, ndrifters-1, min(ncalibrate, ndrifters)).astype(int))
+            if not is_string_like(self.z0): # depths for each drifter
+                tp.z0 = np.asarray(self.z0)[ind]
+
+            try:
+                tinds, nc, t0save, xend, yend, zend, zp, ttend, flag = \
+                    tp.prepare_for_model_run(date, np.asarray(lon0)[ind], np.asarray(lat0)[ind])
+
+                tic = time.time()
+                xstart, ystart, zstart, ta, tb, T0 = tp.prepare_for_model_step(tinds[1], nc, flag, xend, yend, zend, 0, 0, None)
+                est['read_time'] = time.time() - tic
+
+                tic = time.time()
+                tp.step(xstart, ystart, zstart, ta, tb, None, None, None)
+                est['step_time'] = (time.time() - tic)/max(np.ma.count(xstart), 1)
+            finally:
+                tp.state.close() # the model output, and reading ahead
+
+            est['walltime'] = est['nreads']*est['read_time'] + est['ncalls']*est['ntrac']*est['step_time']
+
+        if verbose:
+            print 'Estimate for %d drifters, %d model outputs and %d calls to TRACMASS:' \
+                    % (est['ntrac'], est['noutputs'], est['ncalls'])
+            print '  memory:  %.1f MB for drifter tracks, %.1f MB for model fields' \
+                    % (est['tracks_bytes']/1e6, est['fields_bytes']/1e6)
+            print '  reading: %.1f MB of model output in %d calls to readfields' \
+                    % (est['read_bytes']/1e6, est['nreads'])
+            if calibrate:
+                print '  time:    %.1f s (%.3f s per readfields, %.2e s per drifter per TRACMASS call)' \
+                        % (est['walltime'], est['read_time'], est['step_time'])
+
+        return est